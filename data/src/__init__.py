@@ -1,5 +1,7 @@
 from src.boundary_details import DetailsGenerator
 from src.boundary_loader import BoundaryLoader
+from src.boundary_simplifier import BoundarySimplifier
+from src.build_pipeline import BuildPipeline
 from src.cache_climate import CacheClimate
 from src.chessscape_loader import ChessScapeLoader
 from src.db_manager import DBManager
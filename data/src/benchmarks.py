@@ -0,0 +1,385 @@
+import io
+import time
+
+import numpy as np
+import psycopg2
+import shapely
+
+from src.binary_copy import copy_binary, encode_arrays, encode_binary_copy
+from src.climate_layout import (
+    CLIMATE_DECADES,
+    CLIMATE_PRECISIONS,
+    CLIMATE_STATS,
+    CLIMATE_VARIABLES,
+    get_array_element,
+    get_wide_column_names,
+)
+
+
+def connect_to_db(config):
+    """
+    Connect to database with the credentials in the config file, returning a psycopg2 connection.
+    """
+
+    return psycopg2.connect(
+        host=config["host"], dbname=config["dbname"], user=config["user"], password=config["user_pass"]
+    )
+
+
+def benchmark_copy(config, n_rows=250000, n_columns=30):
+    """
+    Compare rows/s for the text COPY path (rows formatted with str() into a StringIO buffer and loaded with copy_from)
+    against the binary COPY path, for a table shaped like a single variable CHESS-SCAPE table. Random data is loaded
+    into a temporary table, so nothing is left in the database.
+    """
+
+    conn = connect_to_db(config)
+    cur = conn.cursor()
+
+    grid_cell_ids = np.arange(n_rows, dtype=np.int32)
+    climate_data = np.random.default_rng(0).random((n_rows, n_columns), dtype=np.float32)
+
+    column_names = ["grid_cell_id"] + [f"col_{k}" for k in range(n_columns)]
+    columns_definition = ", ".join(f'"{col}" FLOAT' for col in column_names[1:])
+
+    results = {}
+
+    for path in ["text", "binary"]:
+        cur.execute('DROP TABLE IF EXISTS "benchmark_copy"')
+        cur.execute(f'CREATE TEMP TABLE "benchmark_copy" (grid_cell_id INTEGER PRIMARY KEY, {columns_definition})')
+        conn.commit()
+
+        t1 = time.time()
+
+        if path == "text":
+            output = io.StringIO()
+            for grid_cell_id, row in zip(grid_cell_ids, climate_data, strict=True):
+                output.write(",".join(map(str, [grid_cell_id, *row])) + "\n")
+
+            output.seek(0)
+            cur.copy_from(output, "benchmark_copy", sep=",", columns=column_names)
+            output.close()
+
+        else:
+            columns = [grid_cell_ids, *climate_data.astype(np.float64).T]
+            copy_binary(cur, "benchmark_copy", column_names, columns)
+
+        conn.commit()
+        t2 = time.time()
+
+        results[path] = n_rows / (t2 - t1)
+        print(f"{path} COPY: {n_rows} rows in {t2 - t1:.2f} seconds ({results[path]:.0f} rows/s)")
+
+    print(f"Binary COPY speedup: {results['binary'] / results['text']:.2f}x")
+
+    cur.execute('DROP TABLE IF EXISTS "benchmark_copy"')
+    conn.commit()
+    conn.close()
+
+    return results
+
+
+def benchmark_overlap_keys(config, n_regions=200000, cells_per_region=10, no_overlap_every=100):
+    """
+    Compare overlap table layouts on a synthetic boundary set, shaped like the LSOA or parishes overlap tables:
+
+        - before: no indexes, regions with no overlaps found with NOT IN (SELECT DISTINCT gid ...)
+        - after: bulk insert, then a primary key on (gid, grid_cell_id) and an index on grid_cell_id, with regions with
+          no overlaps found with an anti-join (NOT EXISTS)
+
+    The time to load and index the table, and to find the regions with no overlaps, is printed for both. For
+    reference, the load is also timed with the indexes created before the insert. Every no_overlap_every-th region has
+    no overlaps. Data is loaded into temporary tables, so nothing is left in the database.
+    """
+
+    conn = connect_to_db(config)
+    cur = conn.cursor()
+
+    rng = np.random.default_rng(0)
+
+    boundary_gids = np.arange(1, n_regions + 1, dtype=np.int32)
+    overlap_region_gids = boundary_gids[boundary_gids % no_overlap_every != 0]
+
+    gids = np.repeat(overlap_region_gids, cells_per_region)
+    grid_cell_ids = rng.integers(0, 700000 // cells_per_region, len(gids), dtype=np.int32) * cells_per_region + np.tile(
+        np.arange(cells_per_region, dtype=np.int32), len(overlap_region_gids)
+    )
+    is_overlap = np.ones(len(gids), dtype=bool)
+    bias_corrected = rng.random(len(gids)) < 0.9
+    overlap_fractions = rng.random(len(gids), dtype=np.float32)
+
+    overlap_columns = [gids, grid_cell_ids, is_overlap, bias_corrected, overlap_fractions]
+    overlap_column_names = ["gid", "grid_cell_id", "is_overlap", "bias_corrected", "overlap_fraction"]
+
+    cur.execute('DROP TABLE IF EXISTS "benchmark_boundary"')
+    cur.execute('CREATE TEMP TABLE "benchmark_boundary" (gid INTEGER PRIMARY KEY)')
+    copy_binary(cur, "benchmark_boundary", ["gid"], [boundary_gids])
+    cur.execute('ANALYZE "benchmark_boundary"')
+    conn.commit()
+
+    add_indexes_queries = [
+        'ALTER TABLE "benchmark_overlaps" ADD PRIMARY KEY (gid, grid_cell_id) INCLUDE (overlap_fraction)',
+        'CREATE INDEX "benchmark_overlaps_grid_cell_id_idx" ON "benchmark_overlaps" (grid_cell_id)',
+    ]
+
+    lookup_queries = {
+        "before": """
+            SELECT s.gid
+            FROM "benchmark_boundary" s
+            WHERE s.gid NOT IN (
+                SELECT DISTINCT gid
+                FROM "benchmark_overlaps"
+            );
+            """,
+        "after": """
+            SELECT s.gid
+            FROM "benchmark_boundary" s
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM "benchmark_overlaps" o
+                WHERE o.gid = s.gid
+            );
+            """,
+    }
+
+    results = {}
+
+    for layout in ["before", "indexes_before_insert", "after"]:
+        cur.execute('DROP TABLE IF EXISTS "benchmark_overlaps"')
+        cur.execute(
+            """
+            CREATE TEMP TABLE "benchmark_overlaps" (
+                gid INTEGER,
+                grid_cell_id INTEGER,
+                is_overlap BOOLEAN,
+                bias_corrected BOOLEAN,
+                overlap_fraction REAL
+            )
+            """
+        )
+        conn.commit()
+
+        t1 = time.time()
+
+        if layout == "indexes_before_insert":
+            for query in add_indexes_queries:
+                cur.execute(query)
+
+        copy_binary(cur, "benchmark_overlaps", overlap_column_names, overlap_columns)
+
+        if layout == "after":
+            for query in add_indexes_queries:
+                cur.execute(query)
+
+        cur.execute('ANALYZE "benchmark_overlaps"')
+        conn.commit()
+
+        t2 = time.time()
+
+        results[layout] = {"load": t2 - t1}
+        print(f"{layout}: loaded {len(gids)} overlaps in {t2 - t1:.2f} seconds")
+
+        if layout == "indexes_before_insert":
+            continue
+
+        cur.execute(lookup_queries[layout])
+        no_overlap_gids = [row[0] for row in cur.fetchall()]
+
+        t3 = time.time()
+
+        results[layout]["lookup"] = t3 - t2
+        print(f"{layout}: found {len(no_overlap_gids)} regions with no overlaps in {t3 - t2:.2f} seconds")
+
+        if len(no_overlap_gids) != n_regions // no_overlap_every:
+            raise ValueError(f"Unexpected number of regions with no overlaps: {len(no_overlap_gids)}")
+
+    load_speedup = results["indexes_before_insert"]["load"] / results["after"]["load"]
+    print(f"Load speedup (indexes after vs before insert): {load_speedup:.2f}x")
+    print(f"No overlap lookup speedup: {results['before']['lookup'] / results['after']['lookup']:.2f}x")
+
+    cur.execute('DROP TABLE IF EXISTS "benchmark_overlaps"')
+    cur.execute('DROP TABLE IF EXISTS "benchmark_boundary"')
+    conn.commit()
+    conn.close()
+
+    return results
+
+
+def benchmark_grid_geometry(grid_loader):
+    """
+    Compare the time taken to create the grid cell geometries and encode the binary COPY buffer for the grid table,
+    using the per-cell loop (GridLoader.create_grid_data_rows) against the vectorised version
+    (GridLoader.create_grid_data_columns). The grid loader must have its netcdf files opened and masks processed. Both
+    versions are checked to give the same cells, and nothing is written to the database.
+    """
+
+    t1 = time.time()
+
+    rows = grid_loader.create_grid_data_rows()
+    grid_cell_ids, geometries, tags, coastal_labels = zip(*rows, strict=True)
+    columns_before = [np.array(grid_cell_ids, dtype=np.int32), geometries, np.array(tags, dtype=bool), coastal_labels]
+    encode_binary_copy(columns_before).close()
+
+    t2 = time.time()
+
+    columns_after = grid_loader.create_grid_data_columns()
+    encode_binary_copy(columns_after).close()
+
+    t3 = time.time()
+
+    results = {"before": t2 - t1, "after": t3 - t2}
+    print(f"Per-cell loop: {len(rows)} cells in {results['before']:.2f} seconds")
+    print(f"Vectorised: {len(columns_after[0])} cells in {results['after']:.2f} seconds")
+    print(f"Speedup: {results['before'] / results['after']:.2f}x")
+
+    geometries_before = shapely.from_wkb(list(columns_before[1]))
+    # Fixed length bytes values are read from the raw buffer, as numpy strips trailing null bytes from each value
+    geometry_length = columns_after[1].dtype.itemsize
+    geometries_after = shapely.from_wkb(
+        [row.tobytes() for row in columns_after[1].view(np.uint8).reshape(-1, geometry_length)]
+    )
+
+    if not (
+        np.array_equal(columns_before[0], columns_after[0])
+        and shapely.equals(geometries_before, geometries_after).all()
+        and np.array_equal(columns_before[2], columns_after[2])
+        and list(columns_before[3]) == list(columns_after[3])
+    ):
+        raise ValueError("Per-cell and vectorised grid data do not match.")
+
+    return results
+
+
+def get_query_blocks(cur, query, params=None):
+    """
+    Run a query with EXPLAIN (ANALYZE, BUFFERS), returning the number of blocks it read (from the buffer cache or
+    otherwise, including temporary table blocks) and its execution time in seconds.
+    """
+
+    cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+    explained = cur.fetchone()[0][0]
+
+    plan = explained["Plan"]
+    blocks = sum(plan.get(f"{buffer} {kind} Blocks", 0) for buffer in ["Shared", "Local"] for kind in ["Hit", "Read"])
+
+    return blocks, explained["Execution Time"] / 1000
+
+
+def benchmark_climate_layout(config, n_cells=250000, n_lookup_cells=5000, precision="single"):
+    """
+    Compare the wide and array layouts of a CHESS-SCAPE climate table (see src/climate_layout.py), with random data
+    for n_cells grid cells, stored in the given precision ("double" or "single", see CLIMATE_PRECISIONS) in both:
+
+        - wide: one row per cell, with a column per variable, decade and statistic
+        - array: one row per cell and variable, with a [decade][statistic] array, ordered by variable
+
+    The size of each table (with its primary key) is printed, with the blocks read and time taken by a scan of one
+    variable (as when caching a single variable over all cells), and by a lookup of the mean columns used by the app
+    for n_lookup_cells random cells (as in the cell method). Data is loaded into temporary tables, so nothing is left
+    in the database.
+    """
+
+    conn = connect_to_db(config)
+    cur = conn.cursor()
+
+    rng = np.random.default_rng(0)
+
+    grid_cell_ids = np.arange(n_cells, dtype=np.int32)
+    climate_data = rng.random((len(CLIMATE_VARIABLES), n_cells, len(CLIMATE_DECADES), len(CLIMATE_STATS)))
+    climate_dtype, column_type = CLIMATE_PRECISIONS[precision]
+    climate_data = climate_data.astype(climate_dtype)
+
+    lookup_cell_ids = sorted(rng.choice(n_cells, n_lookup_cells, replace=False).tolist())
+    lookup_variables = ["tas", "sfcWind", "pr", "rsds"]
+    lookup_columns = [f"{variable}_{decade}_mean" for variable in lookup_variables for decade in CLIMATE_DECADES]
+
+    # Wide layout table
+    column_names = get_wide_column_names()
+    columns_definition = ", ".join(f'"{col}" {column_type}' for col in column_names)
+
+    cur.execute('DROP TABLE IF EXISTS "benchmark_wide"')
+    cur.execute(f'CREATE TEMP TABLE "benchmark_wide" (grid_cell_id INTEGER PRIMARY KEY, {columns_definition})')
+
+    wide_columns = [grid_cell_ids, *climate_data.transpose(1, 0, 2, 3).reshape(n_cells, -1).T]
+    copy_binary(cur, "benchmark_wide", ["grid_cell_id", *column_names], wide_columns)
+
+    # Array layout table, loaded variable by variable, so rows are ordered by variable
+    cur.execute('DROP TABLE IF EXISTS "benchmark_arrays"')
+    cur.execute(
+        f"""
+        CREATE TEMP TABLE "benchmark_arrays" (
+            grid_cell_id INTEGER,
+            variable VARCHAR,
+            decade_stats {column_type}[],
+            PRIMARY KEY (variable, grid_cell_id)
+        )
+        """
+    )
+
+    for variable, variable_data in zip(CLIMATE_VARIABLES, climate_data, strict=True):
+        variables = np.full(n_cells, variable.encode("utf-8"))
+        array_columns = [grid_cell_ids, variables, encode_arrays(variable_data)]
+        copy_binary(cur, "benchmark_arrays", ["grid_cell_id", "variable", "decade_stats"], array_columns)
+
+    cur.execute('ANALYZE "benchmark_wide"')
+    cur.execute('ANALYZE "benchmark_arrays"')
+    conn.commit()
+
+    array_lookup_columns = ", ".join(
+        "AVG({}) FILTER (WHERE {})".format(*get_array_element(col, "c")) for col in lookup_columns
+    )
+    lookup_variables_list = ", ".join(f"'{variable}'" for variable in lookup_variables)
+
+    queries = {
+        "wide": {
+            "scan": ('SELECT AVG("tas_2020_mean") FROM "benchmark_wide"', None),
+            "lookup": (
+                f"""
+                SELECT {", ".join(f'AVG("{col}")' for col in lookup_columns)}
+                FROM "benchmark_wide"
+                WHERE grid_cell_id = ANY(%s)
+                """,
+                (lookup_cell_ids,),
+            ),
+        },
+        "array": {
+            "scan": ("""SELECT AVG(decade_stats[5][2]) FROM "benchmark_arrays" WHERE variable = 'tas'""", None),
+            "lookup": (
+                f"""
+                SELECT {array_lookup_columns}
+                FROM "benchmark_arrays" c
+                WHERE c.variable IN ({lookup_variables_list}) AND c.grid_cell_id = ANY(%s)
+                """,
+                (lookup_cell_ids,),
+            ),
+        },
+    }
+
+    results = {}
+
+    for layout, table_name in [("wide", "benchmark_wide"), ("array", "benchmark_arrays")]:
+        cur.execute("SELECT pg_total_relation_size(%s)", (table_name,))
+        results[layout] = {"size": cur.fetchone()[0]}
+        print(f"{layout}: table size {results[layout]['size'] / 1024**2:.1f} MB")
+
+        for query_name, (query, params) in queries[layout].items():
+            # Run each query once first, so both layouts are timed with the table in the buffer cache
+            cur.execute(query, params)
+            cur.fetchall()
+
+            blocks, execution_time = get_query_blocks(cur, query, params)
+            results[layout][query_name] = {"blocks": blocks, "time": execution_time}
+            print(f"{layout}: {query_name} read {blocks} blocks in {execution_time:.3f} seconds")
+
+    print(f"Size reduction: {results['wide']['size'] / results['array']['size']:.2f}x")
+
+    for query_name in ["scan", "lookup"]:
+        block_reduction = results["wide"][query_name]["blocks"] / results["array"][query_name]["blocks"]
+        print(f"{query_name.capitalize()} blocks read reduction: {block_reduction:.2f}x")
+
+    cur.execute('DROP TABLE IF EXISTS "benchmark_wide"')
+    cur.execute('DROP TABLE IF EXISTS "benchmark_arrays"')
+    conn.commit()
+    conn.close()
+
+    return results
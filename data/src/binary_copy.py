@@ -0,0 +1,186 @@
+import io
+import struct
+
+import numpy as np
+
+# Binary COPY file header: signature, flags field and header extension length
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+
+# Binary COPY file trailer: a field count of -1
+PGCOPY_TRAILER = struct.pack(">h", -1)
+
+# Network byte order formats for fixed width types. The numpy dtype must match the column type in the database, i.e.
+# int32 for INTEGER, int64 for BIGINT, float32 for REAL, float64 for FLOAT / DOUBLE PRECISION and bool for BOOLEAN
+BINARY_FORMATS = {
+    np.dtype(np.bool_): "?",
+    np.dtype(np.int16): ">i2",
+    np.dtype(np.int32): ">i4",
+    np.dtype(np.int64): ">i8",
+    np.dtype(np.float32): ">f4",
+    np.dtype(np.float64): ">f8",
+}
+
+# Element type OIDs of arrays sent with binary COPY, i.e. float4 for REAL[] columns
+ARRAY_ELEMENT_OIDS = {
+    np.dtype(np.int16): 21,
+    np.dtype(np.int32): 23,
+    np.dtype(np.int64): 20,
+    np.dtype(np.float32): 700,
+    np.dtype(np.float64): 701,
+}
+
+
+def get_binary_format(dtype):
+    """
+    Get the network byte order format of a fixed width numpy dtype, or None if the dtype is not fixed width. Fixed
+    length bytes (i.e. dtype "S93") are also fixed width, for variable width types where every value has the same
+    length (such as EWKB for grid cell boxes, or arrays encoded with encode_arrays).
+    """
+
+    if dtype.kind == "S":
+        return dtype
+
+    return BINARY_FORMATS.get(dtype)
+
+
+def encode_variable_width_field(value):
+    """
+    Encode a single variable width field (i.e. text or EWKB geometry) with its length prefix. None is sent as NULL.
+    """
+
+    if value is None:
+        return struct.pack(">i", -1)
+
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+
+    return struct.pack(">i", len(value)) + bytes(value)
+
+
+def encode_arrays(values):
+    """
+    Encode each row of an (n_rows, *dims) numpy array as a Postgres binary array value, i.e. an array of shape (10, 3)
+    gives a REAL[10][3] value per row for float32 data. As every value has the same length, values are returned as a
+    fixed length bytes array (see get_binary_format), so they are encoded in bulk. Array dimensions start from 1, and
+    arrays never contain NULL (NaN is sent as a float value).
+    """
+
+    n_rows, *dims = values.shape
+    element_oid = ARRAY_ELEMENT_OIDS[values.dtype]
+
+    # Array header: number of dimensions, has null flag, element type, then the size and lower bound of each dimension
+    header = struct.pack(">iii", len(dims), 0, element_oid)
+    header += b"".join(struct.pack(">ii", size, 1) for size in dims)
+
+    # Each element is preceded by its length
+    elements = np.empty((n_rows, values[0].size), dtype=[("length", ">i4"), ("value", BINARY_FORMATS[values.dtype])])
+    elements["length"] = values.dtype.itemsize
+    elements["value"] = values.reshape(n_rows, -1)
+
+    value_length = len(header) + elements.dtype.itemsize * values[0].size
+
+    encoded = np.empty((n_rows, value_length), dtype=np.uint8)
+    encoded[:, : len(header)] = np.frombuffer(header, dtype=np.uint8)
+    encoded[:, len(header) :] = elements.view(np.uint8).reshape(n_rows, -1)
+
+    return encoded.view(f"S{value_length}").ravel()
+
+
+def encode_fixed_width_fields(columns, field_count=None):
+    """
+    Encode a run of fixed width columns into a packed numpy structured array, with one record per row. Each field is
+    preceded by its length. If a field count is given, each record is preceded by the number of fields in the tuple.
+    """
+
+    fields = [("field_count", ">i2")] if field_count is not None else []
+
+    for k, column in enumerate(columns):
+        fields += [(f"length_{k}", ">i4"), (f"value_{k}", get_binary_format(column.dtype))]
+
+    records = np.empty(len(columns[0]), dtype=np.dtype(fields))
+
+    if field_count is not None:
+        records["field_count"] = field_count
+
+    for k, column in enumerate(columns):
+        records[f"length_{k}"] = column.dtype.itemsize
+        records[f"value_{k}"] = column
+
+    return records
+
+
+def encode_binary_copy(columns):
+    """
+    Encode columns of data into a PostgreSQL binary COPY buffer. Columns must be given in the same order as the COPY
+    column list. Each column is either a 1D numpy array with a dtype in BINARY_FORMATS or a fixed length bytes dtype
+    (encoded in bulk), or a sequence of str/bytes/None values (i.e. text, or EWKB for geometry columns), encoded row by
+    row.
+
+    If every column is fixed width, the whole buffer is created with a single numpy structured array.
+    """
+
+    n_rows = len(columns[0])
+
+    if any(len(column) != n_rows for column in columns):
+        raise ValueError("All columns must have the same number of rows.")
+
+    # Split columns into runs of fixed width columns, and single variable width columns
+    segments = []
+    fixed_run = []
+
+    for column in columns:
+        if isinstance(column, np.ndarray) and get_binary_format(column.dtype) is not None:
+            fixed_run.append(column)
+            continue
+
+        if fixed_run:
+            segments.append(("fixed", encode_fixed_width_fields(fixed_run, None if segments else len(columns))))
+            fixed_run = []
+
+        segments.append(("variable", column))
+
+    if fixed_run:
+        segments.append(("fixed", encode_fixed_width_fields(fixed_run, None if segments else len(columns))))
+
+    output = io.BytesIO()
+    output.write(PGCOPY_HEADER)
+
+    if len(segments) == 1 and segments[0][0] == "fixed":
+        output.write(segments[0][1].tobytes())
+
+    else:
+        # The field count prefixes the first fixed width run. If the first column is variable width, write it here
+        field_count_prefix = b"" if segments[0][0] == "fixed" else struct.pack(">h", len(columns))
+
+        encoded_segments = []
+        for kind, segment in segments:
+            if kind == "fixed":
+                size = segment.dtype.itemsize
+                data = segment.tobytes()
+                encoded_segments.append([data[i * size : (i + 1) * size] for i in range(n_rows)])
+            else:
+                encoded_segments.append([encode_variable_width_field(value) for value in segment])
+
+        output.writelines(field_count_prefix + b"".join(row) for row in zip(*encoded_segments, strict=True))
+
+    output.write(PGCOPY_TRAILER)
+    output.seek(0)
+
+    return output
+
+
+def copy_binary(cur, table_name, column_names, columns):
+    """
+    Bulk insert columns of data into a table using binary COPY. See encode_binary_copy for the supported column types.
+    """
+
+    output = encode_binary_copy(columns)
+
+    column_list = ", ".join(f'"{column_name}"' for column_name in column_names)
+    copy_query = f'COPY "{table_name}" ({column_list}) FROM STDIN WITH (FORMAT binary)'
+
+    try:
+        cur.copy_expert(copy_query, output)
+
+    finally:
+        output.close()
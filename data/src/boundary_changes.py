@@ -0,0 +1,139 @@
+import psycopg2
+
+from src.boundary_simplifier import BoundarySimplifier
+from src.cache_climate import CacheClimate
+from src.coastal_identifier import CoastalIdentifier
+from src.overlap_calculator import OverlapCalculator
+
+
+def get_snapshot_table_name(boundary_identifier):
+    """
+    Get the name of the table storing the gids and geometry hashes of a boundary, as it was when its overlaps and cache
+    were last computed.
+    """
+
+    return f"boundary_{boundary_identifier}_snapshot"
+
+
+def find_changed_gids(cur, boundary_identifier):
+    """
+    Compare a boundary table with its snapshot, by gid and geometry hash (md5 of the EWKB). Returns a dictionary of the
+    gids that were added, changed (i.e. a different geometry) or removed since the snapshot was taken, or None if there
+    is no snapshot.
+
+    Note that boundary tables are loaded with a serial gid (see BoundaryLoader), so regions are only matched to their
+    previous versions if a revised shapefile keeps its features in the same order.
+    """
+
+    snapshot_table_name = get_snapshot_table_name(boundary_identifier)
+
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (f'"{snapshot_table_name}"',))
+
+    if not cur.fetchone()[0]:
+        return None
+
+    find_changed_gids_query = f"""
+    SELECT
+        CASE
+            WHEN s.gid IS NULL THEN 'added'
+            WHEN b.gid IS NULL THEN 'removed'
+            ELSE 'changed'
+        END,
+        COALESCE(b.gid, s.gid)
+    FROM (
+        SELECT gid, md5(ST_AsEWKB(geom)) AS geom_hash
+        FROM "boundary_{boundary_identifier}"
+    ) b
+    FULL JOIN "{snapshot_table_name}" s ON s.gid = b.gid
+    WHERE b.geom_hash IS DISTINCT FROM s.geom_hash
+    ORDER BY 2;
+    """
+
+    cur.execute(find_changed_gids_query)
+
+    changes = {"added": [], "changed": [], "removed": []}
+
+    for change, gid in cur.fetchall():
+        changes[change].append(gid)
+
+    return changes
+
+
+def update_snapshot(conn, cur, boundary_identifier):
+    """
+    Replace the snapshot of a boundary with the gids and geometry hashes currently in its boundary table.
+    """
+
+    snapshot_table_name = get_snapshot_table_name(boundary_identifier)
+
+    try:
+        cur.execute(f'DROP TABLE IF EXISTS "{snapshot_table_name}";')
+        cur.execute(
+            f"""
+            CREATE TABLE "{snapshot_table_name}" AS
+            SELECT gid, md5(ST_AsEWKB(geom)) AS geom_hash
+            FROM "boundary_{boundary_identifier}";
+            """
+        )
+        cur.execute(f'ALTER TABLE "{snapshot_table_name}" ADD PRIMARY KEY (gid);')
+        conn.commit()
+
+    except psycopg2.Error as e:
+        print(f"Error updating {boundary_identifier} snapshot: {e}")
+        conn.rollback()
+        raise
+
+
+def refresh_changed_regions(config, boundary_identifier, process_no_overlaps=True):
+    """
+    After a boundary table has been reloaded, update its overlaps and cache tables for the regions that were added,
+    changed or removed only (see OverlapCalculator.refresh_boundary and CacheClimate.refresh_boundary), then update its
+    snapshot. If the boundary has no snapshot, its overlaps and cache are rebuilt in full. Returns the changes found, or
+    None if rebuilt in full.
+
+    Reloading a boundary table (see BoundaryLoader) drops its is_coastal column, and leaves its simplified geometries
+    out of date, so both are recreated for the whole boundary (see CoastalIdentifier and BoundarySimplifier) once the
+    overlaps are updated.
+    """
+
+    overlap_calculator = OverlapCalculator(config)
+    overlap_calculator.connect_to_db()
+
+    cacher = CacheClimate(config)
+    cacher.connect_to_db()
+
+    coastal_identifier = CoastalIdentifier(config)
+    coastal_identifier.connect_to_db()
+
+    boundary_simplifier = BoundarySimplifier(config)
+    boundary_simplifier.connect_to_db()
+
+    try:
+        changes = find_changed_gids(overlap_calculator.cur, boundary_identifier)
+
+        if changes is None:
+            print(f"No snapshot found for {boundary_identifier}: rebuilding overlaps and cache in full.\n")
+            overlap_calculator.process_boundary(boundary_identifier, process_no_overlaps)
+            cacher.process_boundary(boundary_identifier)
+
+        else:
+            print(
+                f"{boundary_identifier}: {len(changes['added'])} added, {len(changes['changed'])} changed and "
+                f"{len(changes['removed'])} removed regions.\n"
+            )
+            overlap_calculator.refresh_boundary(boundary_identifier, changes, process_no_overlaps)
+            cacher.refresh_boundary(boundary_identifier, changes)
+
+        # Coastal tagging uses the overlaps, so is run once they are updated
+        coastal_identifier.process_boundary(boundary_identifier)
+        boundary_simplifier.process_boundary(boundary_identifier)
+
+        update_snapshot(overlap_calculator.conn, overlap_calculator.cur, boundary_identifier)
+
+    finally:
+        overlap_calculator.conn.close()
+        cacher.conn.close()
+        coastal_identifier.conn.close()
+        boundary_simplifier.conn.close()
+
+    return changes
@@ -1,20 +1,69 @@
-import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
+import pandas as pd
 import psycopg2
+import pyogrio
+import shapely
+
+from src.binary_copy import copy_binary
+
+# Postgres column types for the attribute dtypes read from shapefiles. Other dtypes are loaded as text
+COLUMN_TYPES = {
+    np.dtype(np.bool_): "BOOLEAN",
+    np.dtype(np.int16): "SMALLINT",
+    np.dtype(np.int32): "INTEGER",
+    np.dtype(np.int64): "BIGINT",
+    np.dtype(np.float32): "REAL",
+    np.dtype(np.float64): "DOUBLE PRECISION",
+}
+
+
+def load_boundary_in_worker(config, boundary_identifier, source_projection, target_projection, batch_size):
+    """
+    Load a single boundary with a new BoundaryLoader (with its own database connection), so this can be run in a worker
+    thread. Returns the time taken.
+    """
+
+    start_time = time.time()
+
+    boundary_loader = BoundaryLoader(config)
+    boundary_loader.set_database_projection_code(target_projection)
+    boundary_loader.batch_size = batch_size
+    boundary_loader.connect_to_db()
+
+    try:
+        boundary_loader.load_boundary(boundary_identifier, source_projection)
+
+    finally:
+        boundary_loader.conn.close()
+
+    return time.time() - start_time
 
 
 class BoundaryLoader:
     """
     Class to handle the loading of boundary files, provided as ESPG 27700 shapefiles by default.
+
+    Shapefiles are read in batches of self.batch_size features with pyogrio, reprojected to the database projection
+    with geopandas (pyproj), and inserted with a binary COPY, with geometries sent as EWKB. Each boundary table has the
+    same layout as a table loaded with shp2pgsql (i.e. shp2pgsql -I -d -s <source>:<target>):
+
+        - gid: serial primary key
+        - one column per shapefile attribute, with lower case names
+        - geom: geometry(MultiPolygon, <target projection>), with a GiST index
     """
 
     def __init__(self, config):
         self.conf = config
         self.conn = None
         self.cur = None
-        self.connection_string = None
         self.target_projection = None
 
+        # Number of features read from a shapefile and inserted at a time
+        self.batch_size = 50000
+
         self.set_database_projection_code("27700")
 
     def set_database_projection_code(self, target_projection_code):
@@ -42,8 +91,6 @@ class BoundaryLoader:
 
         print("Connection successful.")
 
-        self.connection_string = f"postgresql://{user}:{password}@{host}/{dbname}"
-
     def drop_table(self, table_name):
         """
         Drop table given its name.
@@ -57,9 +104,99 @@ class BoundaryLoader:
         except Exception as e:
             print(f"Error dropping boundary table: {e}")
 
+    def get_attribute_columns(self, filepath):
+        """
+        Get the attribute fields of a shapefile, with their database column names and numpy dtypes (see COLUMN_TYPES
+        for the database column types). As with shp2pgsql, column names are lower case, and an attribute named gid is
+        renamed to __gid (as gid is the primary key). Also returns the number of features in the shapefile.
+        """
+
+        info = pyogrio.read_info(filepath)
+
+        attribute_columns = []
+        for field, dtype in zip(info["fields"], info["dtypes"], strict=True):
+            column_name = field.lower()
+
+            if column_name == "gid":
+                column_name = "__gid"
+
+            attribute_columns.append((field, column_name, np.dtype(dtype)))
+
+        return attribute_columns, info["features"]
+
+    def create_table(self, table_name, attribute_columns):
+        """
+        Create a boundary table with the given attribute columns, a serial gid and a geometry column.
+        """
+
+        column_definitions = [
+            f'"{column_name}" {COLUMN_TYPES.get(dtype, "VARCHAR")}' for _, column_name, dtype in attribute_columns
+        ]
+        column_definitions = ",\n            ".join(
+            ["gid SERIAL PRIMARY KEY", *column_definitions, f"geom geometry(MultiPolygon, {self.target_projection})"]
+        )
+
+        create_table_query = f"""
+        CREATE TABLE "{table_name}" (
+            {column_definitions}
+        );
+        """
+
+        self.cur.execute(create_table_query)
+
+    def get_attribute_values(self, values, dtype):
+        """
+        Get the values of an attribute column for binary COPY. Numeric and boolean columns without missing values are
+        sent as fixed width numpy arrays (see src/binary_copy.py). Otherwise values are sent one by one, with missing
+        values as NULL. Integer fields with missing values are read as floats, so are cast back to the field's dtype.
+        """
+
+        missing = pd.isna(values)
+
+        if dtype not in COLUMN_TYPES:
+            return [None if is_missing else str(value) for value, is_missing in zip(values, missing, strict=True)]
+
+        if not missing.any():
+            return np.asarray(values, dtype=dtype)
+
+        # Numpy scalars are native byte order, so the bytes of each value are taken from a byte view of the array
+        big_endian_values = np.where(missing, 0, values).astype(dtype.newbyteorder(">"))
+        value_bytes = big_endian_values.view(np.uint8).reshape(len(big_endian_values), dtype.itemsize)
+
+        return [None if is_missing else value.tobytes() for value, is_missing in zip(value_bytes, missing, strict=True)]
+
+    def get_geometry_values(self, geometries):
+        """
+        Get EWKB for an array of (multi)polygons. Polygons are converted to single part multipolygons, and any Z values
+        are dropped, to match the geometry column type.
+        """
+
+        geometries = shapely.force_2d(np.array(geometries, dtype=object))
+
+        is_polygon = shapely.get_type_id(geometries) == shapely.GeometryType.POLYGON
+        geometries[is_polygon] = shapely.multipolygons(geometries[is_polygon], indices=np.arange(is_polygon.sum()))
+
+        geometries = shapely.set_srid(geometries, int(self.target_projection))
+
+        return shapely.to_wkb(geometries, include_srid=True)
+
+    def insert_batch(self, table_name, attribute_columns, batch):
+        """
+        Insert a batch of features (a GeoDataFrame, in the database projection) with a binary COPY.
+        """
+
+        column_names = [column_name for _, column_name, _ in attribute_columns] + ["geom"]
+
+        columns = [self.get_attribute_values(batch[field].to_numpy(), dtype) for field, _, dtype in attribute_columns]
+        columns.append(self.get_geometry_values(batch.geometry.to_numpy()))
+
+        copy_binary(self.cur, table_name, column_names, columns)
+
     def load_boundary(self, boundary_identifier, source_projection, filepath=None):
         """
-        Drop boundary table and load into database with shp2pgsql.
+        Drop boundary table and load the shapefile into the database, in batches. The source projection is used
+        regardless of the shapefile's .prj file (as with shp2pgsql -s). The table is committed once fully loaded and
+        indexed. Errors are raised, after the transaction is rolled back.
         """
 
         key = f"{boundary_identifier}_shp"
@@ -69,17 +206,37 @@ class BoundaryLoader:
 
         table_name = f"boundary_{boundary_identifier}"
 
-        cmd = f'shp2pgsql -I -d -s {source_projection}:{self.target_projection} "{filepath}" {table_name} | psql {self.connection_string}'
+        attribute_columns, n_features = self.get_attribute_columns(filepath)
 
         try:
-            os.system(cmd)
+            self.cur.execute(f'DROP TABLE IF EXISTS "{table_name}";')
+            self.create_table(table_name, attribute_columns)
+
+            for skip_features in range(0, n_features, self.batch_size):
+                batch = pyogrio.read_dataframe(filepath, skip_features=skip_features, max_features=self.batch_size)
+                batch = batch.set_crs(f"EPSG:{source_projection}", allow_override=True)
+
+                if str(source_projection) != str(self.target_projection):
+                    batch = batch.to_crs(f"EPSG:{self.target_projection}")
+
+                self.insert_batch(table_name, attribute_columns, batch)
+
+            self.cur.execute(f'CREATE INDEX "{table_name}_geom_idx" ON "{table_name}" USING GIST (geom);')
+            self.cur.execute(f'ANALYZE "{table_name}";')
+            self.conn.commit()
 
         except Exception as e:
+            self.conn.rollback()
             print(f"Error creating {boundary_identifier} table: {e}")
+            raise
+
+        print(f"Loaded {n_features} regions into {table_name}.")
 
-    def load_all_boundaries(self):
+    def load_all_boundaries(self, workers=None):
         """
-        Load all 6 boundaries using boundary identifiers.
+        Load all 8 boundaries using boundary identifiers. If a number of workers is given, boundaries are loaded
+        concurrently in a pool of worker threads, each with its own database connection (so this class does not need to
+        be connected). Otherwise, boundaries are loaded one by one using this class's connection.
         """
 
         source_projections = {
@@ -93,17 +250,31 @@ class BoundaryLoader:
             "iom": "4326",
         }
 
-        for boundary_identifier in source_projections:
-            table_name = f"boundary_{boundary_identifier}"
-            self.drop_table(table_name)
-
         print("############################")
         print("### Processing all boundaries...\n")
 
-        for boundary_identifier, source_projection in source_projections.items():
-            print(f"### Processing boundary: {boundary_identifier}")
-            self.load_boundary(boundary_identifier, source_projection)
-            print(f"### Processing complete: {boundary_identifier}\n")
+        if workers:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(
+                        load_boundary_in_worker,
+                        self.conf,
+                        boundary_identifier,
+                        source_projection,
+                        self.target_projection,
+                        self.batch_size,
+                    ): boundary_identifier
+                    for boundary_identifier, source_projection in source_projections.items()
+                }
+
+                for future in as_completed(futures):
+                    print(f"### Processing complete: {futures[future]} ({future.result():.2f} seconds)\n")
+
+        else:
+            for boundary_identifier, source_projection in source_projections.items():
+                print(f"### Processing boundary: {boundary_identifier}")
+                self.load_boundary(boundary_identifier, source_projection)
+                print(f"### Processing complete: {boundary_identifier}\n")
 
         print("### Processing complete for all boundaries.")
         print("############################\n")
@@ -0,0 +1,137 @@
+import psycopg2
+
+from src.table_swap import get_shadow_table_name, swap_tables
+
+
+class BoundarySimplifier:
+    """
+    Class to precompute simplified boundary geometries, so that the server does not simplify geometries on each request
+    for regions (see the /region route in server/routes/api.js).
+
+    For each boundary, a boundary_<boundary_identifier>_simplified table is created with a gid column (matching the
+    boundary table), and one geometry column per simplification tier. Geometries are simplified with
+    ST_SimplifyPreserveTopology in the database projection (EPSG 27700, so tolerances are in metres), then transformed
+    to EPSG 4326, ready to be sent to the client. Each tier column has a GiST index.
+
+    Tier columns are named geom_4326_<tolerance>, i.e. geom_4326_64 for a 64m tolerance, and geom_4326_0 is the
+    unsimplified geometry. The client requests a tolerance for the current zoom level, from 4891.97m (zoom 5, the
+    minimum) to 0.3m (zoom 19): the server selects the largest tier tolerance no larger than this. Tiers are spaced by a
+    factor of 4, i.e. every other zoom level, so the tier served has a tolerance more than a quarter of the requested
+    tolerance: geometries are less than 4 times as detailed as requested (i.e. the 1024m tier is served for the 2446m
+    requested at zoom 6). Below 1m, unsimplified geometries are served.
+    """
+
+    def __init__(self, config):
+        self.conf = config
+        self.conn = None
+        self.cur = None
+
+        # Simplification tolerances in metres
+        self.tolerances = [0, 1, 4, 16, 64, 256, 1024, 4096]
+
+        self.boundary_identifiers = [
+            "uk_counties",
+            "la_districts",
+            "lsoa",
+            "msoa",
+            "parishes",
+            "sc_dz",
+            "ni_dz",
+            "iom",
+        ]
+
+    def connect_to_db(self, host=None, dbname=None, user=None, password=None):
+        """
+        Connect to database with provided credentials, or those in config file.
+        """
+
+        if not host or not dbname or not user or not password:
+            host = self.conf["host"]
+            dbname = self.conf["dbname"]
+            user = self.conf["user"]
+            password = self.conf["user_pass"]
+
+            print("Connecting using db config from config file...")
+
+        self.conn = psycopg2.connect(host=host, dbname=dbname, user=user, password=password)
+        self.cur = self.conn.cursor()
+
+        print("Connection successful.")
+
+    def get_tier_column(self, tolerance):
+        """
+        Get the name of the geometry column for a simplification tolerance.
+        """
+
+        return f"geom_4326_{tolerance}"
+
+    def get_tier_geometry(self, tolerance):
+        """
+        Get the SQL expression for the simplified geometry of a tier, in EPSG 4326.
+        """
+
+        if tolerance == 0:
+            return "ST_Transform(geom, 4326)"
+
+        return f"ST_Multi(ST_Transform(ST_SimplifyPreserveTopology(ST_Transform(geom, 27700), {tolerance}), 4326))"
+
+    def process_boundary(self, boundary_identifier):
+        """
+        Create the simplified geometry table for a boundary, replacing it if it exists. The table is created and indexed
+        under its shadow name, then swapped in (see src/table_swap.py), so the server can read the live table while it
+        is rebuilt, and never reads a partially built table.
+        """
+
+        boundary_table_name = f"boundary_{boundary_identifier}"
+        table_name = f"{boundary_table_name}_simplified"
+        shadow_table_name = get_shadow_table_name(table_name)
+
+        tier_columns = ",\n            ".join(
+            f"{self.get_tier_geometry(tolerance)}::geometry(MultiPolygon, 4326) AS {self.get_tier_column(tolerance)}"
+            for tolerance in self.tolerances
+        )
+
+        create_table_query = f"""
+        CREATE TABLE "{shadow_table_name}" AS
+        SELECT
+            gid,
+            {tier_columns}
+        FROM "{boundary_table_name}";
+        """
+
+        try:
+            self.cur.execute(f'DROP TABLE IF EXISTS "{shadow_table_name}";')
+            self.cur.execute(create_table_query)
+            self.cur.execute(f'ALTER TABLE "{shadow_table_name}" ADD PRIMARY KEY (gid);')
+
+            for tolerance in self.tolerances:
+                column_name = self.get_tier_column(tolerance)
+                self.cur.execute(
+                    f'CREATE INDEX "{shadow_table_name}_{column_name}_idx" ON "{shadow_table_name}" '
+                    f"USING GIST ({column_name});"
+                )
+
+            self.conn.commit()
+
+        except psycopg2.Error as e:
+            print(f"Error simplifying {boundary_identifier} geometries: {e}")
+            self.conn.rollback()
+            raise
+
+        swap_tables(self.conn, self.cur, [table_name])
+
+        print(f"Simplified geometries created: {table_name}")
+
+    def process_all_boundaries(self):
+        """
+        Create the simplified geometry tables for all boundaries.
+        """
+
+        print("############################")
+        print(f"### Simplifying all boundaries (tolerances: {self.tolerances})...\n")
+
+        for boundary_identifier in self.boundary_identifiers:
+            self.process_boundary(boundary_identifier)
+
+        print("\n### Simplification complete for all boundaries.")
+        print("############################\n")
@@ -0,0 +1,789 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from functools import partial
+
+import psycopg2
+from psycopg2.extras import Json
+
+from src.boundary_changes import update_snapshot
+from src.boundary_details import DetailsGenerator
+from src.boundary_loader import BoundaryLoader
+from src.boundary_simplifier import BoundarySimplifier
+from src.cache_climate import CacheClimate
+from src.chessscape_loader import ChessScapeLoader
+from src.climate_layout import get_climate_table_name, get_storage_precision
+from src.coastal_identifier import CoastalIdentifier
+from src.db_manager import DBManager
+from src.grid_loader import GridLoader
+from src.mask_artefact import load_mask_artefact
+from src.overlap_calculator import OverlapCalculator
+
+
+class BuildPipeline:
+    """
+    Class to run the LCAT database build (as performed by hand in data/examples/build_db.ipynb) as a series of stages.
+    Each stage is recorded in a build_manifest table with the following data:
+
+        - stage: primary key, the stage name
+        - status: "running", "complete" or "failed"
+        - inputs: the input files (with size and modification time), and upstream stages (with output fingerprints)
+        - outputs: the tables written by the stage
+        - input_fingerprint: hash of the inputs
+        - output_fingerprint: hash of the content (row count and row hashes) of the output tables
+        - started_at, finished_at: timestamps
+        - error: the traceback if the stage failed
+
+    When the pipeline is run, a stage is skipped if it has completed before with the same input fingerprint, and its
+    output tables still exist. As stages are run in dependency order, and a stage's input fingerprint includes the
+    output fingerprints of the stages it depends on, a rerun resumes from the first failed (or changed) stage.
+
+    Note that input files are fingerprinted by size and modification time, rather than by content, as hashing all of the
+    CHESS-SCAPE NetCDF files would take a long time. Output tables are fingerprinted by content.
+
+    Stages form a dependency graph: boundaries and grid are independent of each other, and overlaps, geometry
+    simplification, coastal tagging and caching are split into one stage per boundary. The climate stage also builds
+    the UK averages table, from the same decade data (see ChessScapeLoader.process_all_rcps), so each NetCDF file is
+    only read once. Stages are run in a thread pool as soon as their dependencies are complete, limited by
+    max_connections: each stage holds one database connection while it runs (the boundaries stage holds one per
+    boundary loaded at once, and the climate stage one per worker process), and the manifest uses one further
+    connection. A stage that needs more connections than max_connections is an error. Once the build is
+    finished, the critical path (the chain of dependent stages that bounded the build time) is reported.
+    """
+
+    def __init__(self, config, boundary_details=None, max_connections=4):
+        self.conf = config
+        self.conn = None
+        self.cur = None
+
+        self.table_name = "build_manifest"
+
+        # Boundary details, as passed to DetailsGenerator.process_data. If not given, the details stage is skipped
+        self.boundary_details = boundary_details
+
+        self.boundary_identifiers = [
+            "uk_counties",
+            "la_districts",
+            "lsoa",
+            "msoa",
+            "parishes",
+            "sc_dz",
+            "ni_dz",
+            "iom",
+        ]
+
+        # Labelled mask created by the grid stage, and used by the climate stage
+        self.labelled_mask = None
+
+        # Optional mask artefact, written by the grid stage (see GridLoader.save_mask_artefact)
+        self.mask_artefact = self.conf.get("chess_scape_mask_artefact")
+
+        # Number of worker processes for the climate stage (see ChessScapeLoader.process_all_rcps)
+        self.climate_workers = None
+
+        # Layout of the climate tables written by the climate stage (see ChessScapeLoader.set_layout)
+        self.climate_layout = self.conf.get("chess_scape_layout", "wide")
+
+        # Storage precision of the climate, UK averages and cache tables (see src/climate_layout.py)
+        self.climate_precision = get_storage_precision(self.conf)
+
+        # Maximum number of database connections held by running stages
+        self.max_connections = max_connections
+
+        # Stages run in worker threads, and share the manifest connection
+        self.manifest_lock = threading.Lock()
+
+        # Start and end times of each stage in the last run, relative to the start of the run
+        self.stage_timings = {}
+
+        self.stages = {}
+        self.set_stages()
+
+    def connect_to_db(self, host=None, dbname=None, user=None, password=None):
+        """
+        Connect to database with provided credentials, or those in config file.
+        """
+
+        if not host or not dbname or not user or not password:
+            host = self.conf["host"]
+            dbname = self.conf["dbname"]
+            user = self.conf["user"]
+            password = self.conf["user_pass"]
+
+            print("Connecting using db config from config file...")
+
+        self.conn = psycopg2.connect(host=host, dbname=dbname, user=user, password=password)
+        self.cur = self.conn.cursor()
+
+        print("Connection successful.")
+
+    #########################################################################
+    ### Stage definitions
+    #########################################################################
+
+    def get_netcdf_filepaths(self):
+        """
+        Get all NetCDF files in the CHESS-SCAPE data folder.
+        """
+
+        filepaths = []
+
+        for root, _, filenames in os.walk(self.conf["chess_scape_netcdf_location"]):
+            filepaths += [os.path.join(root, filename) for filename in filenames if filename.endswith(".nc")]
+
+        return sorted(filepaths)
+
+    def get_shapefile_filepaths(self):
+        """
+        Get all boundary shapefiles, including the sidecar files (i.e. .dbf, .shx and .prj) that share their name.
+        """
+
+        filepaths = []
+
+        for boundary_identifier in self.boundary_identifiers:
+            shapefile = self.conf[f"{boundary_identifier}_shp"]
+            stem, _ = os.path.splitext(os.path.basename(shapefile))
+            folder = os.path.dirname(shapefile)
+
+            if not os.path.isdir(folder):
+                filepaths.append(shapefile)
+                continue
+
+            filepaths += [
+                os.path.join(folder, filename)
+                for filename in os.listdir(folder)
+                if os.path.splitext(filename)[0] == stem
+            ]
+
+        return sorted(filepaths)
+
+    def get_grid_netcdf_filepaths(self):
+        """
+        Get the two NetCDF files used to create the grid (see GridLoader.open_netcdf_files).
+        """
+
+        data_location = self.conf["chess_scape_netcdf_location"]
+
+        return [
+            os.path.join(
+                data_location,
+                "data/rcp60_bias-corrected/01/annual/"
+                "chess-scape_rcp60_bias-corrected_01_tas_uk_1km_annual_19801201-20801130.nc",
+            ),
+            os.path.join(
+                data_location, "data/rcp60/01/annual/chess-scape_rcp60_01_tas_uk_1km_annual_19801201-20801130.nc"
+            ),
+        ]
+
+    def set_stages(self):
+        """
+        Define the build stages, in an order where each stage comes after the stages it depends on. Each stage has the
+        following keys:
+
+            - depends_on: stages that must be complete before this stage runs
+            - inputs: a function returning the input files of the stage
+            - outputs: the tables the stage writes
+            - output_columns (optional): columns the stage adds to tables written by other stages, by table name
+            - connections: the number of database connections the stage holds while it runs
+            - run: the function that runs the stage
+        """
+
+        climate_tables = [
+            get_climate_table_name(rcp, season, self.climate_layout)
+            for rcp in [60, 85]
+            for season in ["annual", "winter", "summer"]
+        ]
+
+        self.stages = {
+            "database": {
+                "depends_on": [],
+                "inputs": list,
+                "outputs": [],
+                "connections": 1,
+                "run": self.run_database,
+            },
+            "boundaries": {
+                "depends_on": ["database"],
+                "inputs": self.get_shapefile_filepaths,
+                "outputs": [f"boundary_{b}" for b in self.boundary_identifiers],
+                "connections": min(len(self.boundary_identifiers), self.max_connections),
+                "run": self.run_boundaries,
+            },
+            "grid": {
+                "depends_on": ["database"],
+                "inputs": self.get_grid_netcdf_filepaths,
+                "outputs": ["chess_scape_grid"],
+                "connections": 1,
+                "run": self.run_grid,
+            },
+            "climate": {
+                "depends_on": ["grid"],
+                "inputs": self.get_netcdf_filepaths,
+                "outputs": [*climate_tables, "chess_scape_uk_averages"],
+                "connections": 1 + (self.climate_workers or 0),
+                "run": self.run_climate,
+            },
+            "details": {
+                "depends_on": ["database"],
+                "inputs": list,
+                "outputs": ["boundary_details"],
+                "connections": 1,
+                "run": self.run_details,
+            },
+        }
+
+        for boundary_identifier in self.boundary_identifiers:
+            self.stages[f"overlaps_{boundary_identifier}"] = {
+                "depends_on": ["boundaries", "grid"],
+                "inputs": list,
+                "outputs": [f"grid_overlaps_{boundary_identifier}"],
+                "connections": 1,
+                "run": partial(self.run_overlaps, boundary_identifier),
+            }
+
+        for boundary_identifier in self.boundary_identifiers:
+            self.stages[f"simplify_{boundary_identifier}"] = {
+                "depends_on": ["boundaries"],
+                "inputs": list,
+                "outputs": [f"boundary_{boundary_identifier}_simplified"],
+                "connections": 1,
+                "run": partial(self.run_simplify, boundary_identifier),
+            }
+
+            # Depends on boundaries, as well as overlaps, as reloading the boundary tables drops is_coastal, even
+            # where the overlaps are unchanged
+            self.stages[f"coastal_{boundary_identifier}"] = {
+                "depends_on": ["boundaries", f"overlaps_{boundary_identifier}"],
+                "inputs": list,
+                "outputs": [f"boundary_{boundary_identifier}"],
+                "output_columns": {f"boundary_{boundary_identifier}": ["is_coastal"]},
+                "connections": 1,
+                "run": partial(self.run_coastal, boundary_identifier),
+            }
+
+            self.stages[f"cache_{boundary_identifier}"] = {
+                "depends_on": [f"overlaps_{boundary_identifier}", "climate"],
+                "inputs": list,
+                "outputs": [
+                    f"cache_{boundary_identifier}_to_rcp{rcp}_{season}"
+                    for rcp in [60, 85]
+                    for season in ["annual", "summer", "winter"]
+                ],
+                "connections": 1,
+                "run": partial(self.run_cache, boundary_identifier),
+            }
+
+    def set_climate_workers(self, workers):
+        """
+        Set the number of worker processes for the climate stage, which sets the number of connections it holds: one
+        per worker, and one for joining the variable tables. Raises a ValueError if this is more than max_connections.
+        """
+
+        if workers and 1 + workers > self.max_connections:
+            raise ValueError(
+                f"The climate stage needs {1 + workers} connections with {workers} workers, but max_connections is "
+                f"{self.max_connections}. Use at most {self.max_connections - 1} workers, or raise max_connections."
+            )
+
+        self.climate_workers = workers
+        self.stages["climate"]["connections"] = 1 + (workers or 0)
+
+    #########################################################################
+    ### Stage runners
+    #########################################################################
+
+    def get_labelled_mask(self):
+        """
+        Get the labelled mask for the climate stage. If the grid stage was skipped, load the mask artefact, or recreate
+        the mask from the NetCDF files if there is no artefact (without touching the database).
+        """
+
+        if self.labelled_mask is None and self.mask_artefact and os.path.exists(self.mask_artefact):
+            try:
+                self.labelled_mask = load_mask_artefact(self.mask_artefact)["aggregated_labelled"]
+            except ValueError as e:
+                print(e)
+
+        if self.labelled_mask is None:
+            grid_loader = GridLoader(self.conf)
+            grid_loader.open_netcdf_files()
+            grid_loader.process_masks()
+            self.labelled_mask = grid_loader.masks["aggregated_labelled"]
+
+            if self.mask_artefact:
+                grid_loader.save_mask_artefact(self.mask_artefact)
+
+        return self.labelled_mask
+
+    def run_database(self):
+        db_manager = DBManager(
+            superuser=self.conf["superuser"],
+            superuser_pass=self.conf["superuser_pass"],
+            host=self.conf["host"],
+            dbname=self.conf["dbname"],
+            user=self.conf["user"],
+            user_pass=self.conf["user_pass"],
+        )
+        db_manager.setup_database()
+
+    def run_boundaries(self):
+        # Boundaries are loaded concurrently, one connection each, within the connections available to the stage
+        boundary_loader = BoundaryLoader(self.conf)
+        boundary_loader.load_all_boundaries(workers=min(len(self.boundary_identifiers), self.max_connections))
+
+    def run_grid(self):
+        grid_loader = GridLoader(self.conf)
+        grid_loader.connect_to_db()
+        grid_loader.open_netcdf_files()
+        grid_loader.process_masks()
+
+        if self.mask_artefact:
+            grid_loader.save_mask_artefact(self.mask_artefact)
+
+        grid_loader.rebuild_table()
+        grid_loader.conn.close()
+
+        self.labelled_mask = grid_loader.masks["aggregated_labelled"]
+
+    def run_climate(self):
+        chess_loader = ChessScapeLoader(self.conf, self.get_labelled_mask())
+        chess_loader.set_layout(self.climate_layout)
+        chess_loader.set_precision(self.climate_precision)
+        chess_loader.connect_to_db()
+        chess_loader.process_all_rcps(include_uk_averages=True, workers=self.climate_workers)
+        chess_loader.conn.close()
+
+    def run_overlaps(self, boundary_identifier):
+        overlap_calculator = OverlapCalculator(self.conf)
+        overlap_calculator.connect_to_db()
+        overlap_calculator.process_boundary(boundary_identifier, process_no_overlaps=True)
+        overlap_calculator.conn.close()
+
+    def run_simplify(self, boundary_identifier):
+        boundary_simplifier = BoundarySimplifier(self.conf)
+        boundary_simplifier.connect_to_db()
+        boundary_simplifier.process_boundary(boundary_identifier)
+        boundary_simplifier.conn.close()
+
+    def run_coastal(self, boundary_identifier):
+        coastal_region_identifier = CoastalIdentifier(self.conf)
+        coastal_region_identifier.connect_to_db()
+        coastal_region_identifier.process_boundary(boundary_identifier)
+        coastal_region_identifier.conn.close()
+
+    def run_cache(self, boundary_identifier):
+        cacher = CacheClimate(self.conf)
+        cacher.precision = self.climate_precision
+        cacher.connect_to_db()
+        cacher.process_boundary(boundary_identifier)
+
+        # Record the regions the overlaps and cache were built from, for later incremental refreshes
+        update_snapshot(cacher.conn, cacher.cur, boundary_identifier)
+        cacher.conn.close()
+
+    def run_details(self):
+        generator = DetailsGenerator(self.conf)
+        generator.connect_to_db()
+        generator.process_data(self.boundary_details)
+        generator.conn.close()
+
+    #########################################################################
+    ### Manifest
+    #########################################################################
+
+    def create_table(self):
+        """
+        Create the manifest table if it does not already exist.
+        """
+
+        create_table_query = f"""
+        CREATE TABLE IF NOT EXISTS "{self.table_name}" (
+            stage VARCHAR(50) PRIMARY KEY,
+            status VARCHAR(20) NOT NULL,
+            inputs JSONB,
+            outputs JSONB,
+            input_fingerprint VARCHAR(64),
+            output_fingerprint VARCHAR(64),
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            error TEXT
+        );
+        """
+
+        self.cur.execute(create_table_query)
+        self.conn.commit()
+
+    def get_manifest_entry(self, stage_name):
+        """
+        Get the manifest entry for a stage as a dict, or None if the stage has not been run.
+        """
+
+        select_query = f"""
+        SELECT status, input_fingerprint, output_fingerprint
+        FROM "{self.table_name}"
+        WHERE stage = %s;
+        """
+
+        with self.manifest_lock:
+            self.cur.execute(select_query, (stage_name,))
+            entry = self.cur.fetchone()
+
+        if not entry:
+            return None
+
+        return {"status": entry[0], "input_fingerprint": entry[1], "output_fingerprint": entry[2]}
+
+    def record_stage(self, stage_name, status, inputs, input_fingerprint, output_fingerprint=None, error=None):
+        """
+        Insert or update the manifest entry for a stage.
+        """
+
+        now = datetime.now()
+        started_at = now if status == "running" else None
+        finished_at = now if status != "running" else None
+
+        upsert_query = f"""
+        INSERT INTO "{self.table_name}"
+            (stage, status, inputs, outputs, input_fingerprint, output_fingerprint, started_at, finished_at, error)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (stage) DO UPDATE SET
+            status = EXCLUDED.status,
+            inputs = EXCLUDED.inputs,
+            outputs = EXCLUDED.outputs,
+            input_fingerprint = EXCLUDED.input_fingerprint,
+            output_fingerprint = EXCLUDED.output_fingerprint,
+            started_at = COALESCE(EXCLUDED.started_at, "{self.table_name}".started_at),
+            finished_at = EXCLUDED.finished_at,
+            error = EXCLUDED.error;
+        """
+
+        with self.manifest_lock:
+            self.cur.execute(
+                upsert_query,
+                (
+                    stage_name,
+                    status,
+                    Json(inputs),
+                    Json(self.stages[stage_name]["outputs"]),
+                    input_fingerprint,
+                    output_fingerprint,
+                    started_at,
+                    finished_at,
+                    error,
+                ),
+            )
+            self.conn.commit()
+
+    #########################################################################
+    ### Fingerprints
+    #########################################################################
+
+    def get_stage_inputs(self, stage_name):
+        """
+        Get the inputs of a stage: its input files with size and modification time, the output fingerprints of the
+        stages it depends on, and any parameters that change its output.
+        """
+
+        stage = self.stages[stage_name]
+
+        files = {}
+        for filepath in stage["inputs"]():
+            if os.path.exists(filepath):
+                stat = os.stat(filepath)
+                files[filepath] = [stat.st_size, stat.st_mtime_ns]
+            else:
+                files[filepath] = None
+
+        upstream = {}
+        for upstream_stage in stage["depends_on"]:
+            entry = self.get_manifest_entry(upstream_stage)
+            upstream[upstream_stage] = entry["output_fingerprint"] if entry else None
+
+        parameters = {}
+        if stage_name == "database":
+            parameters = {"host": self.conf["host"], "dbname": self.conf["dbname"], "user": self.conf["user"]}
+        elif stage_name == "details":
+            parameters = {"boundary_details": self.boundary_details}
+        elif stage_name == "climate":
+            parameters = {"layout": self.climate_layout, "precision": self.climate_precision}
+        elif stage_name.startswith("cache_"):
+            parameters = {"precision": self.climate_precision}
+        elif stage_name.startswith("simplify_"):
+            parameters = {"tolerances": BoundarySimplifier(self.conf).tolerances}
+
+        return {"files": files, "upstream": upstream, "parameters": parameters}
+
+    def get_fingerprint(self, data):
+        """
+        Hash JSON serialisable data.
+        """
+
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def table_exists(self, table_name):
+        """
+        Check whether a table exists.
+        """
+
+        with self.manifest_lock:
+            self.cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (f'"{table_name}"',))
+            return self.cur.fetchone()[0]
+
+    def column_exists(self, table_name, column_name):
+        """
+        Check whether a table has a column.
+        """
+
+        column_exists_query = """
+        SELECT EXISTS (
+            SELECT 1
+            FROM information_schema.columns
+            WHERE table_name = %s
+            AND column_name = %s
+            AND table_schema = 'public'
+        );
+        """
+
+        with self.manifest_lock:
+            self.cur.execute(column_exists_query, (table_name, column_name))
+            return self.cur.fetchone()[0]
+
+    def get_table_fingerprint(self, cur, table_name):
+        """
+        Fingerprint the content of a table with its row count and the sum of its row hashes, which does not depend on
+        the physical order of the rows.
+        """
+
+        fingerprint_query = f"""
+        SELECT COUNT(*), COALESCE(SUM(hashtext(t::text)::BIGINT), 0)
+        FROM "{table_name}" t;
+        """
+
+        cur.execute(fingerprint_query)
+        row_count, row_hash_sum = cur.fetchone()
+
+        return f"{row_count}:{row_hash_sum}"
+
+    def get_output_fingerprint(self, stage_name):
+        """
+        Fingerprint all output tables of a stage. This uses a separate connection, so that scanning large tables does
+        not hold up the manifest for other running stages.
+        """
+
+        conn = psycopg2.connect(
+            host=self.conf["host"], dbname=self.conf["dbname"], user=self.conf["user"], password=self.conf["user_pass"]
+        )
+        cur = conn.cursor()
+
+        try:
+            outputs = self.stages[stage_name]["outputs"]
+            table_fingerprints = {table_name: self.get_table_fingerprint(cur, table_name) for table_name in outputs}
+
+        finally:
+            conn.close()
+
+        return self.get_fingerprint(table_fingerprints)
+
+    #########################################################################
+    ### Running
+    #########################################################################
+
+    def is_stage_current(self, stage_name, input_fingerprint):
+        """
+        Check whether a stage has completed with the same inputs, and its outputs still exist. For a stage adding
+        columns to another stage's tables, the columns must also exist, as the tables may since have been recreated
+        without them.
+        """
+
+        entry = self.get_manifest_entry(stage_name)
+
+        if not entry or entry["status"] != "complete" or entry["input_fingerprint"] != input_fingerprint:
+            return False
+
+        stage = self.stages[stage_name]
+
+        if not all(self.table_exists(table_name) for table_name in stage["outputs"]):
+            return False
+
+        return all(
+            self.column_exists(table_name, column_name)
+            for table_name, column_names in stage.get("output_columns", {}).items()
+            for column_name in column_names
+        )
+
+    def run_stage(self, stage_name, force=False):
+        """
+        Run a single stage, unless its inputs are unchanged since it last completed. Returns True if the stage ran.
+        Exceptions are recorded in the manifest and raised again.
+        """
+
+        start_time = time.time()
+
+        inputs = self.get_stage_inputs(stage_name)
+        input_fingerprint = self.get_fingerprint(inputs)
+
+        if not force and self.is_stage_current(stage_name, input_fingerprint):
+            print(f"### Stage unchanged, skipping: {stage_name}\n")
+            self.stage_timings[stage_name] = (start_time, start_time)
+            return False
+
+        print(f"### Running stage: {stage_name}\n")
+        self.record_stage(stage_name, "running", inputs, input_fingerprint)
+
+        try:
+            self.stages[stage_name]["run"]()
+
+        except Exception:
+            self.record_stage(stage_name, "failed", inputs, input_fingerprint, error=traceback.format_exc())
+            print(f"### Stage failed: {stage_name}\n")
+            raise
+
+        output_fingerprint = self.get_output_fingerprint(stage_name)
+        self.record_stage(stage_name, "complete", inputs, input_fingerprint, output_fingerprint)
+
+        self.stage_timings[stage_name] = (start_time, time.time())
+
+        print(f"### Stage complete: {stage_name} ({time.time() - start_time:.2f} seconds)\n")
+
+        return True
+
+    def get_critical_path(self, stage_names):
+        """
+        Get the critical path through the given stages: the chain of dependent stages with the largest total duration,
+        which is the lower bound on the build time however many connections are available. Returns the stage names
+        on the path and the total duration in seconds.
+        """
+
+        finish = {}
+        previous = {}
+
+        # Stages are defined in dependency order, so upstream stages are always visited first
+        for stage_name in self.stages:
+            if stage_name not in stage_names:
+                continue
+
+            start_time, end_time = self.stage_timings[stage_name]
+            upstream = [d for d in self.stages[stage_name]["depends_on"] if d in finish]
+            previous[stage_name] = max(upstream, key=finish.get) if upstream else None
+            finish[stage_name] = (end_time - start_time) + (finish[previous[stage_name]] if upstream else 0)
+
+        if not finish:
+            return [], 0
+
+        stage_name = max(finish, key=finish.get)
+        total = finish[stage_name]
+
+        path = []
+        while stage_name:
+            path.append(stage_name)
+            stage_name = previous[stage_name]
+
+        return path[::-1], total
+
+    def print_critical_path(self, stage_names, wall_time):
+        """
+        Print the duration of each stage on the critical path.
+        """
+
+        path, total = self.get_critical_path(stage_names)
+
+        print("### Critical path:")
+        for stage_name in path:
+            start_time, end_time = self.stage_timings[stage_name]
+            print(f"{stage_name}: {end_time - start_time:.2f} seconds")
+
+        print(f"Critical path total: {total:.2f} seconds (build wall time: {wall_time:.2f} seconds)\n")
+
+    def run(self, force_stages=None):
+        """
+        Run all stages, skipping stages whose inputs are unchanged. Stages named in force_stages are always run. The
+        details stage is skipped if no boundary details were provided.
+
+        Stages whose dependencies are complete are started as long as the connections they need are available. A
+        ValueError is raised before any stage is run if a stage needs more connections than max_connections. If a
+        stage fails, the stages that depend on it are not run, but independent stages carry on. Once all stages have
+        finished, the critical path is printed, and a RuntimeError is raised if any stage failed.
+        """
+
+        if not force_stages:
+            force_stages = []
+
+        for stage_name, stage in self.stages.items():
+            if stage["connections"] > self.max_connections:
+                raise ValueError(
+                    f"Stage {stage_name} needs {stage['connections']} connections, but max_connections is "
+                    f"{self.max_connections}."
+                )
+
+        # The manifest is stored in the database, so the database must be set up before any stage can be checked
+        try:
+            self.connect_to_db()
+        except psycopg2.OperationalError:
+            print("Database not found, setting up database...")
+            self.run_database()
+            self.connect_to_db()
+
+        self.create_table()
+
+        print("############################")
+        print("### Running database build...\n")
+
+        pending = list(self.stages)
+        if not self.boundary_details:
+            print("### No boundary details provided, skipping: details\n")
+            pending.remove("details")
+
+        complete = []
+        failed = []
+        blocked = []
+        running = {}
+        available_connections = self.max_connections
+
+        self.stage_timings = {}
+        build_start_time = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            while pending or running:
+                for stage_name in list(pending):
+                    depends_on = self.stages[stage_name]["depends_on"]
+                    connections = self.stages[stage_name]["connections"]
+
+                    if any(d in failed or d in blocked for d in depends_on):
+                        print(f"### Upstream stage failed, not running: {stage_name}\n")
+                        pending.remove(stage_name)
+                        blocked.append(stage_name)
+
+                    elif all(d in complete for d in depends_on) and connections <= available_connections:
+                        pending.remove(stage_name)
+                        available_connections -= connections
+                        future = executor.submit(self.run_stage, stage_name, stage_name in force_stages)
+                        running[future] = stage_name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    stage_name = running.pop(future)
+                    available_connections += self.stages[stage_name]["connections"]
+
+                    if future.exception():
+                        failed.append(stage_name)
+                    else:
+                        complete.append(stage_name)
+
+        self.conn.close()
+
+        self.print_critical_path(complete, time.time() - build_start_time)
+
+        if failed:
+            raise RuntimeError(f"Build stages failed: {', '.join(failed)}. Not run: {', '.join(blocked) or 'none'}.")
+
+        print("### Database build complete.")
+        print("############################\n")
@@ -1,4 +1,54 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+from src.climate_layout import (
+    CLIMATE_PRECISIONS,
+    CLIMATE_VARIABLES,
+    get_array_element,
+    get_climate_table_name,
+    get_storage_precision,
+    get_wide_column_names,
+)
+from src.table_swap import get_shadow_table_name, swap_tables
+
+
+def cache_in_worker(
+    connection_pool, config, boundary_identifier, rcp=None, season=None, area_weighted=True, precision=None
+):
+    """
+    Cache the climate data of a boundary for a single rcp and season, or for all of them with a single grouped query if
+    no rcp and season are given (see CacheClimate.cache_all_grouped). A connection is taken from the pool for the
+    duration of the work, so this can be run in a worker thread. Returns the start and end time of the work.
+    """
+
+    start_time = time.time()
+
+    conn = connection_pool.getconn()
+
+    try:
+        cacher = CacheClimate(config)
+        cacher.conn = conn
+        cacher.cur = conn.cursor()
+        cacher.area_weighted = area_weighted
+        cacher.precision = get_storage_precision(config, precision)
+        cacher.set_boundary(boundary_identifier)
+
+        if rcp is None:
+            cacher.cache_all_grouped()
+        else:
+            cacher.process_rcp_and_season(rcp, season)
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        connection_pool.putconn(conn)
+
+    return start_time, time.time()
 
 
 class CacheClimate:
@@ -6,6 +56,18 @@ class CacheClimate:
     Class to cache the climate data, based on region gid, its overlapping cells, and the relevant CHESS-SCAPE data.
     Note that not all regions use the cache method (and the cache tables) in the app. See the docs for more information
     about the cell method and the cache method.
+
+    There is one cache table per boundary, rcp and season. These can be created concurrently by passing a number of
+    workers to process_all_boundaries, in which case each (boundary, rcp, season) is cached by a worker thread with a
+    connection from a pool. Alternatively (or as well), all cache tables of a boundary can be created from a single
+    grouped scan of its overlap table, with grouped=True.
+
+    Cache tables are built under a shadow name (see src/table_swap.py), and swapped in to replace the live table once
+    complete, so the app can read the cache while it is rebuilt. When only some regions of a boundary have changed,
+    refresh_boundary updates the live cache tables for these regions only.
+
+    Climate tables can be in either layout (see ChessScapeLoader.set_layout): the layout of each rcp and season is
+    found from the tables in the database. Cache tables have the same (wide) columns for both layouts.
     """
 
     def __init__(self, config):
@@ -16,7 +78,29 @@ class CacheClimate:
         self.boundary_identifier = None
         self.overlap_table = None
         self.climate_table = None
+        self.climate_layout = None
         self.cache_table = None
+        self.shadow_cache_table = None
+
+        # Weight mean values by the fraction of each cell inside the region (the overlap_fraction column)
+        self.area_weighted = True
+
+        # Storage precision of the cached values, "double" or "single" (see src/climate_layout.py)
+        self.precision = get_storage_precision(self.conf)
+
+        self.rcps_and_seasons = [(rcp, season) for rcp in [60, 85] for season in ["annual", "summer", "winter"]]
+
+        # Largest boundaries first, so that they are started first when caching in parallel
+        self.boundary_identifiers = [
+            "lsoa",
+            "parishes",
+            "sc_dz",
+            "msoa",
+            "ni_dz",
+            "la_districts",
+            "uk_counties",
+            "iom",
+        ]
 
     def connect_to_db(self, host=None, dbname=None, user=None, password=None):
         """
@@ -58,22 +142,34 @@ class CacheClimate:
         self.overlap_table = f"grid_overlaps_{boundary_identifier}"
 
         self.climate_table = None
+        self.climate_layout = None
         self.cache_table = None
+        self.shadow_cache_table = None
 
     def set_rcp_and_season(self, rcp, season):
         """
         Set rcp and season to determine the climate and cache tables to be used, i.e. rcp{60} or rcp{85}, or
-        "annual", "summer" or "winter".
+        "annual", "summer" or "winter". The cache table is built under its shadow name. The array layout climate table
+        is used if it exists, otherwise the wide layout table.
         """
 
-        self.climate_table = f"chess_scape_rcp{rcp}_{season}"
+        array_table = get_climate_table_name(rcp, season, "array")
+        self.cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (f'"{array_table}"',))
+
+        self.climate_layout = "array" if self.cur.fetchone()[0] else "wide"
+        self.climate_table = get_climate_table_name(rcp, season, self.climate_layout)
         self.cache_table = f"cache_{self.boundary_identifier}_to_rcp{rcp}_{season}"
+        self.shadow_cache_table = get_shadow_table_name(self.cache_table)
 
     def get_climate_column_names(self):
         """
-        Select the column names from the loaded climate table.
+        Select the column names from the loaded climate table. For the array layout, these are the equivalent wide
+        layout column names for all variables.
         """
 
+        if self.climate_layout == "array":
+            return get_wide_column_names()
+
         select_column_name_query = f"""
         SELECT column_name
         FROM information_schema.columns
@@ -90,14 +186,16 @@ class CacheClimate:
 
     def create_table(self):
         """
-        Given the loaded variables, gets the column names, filters then, and creates a new table.
+        Given the loaded variables, gets the column names, filters then, and creates a new (shadow) table, with columns
+        in the storage precision.
         """
 
         column_names = self.get_climate_column_names()
-        columns_definition = ",\n    ".join([f'"{col}" DOUBLE PRECISION' for col in column_names])
+        column_type = CLIMATE_PRECISIONS[self.precision][1]
+        columns_definition = ",\n    ".join([f'"{col}" {column_type}' for col in column_names])
 
         create_table_query = f"""
-        CREATE TABLE "{self.cache_table}" (
+        CREATE TABLE "{self.shadow_cache_table}" (
             gid INT PRIMARY KEY,
             {columns_definition}
         )
@@ -110,76 +208,333 @@ class CacheClimate:
         except Exception as e:
             print(f"Error creating CHESS-SCAPE table: {e}")
 
+    def get_aggregate(self, column_name, table_alias=None):
+        """
+        Get the aggregate of a climate column over a region's cells: the min of the min cells, mean of the mean cells,
+        max of the max cells. If area weighted, the mean is weighted by the overlap fraction (falling back to the plain
+        mean if all cells only touch the region). The column can be qualified with the alias of its climate table.
+
+        Weighted sums are taken in double precision, as the database accumulates sums of REAL values in single
+        precision.
+
+        In the array layout, the column is an element of the arrays (qualified with the alias, ct by default), and each
+        aggregate is filtered to the rows of the column's variable.
+        """
+
+        if self.climate_layout == "array":
+            column, variable_condition = get_array_element(column_name, table_alias or "ct")
+            variable_filter = f" FILTER (WHERE {variable_condition})"
+        else:
+            column = f'{table_alias}."{column_name}"' if table_alias else f'"{column_name}"'
+            variable_filter = ""
+
+        if column_name.endswith("_min"):
+            return f"MIN({column}){variable_filter}"
+
+        if column_name.endswith("_mean"):
+            if not self.area_weighted:
+                return f"AVG({column}){variable_filter}"
+
+            weighted_mean = (
+                f"SUM(ot.overlap_fraction * {column}::DOUBLE PRECISION){variable_filter} "
+                f"/ NULLIF(SUM(ot.overlap_fraction::DOUBLE PRECISION){variable_filter}, 0)"
+            )
+            return f"COALESCE({weighted_mean}, AVG({column}){variable_filter})"
+
+        return f"MAX({column}){variable_filter}"
+
+    def get_climate_join(self, table_alias, variable_alias=None):
+        """
+        Get the JOIN clause of the climate table on the cells of the overlap table (aliased ot). In the array layout,
+        only the rows of the cached variables are joined (so the primary key on (variable, grid_cell_id) can be used),
+        or the rows matching the variable of another array layout table, if its alias is given. This keeps one row per
+        cell and variable when several array layout tables are joined.
+        """
+
+        join_condition = f"{table_alias}.grid_cell_id = ot.grid_cell_id"
+
+        if self.climate_layout == "array":
+            if variable_alias:
+                join_condition += f" AND {table_alias}.variable = {variable_alias}.variable"
+            else:
+                variables = ", ".join(f"'{variable}'" for variable in CLIMATE_VARIABLES)
+                join_condition += f" AND {table_alias}.variable IN ({variables})"
+
+        return f'JOIN "{self.climate_table}" {table_alias} ON {join_condition}'
+
     def cache_all_gids(self):
         """
-        Select all gids in the loaded boundary and cache their climate data.
+        Select all gids in the loaded boundary and cache their climate data, in the shadow cache table.
         """
 
         # Get all column names in climate table
         column_names = self.get_climate_column_names()
 
-        # Take the min of the min cells, mean of the mean cells, max of the max cells
-        select_clause = ", ".join(
-            [
-                f'MIN("{col}") AS "{col}"'
-                if col.endswith("_min")
-                else f'AVG("{col}") AS "{col}"'
-                if col.endswith("_mean")
-                else f'MAX("{col}") AS "{col}"'
-                for col in column_names
-            ]
-        )
+        select_clause = ", ".join([f'{self.get_aggregate(col)} AS "{col}"' for col in column_names])
 
         insert_clause = ", ".join([f'"{col}"' for col in column_names])
 
         cache_all_query = f"""
+        INSERT INTO "{self.shadow_cache_table}" (gid, {insert_clause})
+        SELECT ot.gid, {select_clause}
+        FROM "{self.overlap_table}" ot
+        {self.get_climate_join("ct")}
+        GROUP BY ot.gid
+        """
+
+        self.cur.execute(cache_all_query)
+        self.conn.commit()
+
+    def cache_table_exists(self):
+        """
+        Check whether the live cache table for the current rcp and season exists.
+        """
+
+        self.cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (f'"{self.cache_table}"',))
+
+        return self.cur.fetchone()[0]
+
+    def replace_gids(self, gids, removed_gids=None):
+        """
+        Recache the climate data of the given gids in the live cache table, and remove the rows of any removed gids, in
+        a single transaction. The rows of all of these gids are deleted first, then the given gids are cached again, so
+        a region that no longer overlaps any cells has no row, as after a full rebuild.
+        """
+
+        column_names = self.get_climate_column_names()
+
+        select_clause = ", ".join([f'{self.get_aggregate(col)} AS "{col}"' for col in column_names])
+        insert_clause = ", ".join([f'"{col}"' for col in column_names])
+
+        delete_query = f"""
+        DELETE FROM "{self.cache_table}"
+        WHERE gid = ANY(%s)
+        """
+
+        insert_query = f"""
         INSERT INTO "{self.cache_table}" (gid, {insert_clause})
         SELECT ot.gid, {select_clause}
         FROM "{self.overlap_table}" ot
-        JOIN "{self.climate_table}" ct ON ot.grid_cell_id = ct.grid_cell_id
+        {self.get_climate_join("ct")}
+        WHERE ot.gid = ANY(%s)
         GROUP BY ot.gid
         """
 
+        affected_gids = [int(gid) for gid in list(gids) + list(removed_gids or [])]
+
+        try:
+            if affected_gids:
+                self.cur.execute(delete_query, (affected_gids,))
+
+            if gids:
+                self.cur.execute(insert_query, ([int(gid) for gid in gids],))
+
+            self.conn.commit()
+
+        except psycopg2.Error as e:
+            print(f"Error updating {self.cache_table}: {e}")
+            self.conn.rollback()
+            raise
+
+    def cache_all_grouped(self):
+        """
+        Create and fill the cache tables of the loaded boundary for every rcp and season with a single query. The
+        overlap table is scanned once, joined to all climate tables and grouped by gid once, and the results are then
+        inserted into each cache table from data-modifying CTEs. All climate tables hold the same grid cells (those in
+        the labelled mask), so the inner joins keep the same cells as the per-table queries in cache_all_gids. Array
+        layout tables are joined on the variable of the first array layout table, so there is one row per cell and
+        variable rather than one per combination of variables.
+
+        The cache tables are built under their shadow names, and all swapped in together once filled.
+        """
+
+        select_clauses = []
+        join_clauses = []
+        insert_ctes = []
+        cache_tables = []
+        variable_alias = None
+
+        for k, (rcp, season) in enumerate(self.rcps_and_seasons):
+            self.set_rcp_and_season(rcp, season)
+            self.drop_table(self.shadow_cache_table)
+            self.create_table()
+
+            cache_tables.append(self.cache_table)
+
+            column_names = self.get_climate_column_names()
+
+            select_clauses += [f'{self.get_aggregate(col, f"c{k}")} AS "c{k}_{col}"' for col in column_names]
+            join_clauses.append(self.get_climate_join(f"c{k}", variable_alias))
+
+            if self.climate_layout == "array" and variable_alias is None:
+                variable_alias = f"c{k}"
+
+            insert_clause = ", ".join([f'"{col}"' for col in column_names])
+            grouped_clause = ", ".join([f'"c{k}_{col}"' for col in column_names])
+
+            insert_ctes.append(
+                f"""
+                insert_{k} AS (
+                    INSERT INTO "{self.shadow_cache_table}" (gid, {insert_clause})
+                    SELECT gid, {grouped_clause}
+                    FROM grouped
+                )"""
+            )
+
+        select_clause = ",\n            ".join(select_clauses)
+        join_clause = "\n        ".join(join_clauses)
+
+        cache_all_query = f"""
+        WITH grouped AS MATERIALIZED (
+            SELECT ot.gid,
+            {select_clause}
+            FROM "{self.overlap_table}" ot
+            {join_clause}
+            GROUP BY ot.gid
+        ),{",".join(insert_ctes)}
+        SELECT COUNT(*) FROM grouped;
+        """
+
         self.cur.execute(cache_all_query)
         self.conn.commit()
 
-    def process_boundary(self, boundary_identifier):
+        swap_tables(self.conn, self.cur, cache_tables)
+
+    def process_rcp_and_season(self, rcp, season):
         """
-        For a given boundary, process each rcp and season.
+        Create and fill the cache table of the loaded boundary for a single rcp and season under its shadow name, then
+        swap it in to replace the live cache table.
+        """
+
+        self.set_rcp_and_season(rcp, season)
+        self.drop_table(self.shadow_cache_table)
+        self.create_table()
+        self.cache_all_gids()
+
+        swap_tables(self.conn, self.cur, [self.cache_table])
+
+    def process_boundary(self, boundary_identifier, grouped=False):
+        """
+        For a given boundary, process each rcp and season. If grouped, all cache tables are filled from a single grouped
+        scan of the overlap table.
         """
 
         self.set_boundary(boundary_identifier)
 
         print(f"### Caching {boundary_identifier}...\n")
 
-        for rcp in [60, 85]:
-            for season in ["annual", "summer", "winter"]:
-                self.set_rcp_and_season(rcp, season)
-                self.drop_table(self.cache_table)
-                self.create_table()
-                self.cache_all_gids()
+        if grouped:
+            self.cache_all_grouped()
+            return
+
+        for rcp, season in self.rcps_and_seasons:
+            self.process_rcp_and_season(rcp, season)
 
-    def process_all_boundaries(self):
+    def refresh_boundary(self, boundary_identifier, changes):
         """
-        Cache climate data for all boundaries.
+        For a given boundary, update each rcp and season's cache table for the regions added, changed or removed since
+        the cache was last built (as found by src/boundary_changes.py). The overlaps of these regions must already be
+        refreshed (see OverlapCalculator.refresh_boundary). Cache tables that do not exist yet are built in full.
         """
 
-        boundary_identifiers = [
-            "uk_counties",
-            "la_districts",
-            "lsoa",
-            "msoa",
-            "parishes",
-            "sc_dz",
-            "ni_dz",
-            "iom",
-        ]
+        self.set_boundary(boundary_identifier)
+
+        print(f"### Refreshing cache {boundary_identifier}...\n")
+
+        updated_gids = changes["added"] + changes["changed"]
+
+        for rcp, season in self.rcps_and_seasons:
+            self.set_rcp_and_season(rcp, season)
+
+            if not self.cache_table_exists():
+                self.process_rcp_and_season(rcp, season)
+                continue
+
+            self.replace_gids(updated_gids, changes["removed"])
+
+    def process_all_boundaries_parallel(self, workers, grouped=False):
+        """
+        Cache climate data for all boundaries in a pool of worker threads, sharing a pool of workers database
+        connections. Each (boundary, rcp, season) is a separate task, or each boundary if grouped.
+
+        Returns the time taken for each boundary, from its first task starting to its last task finishing.
+        """
+
+        print("############################")
+        print(f"### Caching all boundaries with {workers} workers...\n")
+
+        if grouped:
+            tasks = [(boundary_identifier, None, None) for boundary_identifier in self.boundary_identifiers]
+        else:
+            tasks = [
+                (boundary_identifier, rcp, season)
+                for boundary_identifier in self.boundary_identifiers
+                for rcp, season in self.rcps_and_seasons
+            ]
+
+        boundary_timings = {b: [] for b in self.boundary_identifiers}
+
+        connection_pool = ThreadedConnectionPool(
+            1,
+            workers,
+            host=self.conf["host"],
+            dbname=self.conf["dbname"],
+            user=self.conf["user"],
+            password=self.conf["user_pass"],
+        )
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(
+                        cache_in_worker,
+                        connection_pool,
+                        self.conf,
+                        boundary_identifier,
+                        rcp,
+                        season,
+                        self.area_weighted,
+                        self.precision,
+                    ): boundary_identifier
+                    for boundary_identifier, rcp, season in tasks
+                }
+
+                for future in as_completed(futures):
+                    boundary_timings[futures[future]].append(future.result())
+
+        finally:
+            connection_pool.closeall()
+
+        boundary_times = {}
+
+        print("### Time taken per boundary:")
+        for boundary_identifier, timings in boundary_timings.items():
+            start_times, end_times = zip(*timings, strict=True)
+            boundary_times[boundary_identifier] = max(end_times) - min(start_times)
+            print(f"{boundary_identifier}: {boundary_times[boundary_identifier]:.2f} seconds")
+
+        print("\n### Caching complete for all boundaries.")
+        print("############################\n")
+
+        return boundary_times
+
+    def process_all_boundaries(self, workers=None, grouped=False):
+        """
+        Cache climate data for all boundaries. If a number of workers is given, boundaries, rcps and seasons are cached
+        concurrently (see process_all_boundaries_parallel). If grouped, each boundary's cache tables are filled from a
+        single grouped scan of its overlap table (see cache_all_grouped).
+        """
+
+        if workers:
+            return self.process_all_boundaries_parallel(workers, grouped)
 
         print("############################")
         print("### Caching all boundaries...\n")
 
-        for boundary_identifier in boundary_identifiers:
-            self.process_boundary(boundary_identifier)
+        for boundary_identifier in self.boundary_identifiers:
+            self.process_boundary(boundary_identifier, grouped)
 
         print("### Caching complete for all boundaries.")
         print("############################\n")
+
+        return None
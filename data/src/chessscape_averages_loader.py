@@ -1,4 +1,3 @@
-import io
 import os
 import time
 from functools import wraps
@@ -7,6 +6,10 @@ import numpy as np
 import psycopg2
 import xarray as xr
 
+from src.binary_copy import copy_binary
+from src.chunked_mode import check_chunked_mode, compute_lazy_data
+from src.climate_layout import CLIMATE_PRECISIONS, get_storage_precision
+
 
 def timefn(fn):
     @wraps(fn)
@@ -26,10 +29,10 @@ class ChessScapeAveragesLoader:
     and then find UK averages/mean values across all cells. We need to do this for bias and
     non-bias corrected data separately, meaning we do not need to use the labelled masks as before.
 
-    There is a lot of overlap with the ChessScapeLoader class. However, it was much easier to create a
-    separate class to create the averages table than integrate into the existing code. This adds a huge
-    inefficiency to the database build, as we are opening, reading and closing NetCDF files for all variables
-    twice, once in the original class, and once in this class. TODO: aggregate these classes.
+    There is a lot of overlap with the ChessScapeLoader class. Running process_all_data opens, reads and closes the
+    NetCDF files for all variables a second time, after ChessScapeLoader has already done so. To avoid this, run
+    ChessScapeLoader.process_all_rcps(include_uk_averages=True), which passes the decade data it has already extracted
+    for each file to insert_uk_averages. Both approaches produce the same table.
     """
 
     def __init__(self, config):
@@ -48,10 +51,17 @@ class ChessScapeAveragesLoader:
         self.is_bias_corrected = None
 
         self.table_name = "chess_scape_uk_averages"
-        self.row_id = 0
+
+        # Chunked (dask) mode settings, see set_chunked_mode
+        self.chunks = None
+        self.dask_num_workers = None
+
+        # Storage precision of the min, mean and max columns, see set_precision
+        self.precision = "double"
 
         self.transform_performed = False
         self.set_data_location()
+        self.set_precision()
 
     def set_data_location(self, filepath=None):
         """
@@ -64,6 +74,28 @@ class ChessScapeAveragesLoader:
 
         self.data_location = filepath
 
+    def set_precision(self, precision=None):
+        """
+        Set the storage precision of the min, mean and max columns, "double" (FLOAT) or "single" (REAL), or use
+        chess_scape_precision in the config file (defaulting to "double").
+        """
+
+        self.precision = get_storage_precision(self.conf, precision)
+
+    def set_chunked_mode(self, chunks=None, num_workers=None):
+        """
+        Opt in to chunked mode. NetCDF files are opened as dask arrays with the given chunks (i.e.
+        {"time": -1, "y": 100, "x": 100}), and the min, mean and max for all decades are computed together in one dask
+        graph, so each chunk is only read once. Peak memory is bounded by the chunk size multiplied by the number of
+        dask workers (threads). Requires dask to be installed (see src/chunked_mode.py), which is checked here. Pass
+        chunks=None to switch back to in-memory mode.
+        """
+
+        check_chunked_mode(chunks)
+
+        self.chunks = chunks
+        self.dask_num_workers = num_workers
+
     def connect_to_db(self, host=None, dbname=None, user=None, password=None):
         """
         Connect to database with provided credentials, or those in config file.
@@ -84,11 +116,11 @@ class ChessScapeAveragesLoader:
 
     def open_netcdf_file(self, filepath):
         """
-        Lazy load a netcdf file with xarray and return.
+        Lazy load a netcdf file with xarray and return. In chunked mode, the variables are backed by dask arrays.
         """
 
         try:
-            return xr.open_dataset(filepath, engine="netcdf4")
+            return xr.open_dataset(filepath, engine="netcdf4", chunks=self.chunks)
 
         except Exception as e:
             print(f"netcdf file open failed with error: {e}")
@@ -141,33 +173,52 @@ class ChessScapeAveragesLoader:
         else:
             print(f"Incorrect filepath: {filepath}")
 
-    def calculate_uk_averages_min_mean_max(self, data, lower_bound, higher_bound, step):
+    def select_season(self, data):
         """
-        Calculate min, mean, and max values of netcdf file in time dimension, and then in spatial dimensions (i, j).
+        Select the time points for the current season from the variable in a netcdf file, and check them once.
+
+          * Annual file time dim is 100, with 1 data point per year. All time points are selected.
+          * Seasonal file time dim is 400, with 4 data points per year. Every 4th time point is selected.
+
+        Note that seasonal data contains readings for winter, spring, summer, and autumn, starting at
+        indexes 0, 1, 2, 3 respectively.
         """
 
-        # Slice the time dimension only to perform some checks
-        time_slice = data.time[lower_bound:higher_bound:step].values
+        # Set step. Seasonal: 4 data points per year. Annual: 1 data point per year
+        step = 1 if self.season == "annual" else 4
+
+        # Set start. Annual and winter start at 0. Summer starts at 2
+        start = 2 if self.season == "summer" else 0
+
+        season_data = data[self.variable][start::step]
 
-        # Check we always take mean over 10 years
-        if len(time_slice) != 10:
-            raise ValueError("Dataset slice does not contain 10 values.")
+        # Check we always take mean, min and max over whole decades
+        if season_data.sizes["time"] % 10 != 0:
+            raise ValueError("Dataset does not contain a whole number of decades.")
 
-        # Check we always only select time points in Jan and Jul in our time slice
+        # Check we always only select time points in Jan and Jul in our seasonal time selection
         if self.season != "annual":
             month_check = 1 if self.season == "winter" else 7
 
-            if not np.all(np.array([date.month for date in time_slice]) == month_check):
-                raise ValueError("Different months identified in time slice")
+            if not np.all(season_data.time.dt.month.values == month_check):
+                raise ValueError("Different months identified in time selection")
+
+        return season_data
+
+    def calculate_uk_averages_min_mean_max(self, season_data):
+        """
+        Calculate min, mean, and max values of season selected data for every decade in time dimension, and then in
+        spatial dimensions (i, j). The time dimension is reshaped to (decade, year), so that each statistic is a single
+        reduction over the year dimension.
+        """
 
-        # Perform the same slicing operation on the data itself
-        data_slice = data[self.variable][lower_bound:higher_bound:step]
+        data_by_decade = season_data.coarsen(time=10).construct(time=("decade", "year"))
 
-        # Return dict of three scalar values
+        # Return dict of arrays of scalar values, one per decade
         return {
-            "min": data_slice.min(dim="time").min(),
-            "mean": data_slice.mean(dim="time").mean(),
-            "max": data_slice.max(dim="time").max(),
+            "min": data_by_decade.min(dim="year").min(dim=["y", "x"]),
+            "mean": data_by_decade.mean(dim="year").mean(dim=["y", "x"]),
+            "max": data_by_decade.max(dim="year").max(dim=["y", "x"]),
         }
 
     def process_decade(self, data):
@@ -176,39 +227,24 @@ class ChessScapeAveragesLoader:
         We perform this operation manually, rather than using xarray.resample.
         This means that our decades might by off by 1 year (1981 to 1991), but we can use
         the same approach for the seasonal dataset (which is more strongly binned into
-        3 month seasons). More details are as follows (with the mean given as an example)
-
-          * Annual file time dim is 100, with 1 data point per year.
-            Means are averaging every 10 years, i.e. 10 chunks of 10 points.
-            Slice for first decade would be dataset[0:10:1]
-          * Seasonal file time dim is 400, with 4 data points per year.
-            Means are averaging every season present in 10 years, i.e. every 4th value in 40 points.
-            Slice for first decade would be dataset[0:40:4]
+        3 month seasons). After selecting the season (see select_season), every 10 time points
+        are a decade, so the first decade would be season_data[0:10].
 
-        Note that seasonal data contains readings for winter, spring, summer, and autumn, starting at
-        indexes 0, 1, 2, 3 respectively.
+        All decades are reduced together, rather than slicing the data once per decade and statistic.
         """
 
-        # Set slice period and step. Seasonal: 1 decade is 40 data points. Annual: 1 decade is 10 data points
-        period = 10 if self.season == "annual" else 40
-        step = int(period / 10)
-
-        # Set range start. Annual and winter start at 0. Summer starts at 2
-        start = 2 if self.season == "summer" else 0
-
-        # Get total years from the dataset
-        stop = len(data.time)
+        season_data = self.select_season(data)
+        min_mean_max_dict = self.calculate_uk_averages_min_mean_max(season_data)
 
-        # Create all data values
+        # Key data by decade
         data_by_decade = {}
 
-        # Get lower and higher slice bounds
-        for lower_bound in range(start, stop, period):
-            higher_bound = int(lower_bound + period)
-            decade_tag = 1980 + int(lower_bound / step)
+        for decade_index in range(min_mean_max_dict["min"].sizes["decade"]):
+            decade_tag = 1980 + 10 * decade_index
 
-            # Get extracted data dict containing min, mean and max and key by decade
-            data_by_decade[decade_tag] = self.calculate_uk_averages_min_mean_max(data, lower_bound, higher_bound, step)
+            data_by_decade[decade_tag] = {
+                key: value.isel(decade=decade_index) for key, value in min_mean_max_dict.items()
+            }
 
         self.extracted_data = data_by_decade
 
@@ -249,17 +285,19 @@ class ChessScapeAveragesLoader:
         Create table if it does not already exist.
         """
 
+        column_type = CLIMATE_PRECISIONS[self.precision][1]
+
         create_table_query = f"""
         CREATE TABLE IF NOT EXISTS "{self.table_name}" (
-            row_id INTEGER PRIMARY KEY,
+            row_id SERIAL PRIMARY KEY,
             is_bias_corrected BOOLEAN,
             rcp VARCHAR(10),
             season VARCHAR(10),
             variable VARCHAR(10),
             decade INTEGER,
-            min FLOAT,
-            mean FLOAT,
-            max FLOAT
+            min {column_type},
+            mean {column_type},
+            max {column_type}
         );
         """
 
@@ -285,40 +323,32 @@ class ChessScapeAveragesLoader:
 
     def insert_data_multiple_decades(self):
         """
-        Create rows from the extracted averages data, and insert into the database with a stringIO buffer.
+        Create columns from the extracted averages data, and insert into the database with binary COPY.
         """
 
-        output = io.StringIO()
+        decades = list(self.extracted_data)
+        n_rows = len(decades)
+
+        climate_dtype = CLIMATE_PRECISIONS[self.precision][0]
+
+        # Prepare columns, with types matching the table definition. The row_id is generated by the database, so rows
+        # can be inserted from several connections at once
+        columns = [
+            np.full(n_rows, self.is_bias_corrected, dtype=bool),
+            [f"rcp{self.rcp}"] * n_rows,
+            [self.season] * n_rows,
+            [self.variable] * n_rows,
+            np.array(decades, dtype=np.int32),
+            *[
+                np.array([self.extracted_data[decade][key].values for decade in decades], dtype=climate_dtype)
+                for key in ["min", "mean", "max"]
+            ],
+        ]
+
+        column_names = ["is_bias_corrected", "rcp", "season", "variable", "decade", "min", "mean", "max"]
 
         try:
-            for decade, min_mean_max_dict in self.extracted_data.items():
-                min_val = min_mean_max_dict["min"].values
-                mean_val = min_mean_max_dict["mean"].values
-                max_val = min_mean_max_dict["max"].values
-
-                # Prepare row and convert to string format
-                row = [
-                    self.row_id,
-                    self.is_bias_corrected,
-                    f"rcp{self.rcp}",
-                    self.season,
-                    self.variable,
-                    decade,
-                    min_val,
-                    mean_val,
-                    max_val,
-                ]
-                output.write(",".join(map(str, row)) + "\n")
-
-                # Increment row_id for the next row
-                self.row_id += 1
-
-            # Move cursor to start of buffer
-            output.seek(0)
-
-            column_names = ["row_id", "is_bias_corrected", "rcp", "season", "variable", "decade", "min", "mean", "max"]
-
-            self.cur.copy_from(output, self.table_name, sep=",", columns=column_names)
+            copy_binary(self.cur, self.table_name, column_names, columns)
             self.conn.commit()
 
         except Exception as e:
@@ -327,8 +357,32 @@ class ChessScapeAveragesLoader:
             # Rollback if fail
             self.conn.rollback()
 
-        finally:
-            output.close()
+    def insert_uk_averages(self, extracted_data, is_bias_corrected, season, rcp, variable):
+        """
+        Given decade min, mean and max data for every grid cell, as extracted (and transformed) by ChessScapeLoader,
+        take the UK min, mean and max for each decade and insert into the database. This skips opening the NetCDF file.
+        """
+
+        # Set variables
+        self.season = season
+        self.rcp = rcp
+        self.variable = variable
+        self.is_bias_corrected = is_bias_corrected
+
+        # Reduce across spatial dimensions, as in calculate_uk_averages_min_mean_max
+        self.extracted_data = {
+            decade: {
+                "min": min_mean_max_dict["min"].min(),
+                "mean": min_mean_max_dict["mean"].mean(),
+                "max": min_mean_max_dict["max"].max(),
+            }
+            for decade, min_mean_max_dict in extracted_data.items()
+        }
+
+        # Data from ChessScapeLoader has already been transformed
+        self.transform_performed = True
+
+        self.insert_data_multiple_decades()
 
     def process_all_variables(self, season, rcp, is_bias_corrected):
         """
@@ -345,6 +399,10 @@ class ChessScapeAveragesLoader:
 
             self.load_netcdf(is_bias_corrected, season, rcp, variable)
             self.process_decade(self.current_netcdf_data)
+
+            # In chunked mode the extracted data is lazy: compute every decade in one pass over the file
+            if self.chunks:
+                self.extracted_data = compute_lazy_data(self.extracted_data, self.dask_num_workers)
             self.transform_data()
             self.insert_data_multiple_decades()
             self.close_netcdf_file()
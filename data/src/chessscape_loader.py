@@ -1,12 +1,26 @@
-import io
+import hashlib
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from functools import wraps
 
 import numpy as np
 import psycopg2
 import xarray as xr
 
+from src.binary_copy import copy_binary, encode_arrays
+from src.chessscape_averages_loader import ChessScapeAveragesLoader
+from src.chunked_mode import check_chunked_mode, compute_lazy_data
+from src.climate_layout import (
+    ARRAY_TABLE_SUFFIX,
+    CLIMATE_DECADES,
+    CLIMATE_LAYOUTS,
+    CLIMATE_PRECISIONS,
+    get_storage_precision,
+)
+from src.mask_artefact import load_mask_artefact
+from src.table_swap import get_shadow_table_name, swap_tables
+
 
 def timefn(fn):
     @wraps(fn)
@@ -20,12 +34,57 @@ def timefn(fn):
     return measure_time
 
 
+# Loader used by each worker process in parallel mode, with its own database connection
+_worker_loader = None
+
+
+def init_worker(
+    config,
+    mask,
+    data_location,
+    include_uk_averages,
+    chunks=None,
+    dask_num_workers=None,
+    cache_location=None,
+    layout=None,
+    precision=None,
+):
+    """
+    Initialise a worker process for parallel mode: create a loader and connect it to the database (using the
+    credentials in the config file). The UK averages table must already exist if include_uk_averages is True.
+    """
+
+    global _worker_loader
+
+    _worker_loader = ChessScapeLoader(config, mask)
+    _worker_loader.set_data_location(data_location)
+    _worker_loader.set_chunked_mode(chunks, dask_num_workers)
+    _worker_loader.set_cache_location(cache_location)
+    _worker_loader.set_layout(layout)
+    _worker_loader.set_precision(precision)
+    _worker_loader.connect_to_db()
+
+    if include_uk_averages:
+        _worker_loader.create_averages_loader(create_table=False)
+
+
+def process_variable_in_worker(season, rcp, variable):
+    """
+    Extract and load a single variable in a worker process, returning the parameters processed.
+    """
+
+    _worker_loader.process_variable(season, rcp, variable)
+
+    return season, rcp, variable
+
+
 class ChessScapeLoader:
     """
     Class to load data from CHESS-SCAPE netcdf files into database. The class determines which data (i.e. bias or
     non-bias corrected) to load from the labelled mask, which must be provided on instantiation. This mask tells this
     class that data for Northern Ireland and the Isles of Scilly is non-bias corrected, whilst data for the rest of
-    the UK is.
+    the UK is. The mask can also be given as the filepath of a mask artefact (see GridLoader.save_mask_artefact), so
+    that the grid masks do not need to be recreated first.
 
     The general process for data extraction and loading is as follows:
 
@@ -35,6 +94,21 @@ class ChessScapeLoader:
         4. Open the data with xarray and get decade mean, min and max data, performing transformations if required
         5. For each climate variable, create database table and insert data
         6. Aggregate multiple tables and clean up
+
+    Steps 3 to 5 are independent for each (rcp, season, variable), and can be run on a process pool by passing a number
+    of workers to process_all_rcps. Each worker opens its own database connection.
+
+    Optionally, UK averages (see ChessScapeAveragesLoader) can be written from the same decade data in step 5, so that
+    each NetCDF file is only opened and reduced once for the whole database build.
+
+    If a cache location is set (chess_scape_cache_location in the config file), the decade data from step 4 is stored
+    as an .npz file per (rcp, season, variable, bias key). Later runs reuse it, skipping the reduction, as long as the
+    NetCDF file's size, modification time and content hash are unchanged.
+
+    Climate tables are stored in the wide layout by default, with one column per variable, decade and statistic, in
+    double precision unless set otherwise (see set_precision). Alternatively, in the array layout (see set_layout),
+    chess_scape_rcp<rcp>_<season>_arrays tables hold one row per grid cell and variable, with an array of values
+    indexed by [decade][statistic], in the same precision (see src/climate_layout.py).
     """
 
     def __init__(self, config, mask):
@@ -50,6 +124,7 @@ class ChessScapeLoader:
 
         # currently loaded CHESS-SCAPE file and associated extracted data
         self.current_netcdf_data = {}
+        self.current_filepaths = {}
         self.extracted_data = {}
 
         # current parameters
@@ -59,7 +134,26 @@ class ChessScapeLoader:
         self.table_name = None
         self.transform_performed = False
 
+        # UK averages loader, set if UK averages are written from the same extracted data
+        self.averages_loader = None
+
+        # Chunked (dask) mode settings, see set_chunked_mode
+        self.chunks = None
+        self.dask_num_workers = None
+
+        # Location of the decade data cache, see set_cache_location
+        self.cache_location = None
+
+        # Layout of the climate tables, see set_layout
+        self.layout = "wide"
+
+        # Storage precision of the climate values, see set_precision
+        self.precision = "double"
+
         self.set_data_location()
+        self.set_cache_location()
+        self.set_layout()
+        self.set_precision()
         self.load_mask(mask)
 
     def set_data_location(self, filepath=None):
@@ -73,11 +167,71 @@ class ChessScapeLoader:
 
         self.data_location = filepath
 
+    def set_cache_location(self, filepath=None):
+        """
+        Set the location of the decade data cache folder. If no folder is given or set in the config file, caching is
+        disabled.
+        """
+
+        if not filepath and self.conf.get("chess_scape_cache_location"):
+            filepath = self.conf["chess_scape_cache_location"]
+            print("CHESS-SCAPE cache location retrieved from config file.")
+
+        if filepath:
+            os.makedirs(filepath, exist_ok=True)
+
+        self.cache_location = filepath
+
+    def set_layout(self, layout=None):
+        """
+        Set the layout of the climate tables, "wide" or "array" (see src/climate_layout.py), or use chess_scape_layout
+        in the config file (defaulting to "wide"). In the array layout, a query for one variable only reads that
+        variable's rows. Once a climate table is swapped in, the table of the other layout (if any) is dropped, so the
+        cache and the app always read the layout last loaded.
+        """
+
+        if not layout:
+            layout = self.conf.get("chess_scape_layout", "wide")
+
+        if layout not in CLIMATE_LAYOUTS:
+            raise ValueError(f"Unknown climate table layout: {layout}. Expected one of {CLIMATE_LAYOUTS}.")
+
+        self.layout = layout
+
+    def set_precision(self, precision=None):
+        """
+        Set the storage precision of the climate values, "double" (DOUBLE PRECISION columns, or arrays in the array
+        layout) or "single" (REAL columns or arrays), or use chess_scape_precision in the config file (defaulting to
+        "double"). In single precision, the float32 values read from the NetCDF files are kept as they are through to
+        the database, halving the size of the climate tables. The UK averages loader created by create_averages_loader
+        uses the same precision.
+        """
+
+        self.precision = get_storage_precision(self.conf, precision)
+
+    def set_chunked_mode(self, chunks=None, num_workers=None):
+        """
+        Opt in to chunked mode. NetCDF files are opened as dask arrays with the given chunks (i.e.
+        {"time": -1, "y": 100, "x": 100}), and the min, mean and max for all decades are computed together in one dask
+        graph, so each chunk is only read once. Peak memory is bounded by the chunk size multiplied by the number of
+        dask workers (threads). Requires dask to be installed (see src/chunked_mode.py), which is checked here. Pass
+        chunks=None to switch back to in-memory mode.
+        """
+
+        check_chunked_mode(chunks)
+
+        self.chunks = chunks
+        self.dask_num_workers = num_workers
+
     def load_mask(self, mask):
         """
         Load a given mask, and determine what data will be needed (i.e. bias corrected or non-bias corrected, or both).
+        The mask can be a labelled mask array, or the filepath of a mask artefact.
         """
 
+        if isinstance(mask, str | os.PathLike):
+            mask = load_mask_artefact(mask)["aggregated_labelled"]
+
         if 0 not in mask:
             raise ValueError("Have you loaded a boolean mask? Please load labelled mask instead.")
 
@@ -109,11 +263,11 @@ class ChessScapeLoader:
 
     def open_netcdf_file(self, filepath):
         """
-        Lazy load a netcdf file with xarray and return.
+        Lazy load a netcdf file with xarray and return. In chunked mode, the variables are backed by dask arrays.
         """
 
         try:
-            return xr.open_dataset(filepath, engine="netcdf4")
+            return xr.open_dataset(filepath, engine="netcdf4", chunks=self.chunks)
 
         except Exception as e:
             print(f"netcdf file open failed with error: {e}")
@@ -163,6 +317,7 @@ class ChessScapeLoader:
         # Load netcdf file
         if os.path.exists(filepath):
             self.current_netcdf_data[bias_corrected_key] = self.open_netcdf_file(filepath)
+            self.current_filepaths[bias_corrected_key] = filepath
 
         else:
             print(f"Incorrect filepath: {filepath}")
@@ -177,32 +332,50 @@ class ChessScapeLoader:
 
         print(f"Loaded {len(self.bias_corrected_keys)} netcdf files into xarray.")
 
-    def calculate_min_mean_max(self, data, lower_bound, higher_bound, step):
+    def select_season(self, data):
         """
-        Calculate min, mean, and max values of netcdf file in time dimension, with upper and lower bounds.
+        Select the time points for the current season from the variable in a netcdf file, and check them once.
+
+          * Annual file time dim is 100, with 1 data point per year. All time points are selected.
+          * Seasonal file time dim is 400, with 4 data points per year. Every 4th time point is selected.
+
+        Note that seasonal data contains readings for winter, spring, summer, and autumn, starting at
+        indexes 0, 1, 2, 3 respectively.
         """
 
-        # Slice the time dimension only to perform some checks
-        time_slice = data.time[lower_bound:higher_bound:step].values
+        # Set step. Seasonal: 4 data points per year. Annual: 1 data point per year
+        step = 1 if self.season == "annual" else 4
+
+        # Set start. Annual and winter start at 0. Summer starts at 2
+        start = 2 if self.season == "summer" else 0
+
+        season_data = data[self.variable][start::step]
 
-        # Check we always take mean, min and max over 10 year slice
-        if len(time_slice) != 10:
-            raise ValueError("Dataset slice does not contain 10 values.")
+        # Check we always take mean, min and max over whole decades
+        if season_data.sizes["time"] % 10 != 0:
+            raise ValueError("Dataset does not contain a whole number of decades.")
 
-        # Check we always only select time points in Jan and Jul in our seasonal time slice
+        # Check we always only select time points in Jan and Jul in our seasonal time selection
         if self.season != "annual":
             month_check = 1 if self.season == "winter" else 7
 
-            if not np.all(np.array([date.month for date in time_slice]) == month_check):
-                raise ValueError("Different months identified in time slice")
+            if not np.all(season_data.time.dt.month.values == month_check):
+                raise ValueError("Different months identified in time selection")
 
-        # Perform the same slicing operation on the data itself
-        data_slice = data[self.variable][lower_bound:higher_bound:step]
+        return season_data
+
+    def calculate_min_mean_max(self, season_data):
+        """
+        Calculate min, mean, and max values of season selected data for every decade. The time dimension is reshaped
+        to (decade, year), so that each statistic is a single reduction over the year dimension.
+        """
+
+        data_by_decade = season_data.coarsen(time=10).construct(time=("decade", "year"))
 
         return {
-            "min": data_slice.min(dim="time"),
-            "mean": data_slice.mean(dim="time"),
-            "max": data_slice.max(dim="time"),
+            "min": data_by_decade.min(dim="year"),
+            "mean": data_by_decade.mean(dim="year"),
+            "max": data_by_decade.max(dim="year"),
         }
 
     def process_decade(self, data):
@@ -211,50 +384,137 @@ class ChessScapeLoader:
         We perform this operation manually, rather than using xarray.resample.
         This means that our decades might by off by 1 year (1981 to 1991), but we can use
         the same approach for the seasonal dataset (which is more strongly binned into
-        3 month seasons). More details are as follows (with the mean given as an example)
+        3 month seasons). After selecting the season (see select_season), every 10 time points
+        are a decade, so the first decade would be season_data[0:10].
 
-          * Annual file time dim is 100, with 1 data point per year.
-            Means are averaging every 10 years, i.e. 10 chunks of 10 points.
-            Slice for first decade would be dataset[0:10:1]
-          * Seasonal file time dim is 400, with 4 data points per year.
-            Means are averaging every season present in 10 years, i.e. every 4th value in 40 points.
-            Slice for first decade would be dataset[0:40:4]
+        All decades are reduced together, rather than slicing the data once per decade and statistic.
+        """
 
-        Note that seasonal data contains readings for winter, spring, summer, and autumn, starting at
-        indexes 0, 1, 2, 3 respectively.
+        season_data = self.select_season(data)
+        min_mean_max_dict = self.calculate_min_mean_max(season_data)
+
+        # Key data by decade
+        data_by_decade = {}
+
+        for decade_index in range(min_mean_max_dict["min"].sizes["decade"]):
+            decade_tag = 1980 + 10 * decade_index
+
+            data_by_decade[decade_tag] = {
+                key: value.isel(decade=decade_index) for key, value in min_mean_max_dict.items()
+            }
+
+        return data_by_decade
+
+    def get_file_fingerprint(self, filepath):
+        """
+        Get the size, modification time and content hash (sha256) of a file.
         """
 
-        # Set slice period and step. Seasonal: 1 decade is 40 data points. Annual: 1 decade is 10 data points
-        period = 10 if self.season == "annual" else 40
-        step = int(period / 10)
+        stat = os.stat(filepath)
+        file_hash = hashlib.sha256()
 
-        # Set range start. Annual and winter start at 0. Summer starts at 2
-        start = 2 if self.season == "summer" else 0
+        with open(filepath, "rb") as file:
+            for block in iter(lambda: file.read(16 * 1024 * 1024), b""):
+                file_hash.update(block)
 
-        # Get total years from the dataset
-        stop = len(data.time)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_hash.hexdigest()}
 
-        # Create all data values
-        data_by_decade = {}
+    def get_cache_filepath(self, bias_corrected_key):
+        """
+        Get the cache filepath for the current parameters and a bias key.
+        """
 
-        # Get lower and higher slice bounds
-        for lower_bound in range(start, stop, period):
-            higher_bound = int(lower_bound + period)
-            decade_tag = 1980 + int(lower_bound / step)
+        filename = f"chess-scape_rcp{self.rcp}_{self.season}_{self.variable}_{bias_corrected_key}.npz"
 
-            # Get extracted data dict containing min, mean and max and key by decade
-            data_by_decade[decade_tag] = self.calculate_min_mean_max(data, lower_bound, higher_bound, step)
+        return os.path.join(self.cache_location, filename)
 
-        return data_by_decade
+    def load_cached_data(self, bias_corrected_key):
+        """
+        Load cached decade data for a bias key, if the cache entry matches the NetCDF file currently loaded. The size
+        and modification time are checked before the (slower) content hash. Returns the file fingerprint (if computed),
+        and the data keyed by decade (or None if there is no matching cache entry).
+        """
+
+        cache_filepath = self.get_cache_filepath(bias_corrected_key)
+        filepath = self.current_filepaths[bias_corrected_key]
+
+        if not os.path.exists(cache_filepath):
+            return None, None
+
+        with np.load(cache_filepath) as cached:
+            stat = os.stat(filepath)
+
+            if int(cached["size"]) != stat.st_size or int(cached["mtime_ns"]) != stat.st_mtime_ns:
+                return None, None
+
+            fingerprint = self.get_file_fingerprint(filepath)
+
+            if str(cached["sha256"]) != fingerprint["sha256"]:
+                return fingerprint, None
+
+            data_by_decade = {
+                int(decade): {key: xr.DataArray(cached[key][k], dims=("y", "x")) for key in ["min", "mean", "max"]}
+                for k, decade in enumerate(cached["decades"])
+            }
+
+        print(f"Loaded cached data: {cache_filepath}")
+
+        return fingerprint, data_by_decade
+
+    def save_cached_data(self, bias_corrected_key, fingerprint=None):
+        """
+        Save extracted (untransformed) decade data for a bias key to the cache, with the fingerprint of the NetCDF file
+        it was extracted from. The file is written to a temporary name first, so partial files are never read.
+        """
+
+        if not fingerprint:
+            fingerprint = self.get_file_fingerprint(self.current_filepaths[bias_corrected_key])
+
+        data_by_decade = self.extracted_data[bias_corrected_key]
+        cache_filepath = self.get_cache_filepath(bias_corrected_key)
+        temp_filepath = f"{cache_filepath}.tmp"
+
+        with open(temp_filepath, "wb") as file:
+            np.savez(
+                file,
+                decades=np.array(list(data_by_decade)),
+                **{
+                    key: np.stack([data[key].values for data in data_by_decade.values()])
+                    for key in ["min", "mean", "max"]
+                },
+                **fingerprint,
+            )
+
+        os.replace(temp_filepath, cache_filepath)
 
     def process_bias_keys(self):
         """
-        Extract data for each decade in bias and non bias corrected cases.
+        Extract data for each decade in bias and non bias corrected cases. If caching is enabled, cached data is used
+        where it matches the NetCDF file, and newly extracted data is saved to the cache.
         """
 
+        uncached_fingerprints = {}
+
         for bias_corrected_key in self.bias_corrected_keys:
+            if self.cache_location:
+                fingerprint, cached_data = self.load_cached_data(bias_corrected_key)
+
+                if cached_data is not None:
+                    self.extracted_data[bias_corrected_key] = cached_data
+                    continue
+
+                uncached_fingerprints[bias_corrected_key] = fingerprint
+
             self.extracted_data[bias_corrected_key] = self.process_decade(self.current_netcdf_data[bias_corrected_key])
 
+        # In chunked mode the extracted data is lazy: compute every decade and bias key in one pass over the files
+        if self.chunks:
+            self.extracted_data = compute_lazy_data(self.extracted_data, self.dask_num_workers)
+
+        # Cache newly extracted data before any transforms are applied
+        for bias_corrected_key, fingerprint in uncached_fingerprints.items():
+            self.save_cached_data(bias_corrected_key, fingerprint)
+
     def transform_dataset(self, data):
         """
         Perform any transformations necessary on a dataset.
@@ -327,12 +587,54 @@ class ChessScapeLoader:
         Given a list of columns, add these to the database if they do not already exist.
         """
 
+        column_type = CLIMATE_PRECISIONS[self.precision][1]
+
         for column_name in column_names:
-            alter_table_query = f'ALTER TABLE "{self.table_name}" ADD COLUMN IF NOT EXISTS "{column_name}" FLOAT'
+            alter_table_query = (
+                f'ALTER TABLE "{self.table_name}" ADD COLUMN IF NOT EXISTS "{column_name}" {column_type}'
+            )
             self.cur.execute(alter_table_query)
 
         self.conn.commit()
 
+    def stack_extracted_data(self, bias_corrected_key):
+        """
+        Stack the extracted data for a bias key into a single array of shape (decades * 3, y, x). The first axis
+        follows the column order used in the database, i.e. decade by decade, with min, mean and max for each.
+        """
+
+        return np.stack(
+            [
+                self.extracted_data[bias_corrected_key][decade_key][key].values
+                for decade_key in self.extracted_data[bias_corrected_key]
+                for key in ["min", "mean", "max"]
+            ]
+        )
+
+    def create_climate_data_matrix(self):
+        """
+        Using the labelled mask, create the grid cell IDs and a (n_cells, decades * 3) matrix of climate data, to be
+        inserted into the database. Cells labelled 1 take bias corrected data, cells labelled 2 take non-bias corrected
+        data, and cells labelled 0 are skipped. Cells are ordered as they are in the mask (row by row), and grid cell
+        IDs are calculated as i * x_size + j, matching the grid table.
+        """
+
+        stacked_data = {key: self.stack_extracted_data(key) for key in self.bias_corrected_keys}
+
+        # Select bias corrected data where the mask is 1, otherwise fall back to non-bias corrected data
+        if len(stacked_data) == 2:
+            combined_data = np.where(self.mask == 1, stacked_data["bias_corrected"], stacked_data["non_bias_corrected"])
+
+        else:
+            combined_data = stacked_data[self.bias_corrected_keys[0]]
+
+        # Flat indices of all labelled cells are equal to the grid cell IDs
+        grid_cell_ids = np.flatnonzero(self.mask)
+
+        climate_data = combined_data.reshape(combined_data.shape[0], -1)[:, grid_cell_ids].T
+
+        return grid_cell_ids, climate_data
+
     def insert_data_multiple_decades(self):
         """
         Bulk insert multiple columns of data (i.e. all decades for a variable). Note that this loads bias corrected
@@ -353,59 +655,119 @@ class ChessScapeLoader:
 
         self.add_multiple_columns(new_column_names)
 
-        # Create string buffer
-        output = io.StringIO()
+        grid_cell_ids, climate_data = self.create_climate_data_matrix()
 
-        # Loop through mask cells. If 0, skip. If 1, choose bias corrected data. If 2, choose non bias corrected data
-        for i, j in np.ndindex(self.mask.shape):
-            # If mask cell has value of 0, skip
-            if self.mask[i, j] == 0:
-                continue
+        # Columns must match the database types: INTEGER for grid cell IDs, and FLOAT or REAL for climate data
+        climate_dtype = CLIMATE_PRECISIONS[self.precision][0]
+        columns = [grid_cell_ids.astype(np.int32), *climate_data.astype(climate_dtype, copy=False).T]
 
-            # If mask cell is 1, get bias corrected data
-            if self.mask[i, j] == 1:
-                bias_corrected_key = "bias_corrected"
+        column_names = ["grid_cell_id"] + new_column_names
+        copy_binary(self.cur, self.table_name, column_names, columns)
 
-            # If mask cell is 2, get non-bias corrected data
-            elif self.mask[i, j] == 2:
-                bias_corrected_key = "non_bias_corrected"
+        self.conn.commit()
 
-            # Get correct climate data row with key
-            climate_data = [
-                self.extracted_data[bias_corrected_key][decade_key][key].values[i, j]
-                for decade_key in self.extracted_data[bias_corrected_key]
-                for key in ["min", "mean", "max"]
-            ]
+    def create_array_table(self):
+        """
+        Create the array layout table for the current variable: one row per grid cell, with the variable name and an
+        array of values indexed by [decade][statistic], in the storage precision.
+        """
 
-            # Get grid cell ID
-            grid_cell_id = i * self.mask.shape[1] + j
+        column_type = CLIMATE_PRECISIONS[self.precision][1]
 
-            # Store data row in buffer
-            row = [grid_cell_id] + climate_data
-            output.write(",".join(map(str, row)) + "\n")
+        create_table_query = f"""
+        CREATE TABLE IF NOT EXISTS "{self.table_name}" (
+            grid_cell_id INTEGER,
+            variable VARCHAR,
+            decade_stats {column_type}[]
+        );
+        """
 
-        # Move cursor to start
-        output.seek(0)
+        try:
+            self.cur.execute(create_table_query)
+            self.conn.commit()
 
-        column_names = ["grid_cell_id"] + new_column_names
-        self.cur.copy_from(output, self.table_name, sep=",", columns=column_names)
+        except Exception as e:
+            print(f"Error creating CHESS-SCAPE table: {e}")
+
+    def insert_data_arrays(self):
+        """
+        Bulk insert the data for the current variable in the array layout. Each cell's climate data is reshaped to
+        (decades, 3), with the min, mean and max of each decade, and sent as a two dimensional array in the storage
+        precision.
+        """
+
+        # Get a bias key
+        bias_key = self.bias_corrected_keys[0]
+
+        if list(self.extracted_data[bias_key]) != CLIMATE_DECADES:
+            raise ValueError(f"Decades incorrect: expected {CLIMATE_DECADES}")
+
+        grid_cell_ids, climate_data = self.create_climate_data_matrix()
+
+        # Every variable name has the same length, so it is sent as fixed length bytes
+        variables = np.full(len(grid_cell_ids), self.variable.encode("utf-8"))
+        climate_dtype = CLIMATE_PRECISIONS[self.precision][0]
+        decade_stats = climate_data.astype(climate_dtype, copy=False).reshape(
+            len(grid_cell_ids), len(CLIMATE_DECADES), 3
+        )
+
+        columns = [grid_cell_ids.astype(np.int32), variables, encode_arrays(decade_stats)]
+
+        copy_binary(self.cur, self.table_name, ["grid_cell_id", "variable", "decade_stats"], columns)
 
         self.conn.commit()
-        output.close()
+
+    def create_averages_loader(self, create_table=True):
+        """
+        Create a ChessScapeAveragesLoader that shares this class's database connection, and optionally (re)create the
+        UK averages table. UK averages are then written for each variable from the extracted data, rather than from a
+        second pass over the NetCDF files. Note that averages are only written for the bias keys present in the mask.
+        """
+
+        self.averages_loader = ChessScapeAveragesLoader(self.conf)
+        self.averages_loader.set_data_location(self.data_location)
+        self.averages_loader.set_precision(self.precision)
+        self.averages_loader.conn = self.conn
+        self.averages_loader.cur = self.cur
+
+        if create_table:
+            self.averages_loader.drop_table()
+            self.averages_loader.create_table()
+
+    def insert_uk_averages(self):
+        """
+        Insert UK averages for the current variable, for each bias key, from the extracted (and transformed) data.
+        """
+
+        for bias_corrected_key in self.bias_corrected_keys:
+            self.averages_loader.insert_uk_averages(
+                self.extracted_data[bias_corrected_key],
+                bias_corrected_key == "bias_corrected",
+                self.season,
+                self.rcp,
+                self.variable,
+            )
 
     def join_tables(self, variables):
         """
-        Given multiple tables for variables, create a single table with a JOIN, and clean up afterwards.
+        Given multiple tables for variables, create a single table with a JOIN, and clean up afterwards. The joined
+        table is created under a shadow name with a primary key, then swapped in to replace the live table. In the
+        array layout, tables are combined with join_array_tables instead.
         """
 
-        self.drop_table(self.aggregated_table_name)
+        if self.layout == "array":
+            self.join_array_tables(variables)
+            return
+
+        shadow_table_name = get_shadow_table_name(self.aggregated_table_name)
+        self.drop_table(shadow_table_name)
 
         base_table = f"{self.aggregated_table_name}_{variables[0]}"
         table_name_joins = [f'JOIN "{self.aggregated_table_name}_{var}" USING (grid_cell_id)' for var in variables[1:]]
         joins_string = " ".join(table_name_joins)
 
         join_table_query = f"""
-        CREATE TABLE IF NOT EXISTS "{self.aggregated_table_name}" AS
+        CREATE TABLE "{shadow_table_name}" AS
         SELECT *
         FROM {base_table}
         {joins_string}
@@ -413,17 +775,85 @@ class ChessScapeLoader:
         """
 
         self.cur.execute(join_table_query)
+        self.cur.execute(f'ALTER TABLE "{shadow_table_name}" ADD PRIMARY KEY (grid_cell_id);')
         self.conn.commit()
 
-        # Drop temporary variable tables
+        swap_tables(self.conn, self.cur, [self.aggregated_table_name])
+
+        # Drop temporary variable tables, and the table of the other layout
         for temp_table in [f"{self.aggregated_table_name}_{var}" for var in variables]:
             self.drop_table(temp_table)
 
-    def process_all_variables(self, season, rcp):
+        self.drop_table(f"{self.aggregated_table_name}{ARRAY_TABLE_SUFFIX}")
+
+    def join_array_tables(self, variables):
+        """
+        Given the array layout tables for multiple variables, create a single array layout table with a UNION, and
+        clean up afterwards. Rows are ordered by variable, so that the rows read by a query for one variable are stored
+        together, and the primary key is (variable, grid_cell_id). As with join_tables, the table is created under a
+        shadow name and swapped in to replace the live table.
+        """
+
+        array_table_name = f"{self.aggregated_table_name}{ARRAY_TABLE_SUFFIX}"
+        shadow_table_name = get_shadow_table_name(array_table_name)
+        self.drop_table(shadow_table_name)
+
+        union_string = "\n        UNION ALL\n        ".join(
+            f'SELECT * FROM "{self.aggregated_table_name}_{var}"' for var in variables
+        )
+
+        union_table_query = f"""
+        CREATE TABLE "{shadow_table_name}" AS
+        SELECT *
+        FROM (
+        {union_string}
+        ) u
+        ORDER BY variable, grid_cell_id;
+        """
+
+        self.cur.execute(union_table_query)
+        self.cur.execute(f'ALTER TABLE "{shadow_table_name}" ADD PRIMARY KEY (variable, grid_cell_id);')
+        self.conn.commit()
+
+        swap_tables(self.conn, self.cur, [array_table_name])
+
+        # Drop temporary variable tables, and the table of the other layout
+        for temp_table in [f"{self.aggregated_table_name}_{var}" for var in variables]:
+            self.drop_table(temp_table)
+
+        self.drop_table(self.aggregated_table_name)
+
+    def process_variable(self, season, rcp, variable):
         """
         Create a table of data for a single variable, containing an ID column and 10 decade averaged columns.
         """
 
+        print(f"### Processing variable: {variable}")
+
+        self.load_all_netcdf(season, rcp, variable)
+        self.process_bias_keys()
+        self.transform_all_means()
+        self.drop_table()
+
+        if self.layout == "array":
+            self.create_array_table()
+            self.insert_data_arrays()
+        else:
+            self.create_table()
+            self.insert_data_multiple_decades()
+
+        if self.averages_loader:
+            self.insert_uk_averages()
+
+        self.close_netcdf_files()
+
+        print(f"### Processing complete: {variable}\n")
+
+    def process_all_variables(self, season, rcp):
+        """
+        Create a table of data for each variable, and join these into a single table for the season and rcp.
+        """
+
         variables = ["pr", "rsds", "sfcWind", "tas", "tasmax", "tasmin"]
 
         print("############################")
@@ -431,17 +861,7 @@ class ChessScapeLoader:
         print(f"### Processing all variables for dataset: {season}, rcp{rcp}.\n")
 
         for variable in variables:
-            print(f"### Processing variable: {variable}")
-
-            self.load_all_netcdf(season, rcp, variable)
-            self.process_bias_keys()
-            self.transform_all_means()
-            self.drop_table()
-            self.create_table()
-            self.insert_data_multiple_decades()
-            self.close_netcdf_files()
-
-            print(f"### Processing complete: {variable}\n")
+            self.process_variable(season, rcp, variable)
 
         self.join_tables(variables)
 
@@ -458,13 +878,78 @@ class ChessScapeLoader:
         for season in seasons:
             self.process_all_variables(season, rcp)
 
+    def process_all_parallel(self, workers, include_uk_averages=False):
+        """
+        Process all variables, for all seasons and RCPs, on a pool of worker processes. Each worker has its own database
+        connection, and extracts and loads one variable at a time. Once all variables for a season and rcp have been
+        loaded, the variable tables are joined using this class's connection.
+
+        Note that each worker holds a pair of NetCDF files and their decade data in memory, so peak memory grows with
+        the number of workers.
+        """
+
+        rcps = [60, 85]
+        seasons = ["annual", "winter", "summer"]
+        variables = ["pr", "rsds", "sfcWind", "tas", "tasmax", "tasmin"]
+
+        print("############################")
+        print(f"### Data to be processed: {self.bias_corrected_keys}")
+        print(f"### Processing all datasets with {workers} workers.\n")
+
+        # Count the variables left to process for each season and rcp
+        remaining_variables = {(season, rcp): len(variables) for rcp in rcps for season in seasons}
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(
+                self.conf,
+                self.mask,
+                self.data_location,
+                include_uk_averages,
+                self.chunks,
+                self.dask_num_workers,
+                self.cache_location,
+                self.layout,
+                self.precision,
+            ),
+        ) as executor:
+            futures = [
+                executor.submit(process_variable_in_worker, season, rcp, variable)
+                for rcp in rcps
+                for season in seasons
+                for variable in variables
+            ]
+
+            for future in as_completed(futures):
+                season, rcp, _ = future.result()
+                remaining_variables[(season, rcp)] -= 1
+
+                if remaining_variables[(season, rcp)] == 0:
+                    self.aggregated_table_name = f"chess_scape_rcp{rcp}_{season}"
+                    self.join_tables(variables)
+
+                    print(f"### Processing complete for dataset: {season}, rcp{rcp}.\n")
+
+        print("### Processing complete for all datasets.")
+        print("############################\n")
+
     @timefn
-    def process_all_rcps(self):
+    def process_all_rcps(self, include_uk_averages=False, workers=None):
         """
-        Process all seasons and variables for all RCPs.
+        Process all seasons and variables for all RCPs. If include_uk_averages is True, the UK averages table is also
+        built in the same pass, replacing ChessScapeAveragesLoader.process_all_data. If a number of workers greater
+        than 1 is given, variables are processed in parallel (see process_all_parallel).
         """
 
         rcps = [60, 85]
 
+        if include_uk_averages:
+            self.create_averages_loader()
+
+        if workers and workers > 1:
+            self.process_all_parallel(workers, include_uk_averages)
+            return
+
         for rcp in rcps:
             self.process_all_seasons(rcp)
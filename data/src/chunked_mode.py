@@ -0,0 +1,36 @@
+def import_dask():
+    """
+    Import dask, which is an optional dependency (pip install dask, or poetry install --extras chunked). Raises an
+    ImportError explaining how to install it, or disable chunked mode, if it is missing.
+    """
+
+    try:
+        import dask
+
+    except ImportError as e:
+        raise ImportError("Chunked mode requires dask. Please install dask, or disable chunked mode.") from e
+
+    return dask
+
+
+def check_chunked_mode(chunks):
+    """
+    Check that chunked mode can be used for the given chunks, i.e. that dask is installed if chunks are given. This is
+    checked when chunked mode is set, as xarray raises its own (less helpful) error when opening a file with chunks.
+    """
+
+    if chunks:
+        import_dask()
+
+
+def compute_lazy_data(data, num_workers=None):
+    """
+    Compute a (nested) dict of lazy dask-backed xarray objects in a single graph, with the given number of dask workers
+    (threads), returning the same structure with numpy-backed values.
+    """
+
+    dask = import_dask()
+
+    (computed_data,) = dask.compute(data, num_workers=num_workers)
+
+    return computed_data
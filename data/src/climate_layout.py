@@ -0,0 +1,86 @@
+import re
+
+import numpy as np
+
+# Layouts of the CHESS-SCAPE climate tables (see ChessScapeLoader.set_layout):
+#   - wide: one row per grid cell, with one column per variable, decade and statistic (i.e. tas_2020_mean)
+#   - array: one row per grid cell and variable, with an array of values indexed by [decade][statistic]
+CLIMATE_LAYOUTS = ["wide", "array"]
+
+# Suffix of the climate table names for the array layout, i.e. chess_scape_rcp60_annual_arrays
+ARRAY_TABLE_SUFFIX = "_arrays"
+
+# Decades and statistics along the dimensions of the arrays, in order. Array indices start from 1
+CLIMATE_DECADES = list(range(1980, 2080, 10))
+CLIMATE_STATS = ["min", "mean", "max"]
+
+CLIMATE_VARIABLES = ["pr", "rsds", "sfcWind", "tas", "tasmax", "tasmin"]
+
+# Storage precisions of climate values, with the numpy dtype sent with binary COPY and the database column type. Single
+# precision keeps the float32 values of the CHESS-SCAPE NetCDF files as they are
+CLIMATE_PRECISIONS = {
+    "double": (np.dtype(np.float64), "DOUBLE PRECISION"),
+    "single": (np.dtype(np.float32), "REAL"),
+}
+
+
+def get_climate_table_name(rcp, season, layout="wide"):
+    """
+    Get the name of the climate table for an rcp and season, in the given layout.
+    """
+
+    table_name = f"chess_scape_rcp{rcp}_{season}"
+
+    if layout == "array":
+        return f"{table_name}{ARRAY_TABLE_SUFFIX}"
+
+    return table_name
+
+
+def get_storage_precision(config, precision=None):
+    """
+    Get the storage precision of climate values, "double" or "single" (see CLIMATE_PRECISIONS), or use
+    chess_scape_precision in the config file (defaulting to "double"). Raises a ValueError for an unknown precision.
+    """
+
+    if not precision:
+        precision = config.get("chess_scape_precision", "double")
+
+    if precision not in CLIMATE_PRECISIONS:
+        raise ValueError(f"Unknown storage precision: {precision}. Expected one of {list(CLIMATE_PRECISIONS)}.")
+
+    return precision
+
+
+def get_wide_column_names(variables=None):
+    """
+    Get the wide layout climate column names (<variable>_<decade>_<statistic>) for the given variables, or all
+    variables. Cache tables use these column names, whatever the layout of the climate tables.
+    """
+
+    return [
+        f"{variable}_{decade}_{stat}"
+        for variable in variables or CLIMATE_VARIABLES
+        for decade in CLIMATE_DECADES
+        for stat in CLIMATE_STATS
+    ]
+
+
+def get_array_element(column_name, table_alias):
+    """
+    Get the array layout equivalent of a wide layout climate column, as the SQL expression of the array element and
+    the condition selecting the variable's rows, i.e. tas_2020_mean becomes ('c.decade_stats[5][2]', "c.variable =
+    'tas'"). Raises a ValueError for an unknown column name.
+    """
+
+    match = re.fullmatch(r"(\w+)_(\d{4})_(min|mean|max)", column_name)
+
+    if not match or match.group(1) not in CLIMATE_VARIABLES or int(match.group(2)) not in CLIMATE_DECADES:
+        raise ValueError(f"Unknown climate column: {column_name}")
+
+    variable, decade, stat = match.groups()
+
+    decade_index = CLIMATE_DECADES.index(int(decade)) + 1
+    stat_index = CLIMATE_STATS.index(stat) + 1
+
+    return f"{table_alias}.decade_stats[{decade_index}][{stat_index}]", f"{table_alias}.variable = '{variable}'"
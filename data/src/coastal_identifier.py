@@ -5,15 +5,16 @@ class CoastalIdentifier:
     """
     Previously, when loading CHESS-SCAPE grid cells to the database using the GridLoader class, we tagged cells if they
     were coastline, land, or in 5*10km inland coastal bands. This was recorded in the chess_scape_grid postgres table,
-    in the coastal_info column. We can identify whether a region is coastal based on this data.
+    in the coastal_info column. The distance from each cell to the coast is also recorded, in the coast_distance_km
+    column. We can identify whether a region is coastal based on this data.
 
-    Based on the type of overlapping grid cells, determine if a region is coastal or not. We write this to a boolean
-    column in the boundary table called is_coastal.
+    Based on the distance to the coast of the overlapping grid cells, determine if a region is coastal or not. We write
+    this to a boolean column in the boundary table called is_coastal.
 
     Rules:
         - Define regions as coastal if they contain overlapping cells that are 20km or less to the coast. This can be
-          updated as required.
-        - If the region contains any of self.coastal_values, the region is deemed coastal.
+          updated as required, by setting self.coastal_threshold_km: the grid does not need to be rebuilt.
+        - Coastline cells have a distance of 0, so regions containing coastline are always coastal.
     """
 
     def __init__(self, config):
@@ -21,10 +22,21 @@ class CoastalIdentifier:
         self.conn = None
         self.cur = None
 
-        # Set the default distances for coastal identification
-        self.coastal_values = ["20km from coast", "10km from coast", "coastline"]
+        # Set the default distance for coastal identification
+        self.coastal_threshold_km = 20
         self.coastal_column_name = "is_coastal"
 
+        self.boundary_identifiers = [
+            "uk_counties",
+            "la_districts",
+            "lsoa",
+            "msoa",
+            "parishes",
+            "sc_dz",
+            "ni_dz",
+            "iom",
+        ]
+
     def connect_to_db(self, host=None, dbname=None, user=None, password=None):
         """
         Connect to database with provided credentials, or those in config file.
@@ -76,9 +88,6 @@ class CoastalIdentifier:
                 self.conn.commit()
 
             else:
-                # Make coastal values a tuple
-                coastal_values = tuple(self.coastal_values)
-
                 # Update all regions in a single query
                 update_query = f"""
                     UPDATE boundary_{boundary_identifier} b
@@ -86,10 +95,10 @@ class CoastalIdentifier:
                         SELECT 1
                         FROM grid_overlaps_{boundary_identifier} o
                         JOIN chess_scape_grid g ON o.grid_cell_id = g.grid_cell_id
-                        WHERE o.gid = b.gid AND g.coastal_info IN %s
+                        WHERE o.gid = b.gid AND g.coast_distance_km <= %s
                     );
                 """
-                self.cur.execute(update_query, (coastal_values,))
+                self.cur.execute(update_query, (self.coastal_threshold_km,))
                 self.conn.commit()
 
             print(f"Boundary {boundary_identifier} processed successfully.")
@@ -98,27 +107,80 @@ class CoastalIdentifier:
             print(f"Database error processing {boundary_identifier}: {e}")
             self.conn.rollback()
 
-    def process_all_boundaries(self):
+    def create_coastal_regions_table(self):
         """
-        Tag all regions in all boundaries as coastal or not coastal.
+        Find the coastal regions of all boundaries in a single pass: the coastal cells are selected once (using the
+        index on coast_distance_km), then joined to every overlap table (using their grid_cell_id indexes) in a single
+        UNION ALL query. The (boundary_identifier, gid) pairs are stored in a temporary table, for the current
+        transaction only.
         """
 
-        boundary_identifiers = [
-            "uk_counties",
-            "la_districts",
-            "lsoa",
-            "msoa",
-            "parishes",
-            "sc_dz",
-            "ni_dz",
-            "iom",
-        ]
+        select_coastal_regions_query = "\nUNION ALL\n".join(
+            f"""
+            SELECT DISTINCT '{boundary_identifier}' AS boundary_identifier, o.gid
+            FROM grid_overlaps_{boundary_identifier} o
+            JOIN coastal_cells c ON o.grid_cell_id = c.grid_cell_id
+            """
+            for boundary_identifier in self.boundary_identifiers
+            if boundary_identifier != "ni_dz"
+        )
+
+        create_table_query = f"""
+        CREATE TEMP TABLE coastal_regions ON COMMIT DROP AS
+        WITH coastal_cells AS MATERIALIZED (
+            SELECT grid_cell_id
+            FROM chess_scape_grid
+            WHERE coast_distance_km <= %s
+        )
+        {select_coastal_regions_query};
+        """
+
+        self.cur.execute(create_table_query, (self.coastal_threshold_km,))
+        self.cur.execute("CREATE INDEX ON coastal_regions (boundary_identifier, gid);")
+
+    def process_all_boundaries(self):
+        """
+        Tag all regions in all boundaries as coastal or not coastal, in a single transaction. Coastal regions are found
+        for all boundaries in a single pass (see create_coastal_regions_table), then each boundary table is updated.
+        """
 
         print("############################")
-        print("### Tagging regions as coastal in all boundaries...\n")
+        print(f"### Tagging regions as coastal ({self.coastal_threshold_km}km) in all boundaries...\n")
+
+        for boundary_identifier in self.boundary_identifiers:
+            self.add_column(boundary_identifier, self.coastal_column_name)
 
-        for boundary_identifier in boundary_identifiers:
-            self.process_boundary(boundary_identifier)
+        try:
+            self.create_coastal_regions_table()
+
+            for boundary_identifier in self.boundary_identifiers:
+                # For Northern Ireland, all regions are deemed coastal (see process_boundary)
+                if boundary_identifier == "ni_dz":
+                    update_query = f"""
+                        UPDATE boundary_{boundary_identifier}
+                        SET is_coastal = TRUE;
+                    """
+                    self.cur.execute(update_query)
+
+                else:
+                    update_query = f"""
+                        UPDATE boundary_{boundary_identifier} b
+                        SET is_coastal = EXISTS (
+                            SELECT 1
+                            FROM coastal_regions c
+                            WHERE c.boundary_identifier = %s AND c.gid = b.gid
+                        );
+                    """
+                    self.cur.execute(update_query, (boundary_identifier,))
+
+                print(f"Boundary {boundary_identifier} processed successfully.")
+
+            self.conn.commit()
+
+        except psycopg2.Error as e:
+            print(f"Database error tagging coastal regions: {e}")
+            self.conn.rollback()
+            raise
 
-        print("### Coastal tagging complete for all regions in all boundaries.")
+        print("\n### Coastal tagging complete for all regions in all boundaries.")
         print("############################\n")
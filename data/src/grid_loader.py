@@ -1,17 +1,22 @@
-import io
 import os
 
 import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 import numpy as np
 import psycopg2
+import shapely
 import xarray as xr
 from cartopy.mpl.gridliner import LATITUDE_FORMATTER, LONGITUDE_FORMATTER
 from matplotlib.path import Path
-from scipy.ndimage import binary_erosion, binary_fill_holes, convolve, label
+from scipy.ndimage import binary_fill_holes, convolve, distance_transform_edt, label
 from scipy.ndimage import sum as ndi_sum
+from shapely import wkb
 from shapely.geometry import Polygon
 
+from src.binary_copy import copy_binary
+from src.mask_artefact import load_mask_artefact, save_mask_artefact
+from src.table_swap import get_shadow_table_name, swap_tables
+
 
 class GridLoader:
     """
@@ -31,6 +36,11 @@ class GridLoader:
         - geometry: geometry (postgis geometry type, 1km by 1km square)
         - bias_corrected: boolean, whether the cell has bias-corrected data for it or not
         - coastal_info: charvar, string to identify coastline, land, or 5*10km inwards bands
+        - coast_distance_km: real, distance from the cell centre to the coast in km (0 for coastline cells)
+
+    Creating the masks requires both NetCDF files, and is fairly slow. Once created, the masks and grid edges can be
+    saved as a .npz artefact (see save_mask_artefact), which can be reloaded here with load_masks, or passed directly to
+    ChessScapeLoader in place of the labelled mask.
     """
 
     def __init__(self, config):
@@ -42,6 +52,9 @@ class GridLoader:
         self.masks = {}
         self.table_name = "chess_scape_grid"
 
+        # Grid cell edges, if loaded from a mask artefact rather than calculated from the netcdf data
+        self.grid_edges = None
+
         self.set_data_location()
 
     def set_data_location(self, filepath=None):
@@ -278,24 +291,28 @@ class GridLoader:
 
         self.masks["coastline"] = coastline_mask
 
-    def create_inland_mask(self, land_mask, filled_land_mask, radius):
+    def create_coast_distance_mask(self, filled_land_mask):
         """
-        Using a circular structuring element, create an inland mask from the edge of a given mask pair, using erosion.
+        Calculate the distance (in km) from each cell centre to the nearest cell outside the filled land mask (i.e.
+        sea), with a single Euclidean distance transform. Cells beyond the edge of the grid are counted as sea. Sea
+        cells have a distance of 0.
         """
 
-        y, x = np.ogrid[-radius : radius + 1, -radius : radius + 1]
-        circular_structure = (x**2 + y**2) <= radius**2
+        # Pad with a border of sea, so that distances are also measured to the edge of the grid
+        padded_land_mask = np.pad(filled_land_mask, 1, constant_values=False)
+        coast_distance = distance_transform_edt(padded_land_mask)[1:-1, 1:-1]
 
-        # Apply erosion to shrink the land mask inward by n cells
-        eroded_land_mask = binary_erosion(filled_land_mask, structure=circular_structure)
+        # Convert from cells to km
+        x_edges, _ = self.get_grid_edges()
+        cell_size_km = abs(np.diff(x_edges)[0]) / 1000
 
-        # Extract the n-cell inland boundary by subtracting the eroded mask from the original land mask
-        return land_mask & ~eroded_land_mask
+        return coast_distance * cell_size_km
 
-    def create_coastal_mask_with_inland_regions(self):
+    def create_coastal_mask_with_inland_regions(self, bands=None):
         """
-        Create a coastline mask with inland regions a specified distance away from the coast tagged.
-        The following classifications are used:
+        Create a coastline mask with inland regions a specified distance away from the coast tagged. Bands are taken
+        from the distance to the coast (see create_coast_distance_mask), which is also stored in
+        self.masks["coast_distance_km"]. By default, the following classifications are used:
 
          - 0 = Ocean (or inland water body, not present in final database)
          - 1 = Coastline
@@ -305,29 +322,29 @@ class GridLoader:
          - 30 = Land (30km from the coast)
          - 40 = Land (40km from the coast)
          - 50 = Land (50km from the coast)
+
+        Other band widths can be given as a list of integer distances in km, i.e. [5, 15, 25]. A cell is in a band if it
+        is within the band's distance from the coast, and not in a narrower band.
         """
 
+        if not bands:
+            bands = [10, 20, 30, 40, 50]
+
+        if any(band in [0, 1, 2] for band in bands):
+            raise ValueError("Band distances of 0, 1 or 2 km clash with the ocean, coastline and land classifications.")
+
         # Store the map for use later on
         self.coastal_map = {
             0: "ocean",
             1: "coastline",
             2: "land",
-            10: "10km from coast",
-            20: "20km from coast",
-            30: "30km from coast",
-            40: "40km from coast",
-            50: "50km from coast",
         }
+        self.coastal_map.update({band: f"{band}km from coast" for band in sorted(bands)})
 
         land_mask = self.masks["aggregated_labelled"].astype(bool)
         filled_land_mask = binary_fill_holes(land_mask)
 
-        # Create a number of 10km bands
-        inward_10_mask = self.create_inland_mask(land_mask, filled_land_mask, 10)
-        inward_20_mask = self.create_inland_mask(land_mask, filled_land_mask, 20)
-        inward_30_mask = self.create_inland_mask(land_mask, filled_land_mask, 30)
-        inward_40_mask = self.create_inland_mask(land_mask, filled_land_mask, 40)
-        inward_50_mask = self.create_inland_mask(land_mask, filled_land_mask, 50)
+        coast_distance = self.create_coast_distance_mask(filled_land_mask)
 
         # Initialize the final mask with 0 (ocean)
         final_mask = np.zeros_like(land_mask, dtype=int)
@@ -335,12 +352,9 @@ class GridLoader:
         # Set land cells to 2 (excluding coast and inward bands)
         final_mask[land_mask] = 2
 
-        # Assign land masks from inside to outside
-        final_mask[inward_50_mask] = 50
-        final_mask[inward_40_mask] = 40
-        final_mask[inward_30_mask] = 30
-        final_mask[inward_20_mask] = 20
-        final_mask[inward_10_mask] = 10
+        # Assign bands from inside to outside. A small tolerance is used, as distances are calculated in floating point
+        for band in sorted(bands, reverse=True):
+            final_mask[land_mask & (coast_distance <= band + 1e-6)] = band
 
         # Finally assign coastline cells
         coastline_mask = self.masks["coastline"]
@@ -348,6 +362,9 @@ class GridLoader:
 
         self.masks["final_coastal_mask"] = final_mask
 
+        # Store the distance to the coast for land cells, with coastline cells on the coast
+        self.masks["coast_distance_km"] = np.where(land_mask & ~coastline_mask, coast_distance, 0)
+
     def plot_mask(self, mask, key):
         """
         Plot mask with matplotlib. Note EPSG 27700 is used.
@@ -399,7 +416,8 @@ class GridLoader:
             grid_cell_id INTEGER PRIMARY KEY,
             geometry GEOMETRY(POLYGON, 27700) NOT NULL,
             bias_corrected BOOLEAN NOT NULL,
-            coastal_info VARCHAR(20)
+            coastal_info VARCHAR(20),
+            coast_distance_km REAL
         );
         """
 
@@ -410,16 +428,16 @@ class GridLoader:
         except Exception as e:
             print(f"Error creating CHESS-SCAPE grid table: {e}")
 
-    def create_grid_data_rows(self):
+    def get_grid_edges(self):
         """
-        Using the aggregated, labelled mask and any netcdf data (bias or non-bias corrected), create the
-        rows of data to be inserted into the table. The netcdf data is used to calculate the grid edges.
-        The mask is used to check whether the cells should be stored in the database: if a cell has data
-        associated with it, we store it in the database. Polygons are initially created as WKT representations.
-
-        Note that similar logic is used in ChessScapeLoader to loop through the mask, and select climate data
-        to load into the database.
+        Calculate the x and y edges of the grid cells from the cell centres in the netcdf data (bias corrected, as both
+        datasets share a grid). Cell (i, j) spans x_edges[j] to x_edges[j + 1] and y_edges[i] to y_edges[i + 1]. If
+        the masks were loaded from an artefact, the edges stored in it are returned instead.
         """
+
+        if self.grid_edges is not None:
+            return self.grid_edges
+
         x = self.data["bias_corrected"]["x"].values
         y = self.data["bias_corrected"]["y"].values
 
@@ -430,6 +448,20 @@ class GridLoader:
         x_edges = np.concatenate([x - dx / 2, [x[-1] + dx / 2]])
         y_edges = np.concatenate([y - dy / 2, [y[-1] + dy / 2]])
 
+        return x_edges, y_edges
+
+    def create_grid_data_rows(self):
+        """
+        Using the aggregated, labelled mask and any netcdf data (bias or non-bias corrected), create the
+        rows of data to be inserted into the table. The netcdf data is used to calculate the grid edges.
+        The mask is used to check whether the cells should be stored in the database: if a cell has data
+        associated with it, we store it in the database. Polygons are created as EWKB, ready for binary COPY.
+
+        Note that similar logic is used in ChessScapeLoader to loop through the mask, and select climate data
+        to load into the database. insert_data uses the vectorised version, create_grid_data_columns.
+        """
+        x_edges, y_edges = self.get_grid_edges()
+
         # Prepare data rows for insertion
         rows = []
 
@@ -449,8 +481,8 @@ class GridLoader:
             coastal_mask_value = coastal_mask[i, j]
             coastal_label = self.coastal_map[coastal_mask_value]
 
-            # If mask cell is 1 label as bias corrected ("TRUE"), if 2 label as non-bias corrected ("FALSE")
-            tag = "TRUE" if mask[i, j] == 1 else "FALSE"
+            # If mask cell is 1 label as bias corrected (True), if 2 label as non-bias corrected (False)
+            tag = bool(mask[i, j] == 1)
 
             # Create polygon and prepare the row
             poly = Polygon(
@@ -463,34 +495,92 @@ class GridLoader:
             )
 
             grid_cell_id = i * mask.shape[1] + j
-            rows.append((grid_cell_id, poly.wkt, tag, coastal_label))
+            rows.append((grid_cell_id, wkb.dumps(poly, srid=27700), tag, coastal_label))
 
         return rows
 
-    def insert_data(self):
+    def create_grid_data_columns(self):
         """
-        Bulk insert data into database with StringIO buffer and copy_from.
+        Vectorised version of create_grid_data_rows, returning columns of data (with types matching the table
+        definition) rather than rows. All cell boxes are created with a single call to shapely.box over the edge
+        arrays, and converted to EWKB in bulk. As every box has the same EWKB length, geometries are returned as a
+        fixed length bytes array, so they are encoded into the binary COPY buffer without a Python loop.
         """
 
-        print("############################")
-        print("### Calculating grid cell locations and inserting...\n")
+        x_edges, y_edges = self.get_grid_edges()
 
-        rows = self.create_grid_data_rows()
+        mask = self.masks["aggregated_labelled"]
+        coastal_mask = self.masks["final_coastal_mask"]
+        coast_distance = self.masks["coast_distance_km"]
+
+        if mask.shape != coastal_mask.shape:
+            raise ValueError(f"Shape mismatch: mask shape {mask.shape} != coastal_mask shape {coastal_mask.shape}")
+
+        # Cells with data, in the same (row major) order as create_grid_data_rows
+        i, j = np.nonzero(mask)
 
-        # Prepare the StringIO buffer
-        output = io.StringIO()
+        boxes = shapely.box(x_edges[j], y_edges[i], x_edges[j + 1], y_edges[i + 1])
+        geometries = shapely.to_wkb(shapely.set_srid(boxes, 27700), include_srid=True)
+        geometry_length = len(geometries[0])
 
-        for row in rows:
-            output.write(f"{row[0]}\t{row[1]}\t{row[2]}\t{row[3]}\n")
+        if any(len(geometry) != geometry_length for geometry in geometries):
+            raise ValueError("Grid cell geometries must all have the same EWKB length.")
 
-        # Move cursor to start of buffer
-        output.seek(0)
+        coastal_labels = np.array([self.coastal_map[value] for value in np.unique(coastal_mask)], dtype=object)
+        coastal_label_indices = np.searchsorted(np.unique(coastal_mask), coastal_mask[i, j])
 
-        column_names = ["grid_cell_id", "geometry", "bias_corrected", "coastal_info"]
-        self.cur.copy_from(output, self.table_name, sep="\t", columns=column_names)
+        return [
+            (i * mask.shape[1] + j).astype(np.int32),
+            geometries.astype(f"S{geometry_length}"),
+            mask[i, j] == 1,
+            coastal_labels[coastal_label_indices],
+            coast_distance[i, j].astype(np.float32),
+        ]
+
+    def create_coast_distance_index(self):
+        """
+        Create an index on the coast_distance_km column, so that coastal cells can be selected by distance threshold
+        (see CoastalIdentifier).
+        """
+
+        create_index_query = f"""
+        CREATE INDEX IF NOT EXISTS "{self.table_name}_coast_distance_km_idx"
+        ON "{self.table_name}" (coast_distance_km);
+        """
+
+        self.cur.execute(create_index_query)
+        self.conn.commit()
+
+    def create_spatial_index(self):
+        """
+        Create a spatial index on the geometry column (named as in OverlapCalculator.ensure_spatial_index).
+        """
+
+        create_index_query = f"""
+        CREATE INDEX IF NOT EXISTS "{self.table_name}_geometry_idx"
+        ON "{self.table_name}" USING GIST (geometry);
+        """
+
+        self.cur.execute(create_index_query)
+        self.conn.commit()
+
+    def insert_data(self):
+        """
+        Bulk insert data into database with binary COPY.
+        """
+
+        print("############################")
+        print("### Calculating grid cell locations and inserting...\n")
+
+        columns = self.create_grid_data_columns()
+
+        column_names = ["grid_cell_id", "geometry", "bias_corrected", "coastal_info", "coast_distance_km"]
+        copy_binary(self.cur, self.table_name, column_names, columns)
 
         self.conn.commit()
-        output.close()
+
+        self.create_coast_distance_index()
+        self.create_spatial_index()
 
         print("### Grid cell insertion complete.")
         print("############################\n")
@@ -515,12 +605,49 @@ class GridLoader:
         if plot_labelled_mask:
             self.plot_mask(self.masks["aggregated_labelled"], "aggregated & labelled")
 
+    def save_mask_artefact(self, filepath):
+        """
+        Save the processed masks and grid edges as a versioned .npz artefact (see src/mask_artefact.py).
+        """
+
+        x_edges, y_edges = self.get_grid_edges()
+        save_mask_artefact(filepath, self.masks, x_edges, y_edges, self.coastal_map)
+
+    def load_masks(self, filepath):
+        """
+        Load processed masks and grid edges from an artefact saved by save_mask_artefact, in place of opening the netcdf
+        files and running process_masks.
+        """
+
+        artefact = load_mask_artefact(filepath)
+
+        self.grid_edges = artefact.pop("x_edges"), artefact.pop("y_edges")
+        self.coastal_map = artefact.pop("coastal_map")
+        self.masks.update(artefact)
+
+    def rebuild_table(self):
+        """
+        Create and fill the grid table under a shadow name (see src/table_swap.py), then swap it in to replace the live
+        table, so the grid table can be rebuilt while the app is running. Masks must already be processed.
+        """
+
+        table_name = self.table_name
+        self.table_name = get_shadow_table_name(table_name)
+
+        try:
+            self.drop_table()
+            self.create_table()
+            self.insert_data()
+
+        finally:
+            self.table_name = table_name
+
+        swap_tables(self.conn, self.cur, [self.table_name])
+
     def process_grid(self):
         """
         Run mask creation and database insert process.
         """
 
         self.process_masks(plot_labelled_mask=True)
-        self.drop_table()
-        self.create_table()
-        self.insert_data()
+        self.rebuild_table()
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+
+# Increment when the contents or meaning of the artefact change, so that old artefacts are rebuilt rather than misread
+MASK_ARTEFACT_VERSION = 1
+
+MASK_ARTEFACT_KEYS = ["aggregated_labelled", "final_coastal_mask", "coast_distance_km"]
+
+
+def save_mask_artefact(filepath, masks, x_edges, y_edges, coastal_map):
+    """
+    Save the grid masks created by GridLoader.process_masks, the grid cell edges and the labels of the values in the
+    final coastal mask, as a versioned .npz artefact. The file is written to a temporary name first, so partial files
+    are never read.
+    """
+
+    directory = os.path.dirname(filepath)
+
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    temp_filepath = f"{filepath}.tmp"
+
+    with open(temp_filepath, "wb") as file:
+        np.savez_compressed(
+            file,
+            version=MASK_ARTEFACT_VERSION,
+            x_edges=x_edges,
+            y_edges=y_edges,
+            coastal_map_values=np.array(list(coastal_map)),
+            coastal_map_labels=np.array(list(coastal_map.values())),
+            **{key: masks[key] for key in MASK_ARTEFACT_KEYS},
+        )
+
+    os.replace(temp_filepath, filepath)
+
+    print(f"Mask artefact saved: {filepath}")
+
+
+def load_mask_artefact(filepath):
+    """
+    Load a mask artefact saved by save_mask_artefact. Returns a dictionary of the masks (keyed as in GridLoader.masks),
+    with the grid cell edges under x_edges and y_edges, and the coastal mask labels under coastal_map. Raises a
+    ValueError if the artefact was saved by a different version.
+    """
+
+    with np.load(filepath) as artefact:
+        version = int(artefact["version"]) if "version" in artefact else None
+
+        if version != MASK_ARTEFACT_VERSION:
+            raise ValueError(
+                f"Mask artefact {filepath} has version {version}, expected {MASK_ARTEFACT_VERSION}. "
+                "Please recreate it with GridLoader.save_mask_artefact."
+            )
+
+        data = {key: artefact[key] for key in [*MASK_ARTEFACT_KEYS, "x_edges", "y_edges"]}
+        data["coastal_map"] = dict(
+            zip(artefact["coastal_map_values"].tolist(), artefact["coastal_map_labels"].tolist(), strict=True)
+        )
+
+    print(f"Mask artefact loaded: {filepath}")
+
+    return data
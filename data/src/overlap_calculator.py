@@ -1,9 +1,16 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import matplotlib.pyplot as plt
+import numpy as np
 import psycopg2
 from matplotlib.ticker import ScalarFormatter
-from shapely import wkb
+from shapely import from_wkb, wkb
 from shapely.geometry import MultiPolygon, Polygon
 
+from src.binary_copy import copy_binary
+from src.raster_overlaps import get_overlapping_cells
+
 
 def plot_geometry(geometry, ax=None, **kwargs):
     """
@@ -29,6 +36,37 @@ def plot_geometry(geometry, ax=None, **kwargs):
     return ax
 
 
+def process_partition_in_worker(
+    config, boundary_identifier, gid_range=None, process_no_overlaps=False, raster_grid=None
+):
+    """
+    Insert the overlaps for a range of region gids, or process the regions with no overlaps, for a boundary whose
+    overlap table has already been created. A new OverlapCalculator (with its own database connection) is used, so this
+    can be run in a worker thread. If a raster grid is given (see OverlapCalculator.set_raster_grid), overlaps are
+    found with the raster engine. Returns the start and end time of the work.
+    """
+
+    start_time = time.time()
+
+    overlap_calculator = OverlapCalculator(config)
+    overlap_calculator.connect_to_db()
+    overlap_calculator.set_boundary_table(boundary_identifier)
+
+    if raster_grid:
+        overlap_calculator.set_raster_grid(**raster_grid)
+
+    try:
+        if process_no_overlaps:
+            overlap_calculator.process_no_overlap_regions()
+        else:
+            overlap_calculator.insert_overlaps(gid_range)
+
+    finally:
+        overlap_calculator.conn.close()
+
+    return start_time, time.time()
+
+
 class OverlapCalculator:
     """
     Class to determine grid cell overlaps between boundary/shapefile regions, and grid cells.
@@ -47,6 +85,31 @@ class OverlapCalculator:
         self.no_overlap_regions = {}
         self.no_overlap_closest_cells = {}
 
+        self.boundary_identifiers = [
+            "uk_counties",
+            "la_districts",
+            "lsoa",
+            "msoa",
+            "parishes",
+            "sc_dz",
+            "ni_dz",
+            "iom",
+        ]
+
+        # Number of gid range partitions for large boundaries in parallel mode. Other boundaries use one partition
+        self.boundary_partitions = {"lsoa": 4, "parishes": 4, "msoa": 2, "sc_dz": 2}
+
+        # Mask and cell edges of the CHESS-SCAPE grid, used by the raster overlap engine (see set_raster_grid)
+        self.raster_grid = None
+
+    def set_raster_grid(self, mask, x_edges, y_edges):
+        """
+        Use the raster overlap engine, rather than a PostGIS join, to find overlaps. The engine needs the aggregated,
+        labelled mask used to create the grid table, and the grid cell edges (see GridLoader.get_grid_edges).
+        """
+
+        self.raster_grid = {"mask": mask, "x_edges": x_edges, "y_edges": y_edges}
+
     def set_boundary_table(self, boundary_identifier):
         """
         Given a boundary identifier, set the boundary_table_name.
@@ -107,13 +170,37 @@ class OverlapCalculator:
             gid INTEGER,
             grid_cell_id INTEGER,
             is_overlap BOOLEAN,
-            bias_corrected BOOLEAN
+            bias_corrected BOOLEAN,
+            overlap_fraction REAL
         );
         """
 
         self.cur.execute(create_table_query)
         self.conn.commit()
 
+    def create_overlap_indexes(self):
+        """
+        Add a primary key on (gid, grid_cell_id) to the overlap table, and an index on grid_cell_id. The primary key
+        includes the overlap fraction, so the cells and overlap fractions for a set of regions (i.e. for area-weighted
+        means) can be read from the index alone. Indexes are built once the overlaps have been bulk inserted, which is
+        much quicker than updating them row by row.
+        """
+
+        add_primary_key_query = f"""
+        ALTER TABLE "{self.new_table_name}"
+        ADD PRIMARY KEY (gid, grid_cell_id) INCLUDE (overlap_fraction);
+        """
+
+        create_index_query = f"""
+        CREATE INDEX IF NOT EXISTS "{self.new_table_name}_grid_cell_id_idx"
+        ON "{self.new_table_name}" (grid_cell_id);
+        """
+
+        self.cur.execute(add_primary_key_query)
+        self.cur.execute(create_index_query)
+        self.cur.execute(f'ANALYZE "{self.new_table_name}";')
+        self.conn.commit()
+
     def ensure_spatial_index(self, table_name, column_name):
         """
         Ensure a spatial index exists on the specified geometry column, so that ST_Envelope runs a bit quicker.
@@ -129,25 +216,150 @@ class OverlapCalculator:
     ### Regular overlap processing code
     #########################################################################
 
-    def insert_overlaps_optimised(self):
+    def get_gid_filter(self, column, gid_range=None, gids=None):
+        """
+        Get the SQL conditions and query parameters to select regions in a (min, max) gid range, and/or in a list of
+        gids, from a gid column.
+        """
+
+        conditions = []
+        parameters = []
+
+        if gid_range:
+            conditions.append(f"{column} BETWEEN %s AND %s")
+            parameters += list(gid_range)
+
+        if gids is not None:
+            conditions.append(f"{column} = ANY(%s)")
+            parameters.append([int(gid) for gid in gids])
+
+        return conditions, parameters
+
+    def insert_overlaps_optimised(self, gid_range=None, gids=None):
         """
         Given a table of regions, find the overlapping grid cells with these regions, and insert into the new overlap table.
+        The fraction of each cell's area inside the region is stored, skipping the intersection for cells fully inside.
+        If a (min, max) gid range or a list of gids is given, only these regions are processed.
         """
 
+        conditions, parameters = self.get_gid_filter("s.gid", gid_range, gids)
+        gid_filter = " ".join(f"AND {condition}" for condition in conditions)
+
         # Find overlaps and insert directly into the new table
         insert_overlaps_query = f"""
-        INSERT INTO "{self.new_table_name}" (gid, grid_cell_id, is_overlap, bias_corrected)
-        SELECT s.gid, g.grid_cell_id, TRUE, g.bias_corrected
+        INSERT INTO "{self.new_table_name}" (gid, grid_cell_id, is_overlap, bias_corrected, overlap_fraction)
+        SELECT s.gid, g.grid_cell_id, TRUE, g.bias_corrected,
+            CASE
+                WHEN ST_CoveredBy(g.geometry, s.geom) THEN 1
+                ELSE ST_Area(ST_Intersection(g.geometry, s.geom)) / ST_Area(g.geometry)
+            END
         FROM {self.grid_table_name} g
         JOIN {self.boundary_table_name} s
         ON ST_Intersects(g.geometry, s.geom)
-        WHERE ST_Intersects(ST_Envelope(g.geometry), ST_Envelope(s.geom));
+        WHERE ST_Intersects(ST_Envelope(g.geometry), ST_Envelope(s.geom))
+        {gid_filter};
         """
 
-        self.cur.execute(insert_overlaps_query)
+        self.cur.execute(insert_overlaps_query, parameters)
         self.conn.commit()
 
-        print("Inserted all overlaps into new table.")
+        if gids is not None:
+            print(f"Inserted overlaps for {len(gids)} regions: {self.boundary_identifier}")
+        elif gid_range:
+            print(f"Inserted overlaps for gids {gid_range[0]} to {gid_range[1]}: {self.boundary_identifier}")
+        else:
+            print("Inserted all overlaps into new table.")
+
+    def get_boundary_geometries(self, gid_range=None, gids=None):
+        """
+        Select the gids and geometries (as shapely geometries) of the regions in the boundary table. If a (min, max)
+        gid range or a list of gids is given, only these regions are selected.
+        """
+
+        conditions, parameters = self.get_gid_filter("gid", gid_range, gids)
+        gid_filter = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        select_geometries_query = f"""
+        SELECT gid, ST_AsBinary(geom)
+        FROM {self.boundary_table_name}
+        {gid_filter}
+        ORDER BY gid;
+        """
+
+        self.cur.execute(select_geometries_query, parameters)
+        rows = self.cur.fetchall()
+
+        if not rows:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=object)
+
+        gids, geometries = zip(*rows, strict=True)
+
+        return np.array(gids, dtype=np.int32), from_wkb([bytes(geometry) for geometry in geometries])
+
+    def insert_overlaps_raster(self, gid_range=None, gids=None):
+        """
+        Find the overlapping grid cells for each region with the raster overlap engine (see src/raster_overlaps.py),
+        and bulk insert into the new overlap table. Gives the same overlaps as insert_overlaps_optimised, but only cells
+        on region boundaries are intersected exactly. If a (min, max) gid range or a list of gids is given, only these
+        regions are processed.
+        """
+
+        if not self.raster_grid:
+            raise ValueError("Please set the raster grid with set_raster_grid.")
+
+        gids, geometries = self.get_boundary_geometries(gid_range, gids)
+
+        overlap_gids, grid_cell_ids, overlap_fractions, bias_corrected = get_overlapping_cells(
+            gids,
+            geometries,
+            self.raster_grid["x_edges"],
+            self.raster_grid["y_edges"],
+            self.raster_grid["mask"],
+        )
+
+        columns = [
+            overlap_gids,
+            grid_cell_ids,
+            np.ones(len(overlap_gids), dtype=bool),
+            bias_corrected,
+            overlap_fractions,
+        ]
+        column_names = ["gid", "grid_cell_id", "is_overlap", "bias_corrected", "overlap_fraction"]
+        copy_binary(self.cur, self.new_table_name, column_names, columns)
+
+        self.conn.commit()
+
+        print(f"Inserted {len(overlap_gids)} overlaps for {len(gids)} regions with raster engine.")
+
+    def insert_overlaps(self, gid_range=None, gids=None):
+        """
+        Insert overlaps with the raster engine if a raster grid has been set, otherwise with a PostGIS join.
+        """
+
+        if self.raster_grid:
+            self.insert_overlaps_raster(gid_range, gids)
+        else:
+            self.insert_overlaps_optimised(gid_range, gids)
+
+    def get_gid_partitions(self, n_partitions):
+        """
+        Split the regions of the boundary table into n_partitions ranges of gids with (roughly) equal numbers of
+        regions, returning a list of (min, max) gid ranges.
+        """
+
+        get_gid_partitions_query = f"""
+        SELECT MIN(gid), MAX(gid)
+        FROM (
+            SELECT gid, NTILE(%s) OVER (ORDER BY gid) AS partition
+            FROM {self.boundary_table_name}
+        ) AS p
+        GROUP BY partition
+        ORDER BY 1;
+        """
+
+        self.cur.execute(get_gid_partitions_query, (n_partitions,))
+
+        return self.cur.fetchall()
 
     #########################################################################
     ### No overlap processing methods
@@ -158,12 +370,14 @@ class OverlapCalculator:
         Find the regions with no overlaps. Store these for easy analysis later.
         """
 
+        # Anti-join, which can use the primary key on the overlap table
         find_no_overlap_gids_query = f"""
         SELECT s.gid
         FROM {self.boundary_table_name} s
-        WHERE s.gid NOT IN (
-            SELECT DISTINCT gid
-            FROM {self.new_table_name}
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM "{self.new_table_name}" o
+            WHERE o.gid = s.gid
         );
         """
         self.cur.execute(find_no_overlap_gids_query)
@@ -257,12 +471,13 @@ class OverlapCalculator:
 
     def insert_closest_cell(self, gid, closest_grid_cell_id, bias_corrected):
         """
-        Insert the closest grid cell for the specified region into the database.
+        Insert the closest grid cell for the specified region into the database. As it is the only cell for the region,
+        it is given an overlap fraction (i.e. weight) of 1.
         """
 
         insert_closest_cell_query = f"""
-        INSERT INTO "{self.new_table_name}" (gid, grid_cell_id, is_overlap, bias_corrected)
-        VALUES (%s, %s, FALSE, %s);
+        INSERT INTO "{self.new_table_name}" (gid, grid_cell_id, is_overlap, bias_corrected, overlap_fraction)
+        VALUES (%s, %s, FALSE, %s, 1);
         """
 
         self.cur.execute(insert_closest_cell_query, (gid, closest_grid_cell_id, bias_corrected))
@@ -304,11 +519,61 @@ class OverlapCalculator:
 
         return closest_grid_cell_id, bbox_expansion, bias_corrected
 
+    def insert_closest_cells(self):
+        """
+        For all regions with no overlaps, find the closest grid cell and bulk insert into the overlap table in a single
+        query. The closest cell is found with a KNN search (ORDER BY <-> LIMIT 1) using the spatial index on the grid
+        table. The closest cell and its distance (in metres) are stored in self.no_overlap_closest_cells by gid.
+        """
+
+        insert_closest_cells_query = f"""
+        WITH closest AS (
+            SELECT s.gid, c.grid_cell_id, c.bias_corrected, ST_Distance(c.geometry, s.geom) AS distance
+            FROM {self.boundary_table_name} s
+            CROSS JOIN LATERAL (
+                SELECT g.grid_cell_id, g.bias_corrected, g.geometry
+                FROM {self.grid_table_name} g
+                ORDER BY g.geometry <-> s.geom
+                LIMIT 1
+            ) c
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM "{self.new_table_name}" o
+                WHERE o.gid = s.gid
+            )
+        ),
+        inserted AS (
+            INSERT INTO "{self.new_table_name}" (gid, grid_cell_id, is_overlap, bias_corrected, overlap_fraction)
+            SELECT gid, grid_cell_id, FALSE, bias_corrected, 1
+            FROM closest
+        )
+        SELECT gid, grid_cell_id, distance
+        FROM closest
+        ORDER BY gid;
+        """
+
+        self.cur.execute(insert_closest_cells_query)
+        closest_cells = self.cur.fetchall()
+        self.conn.commit()
+
+        print(f"{len(closest_cells)} no overlap regions found.\n")
+
+        for gid, closest_grid_cell_id, distance in closest_cells:
+            self.no_overlap_closest_cells[gid] = (closest_grid_cell_id, distance)
+            print(f"Inserted closest grid cell {closest_grid_cell_id} for region {gid} ({distance:.0f} m away).")
+
+        return closest_cells
+
     def process_no_overlap_regions(self, only_show_plots=False):
         """
-        Find regions with no overlaps, then for each region, find closest grid cell.
+        Find regions with no overlaps, then for each region, find closest grid cell. If only_show_plots set to True,
+        regions are processed one by one with an expanding bounding box search, and the candidate cells are plotted.
         """
 
+        if not only_show_plots:
+            self.insert_closest_cells()
+            return
+
         no_overlap_regions = self.find_no_overlap_regions()
 
         print(f"{len(no_overlap_regions)} no overlap regions found.\n")
@@ -316,9 +581,8 @@ class OverlapCalculator:
         for gid in no_overlap_regions:
             closest_grid_cell_id, bbox_expansion, bias_corrected = self.find_closest_cell(gid)
 
-            if only_show_plots:
-                print(f"Closest grid cell ID: {closest_grid_cell_id}, bbox expansion reached: {bbox_expansion}")
-                self.plot_region_and_candidates(gid, scale_factor=bbox_expansion)
+            print(f"Closest grid cell ID: {closest_grid_cell_id}, bbox expansion reached: {bbox_expansion}")
+            self.plot_region_and_candidates(gid, scale_factor=bbox_expansion)
 
             if closest_grid_cell_id:
                 self.insert_closest_cell(gid, closest_grid_cell_id, bias_corrected)
@@ -327,46 +591,178 @@ class OverlapCalculator:
     ### Processing all
     #########################################################################
 
-    def process_all_boundary_overlaps(self, process_no_overlaps=False):
+    def process_boundary(self, boundary_identifier, process_no_overlaps=False):
         """
-        For each of the boundaries, calculate grid cell overlaps and create a table. If process_no_overlaps set to True,
+        For a given boundary, calculate grid cell overlaps and create a table. If process_no_overlaps set to True,
         regions with no overlaps are also processed.
         """
 
-        boundary_identifiers = [
-            "uk_counties",
-            "la_districts",
-            "lsoa",
-            "msoa",
-            "parishes",
-            "sc_dz",
-            "ni_dz",
-            "iom",
-        ]
+        print(f"### Calculating grid cell overlaps: {boundary_identifier}")
+
+        self.set_boundary_table(boundary_identifier)
+        self.drop_table(self.new_table_name)
+        self.create_overlap_table()
+        self.ensure_spatial_index(self.grid_table_name, "geometry")
+        self.ensure_spatial_index(self.boundary_table_name, "geom")
+        self.insert_overlaps()
+        self.create_overlap_indexes()
+
+        print(f"Overlap insertion complete: {boundary_identifier}\n")
+
+        if process_no_overlaps:
+            print(f"### Processing regions with no overlaps: {boundary_identifier}")
+            self.process_no_overlap_regions()
+            print(f"### No overlap processing complete: {boundary_identifier}\n")
+
+    def refresh_boundary(self, boundary_identifier, changes, process_no_overlaps=False):
+        """
+        Update the overlap table of a boundary for the regions added, changed or removed since the overlaps were last
+        calculated (as found by src/boundary_changes.py), rather than recalculating every region. The overlaps of all
+        these regions are deleted, and those of added and changed regions inserted again, in a single transaction. If
+        process_no_overlaps set to True, added or changed regions with no overlaps are then also processed.
+        """
+
+        print(f"### Refreshing grid cell overlaps: {boundary_identifier}")
+
+        self.set_boundary_table(boundary_identifier)
+
+        updated_gids = changes["added"] + changes["changed"]
+        affected_gids = updated_gids + changes["removed"]
+
+        if not affected_gids:
+            print(f"No changed regions: {boundary_identifier}\n")
+            return
+
+        delete_overlaps_query = f"""
+        DELETE FROM "{self.new_table_name}"
+        WHERE gid = ANY(%s);
+        """
+
+        self.cur.execute(delete_overlaps_query, ([int(gid) for gid in affected_gids],))
+
+        # The deletions are committed with the insertions
+        if updated_gids:
+            self.insert_overlaps(gids=updated_gids)
+        else:
+            self.conn.commit()
+
+        if process_no_overlaps:
+            self.process_no_overlap_regions()
+
+        self.cur.execute(f'ANALYZE "{self.new_table_name}";')
+        self.conn.commit()
+
+        print(f"Overlap refresh complete: {boundary_identifier}\n")
+
+    def process_all_boundary_overlaps(self, process_no_overlaps=False, workers=None):
+        """
+        For each of the boundaries, calculate grid cell overlaps and create a table. If process_no_overlaps set to True,
+        regions with no overlaps are also processed. If a number of workers is given, boundaries are processed in
+        parallel (see process_all_boundary_overlaps_parallel).
+        """
+
+        if workers:
+            return self.process_all_boundary_overlaps_parallel(workers, process_no_overlaps)
 
         print("############################")
         print("### Processing all boundaries...\n")
 
-        for boundary_identifier in boundary_identifiers:
-            print(f"### Calculating grid cell overlaps: {boundary_identifier}")
+        for boundary_identifier in self.boundary_identifiers:
+            self.process_boundary(boundary_identifier, process_no_overlaps)
+
+        print("### Overlaps inserted for all boundaries.")
+        print("############################\n")
+
+        return None
+
+    def process_all_boundary_overlaps_parallel(self, workers, process_no_overlaps=False):
+        """
+        Calculate grid cell overlaps for all boundaries in a pool of worker threads, each with its own database
+        connection. Large boundaries (see self.boundary_partitions) are split into gid ranges, so that several
+        connections work on them at once. Once all partitions of a boundary are inserted, its regions with no overlaps
+        are processed (if process_no_overlaps set to True). The overlap tables, spatial indexes and (once each
+        boundary's partitions are inserted) the overlap table indexes are created using this class's connection.
+
+        Returns the time taken for each boundary, from its first partition starting to its last task finishing, or 0
+        for an empty boundary.
+        """
 
+        print("############################")
+        print(f"### Processing all boundaries with {workers} workers...\n")
+
+        tasks = []
+        for boundary_identifier in self.boundary_identifiers:
             self.set_boundary_table(boundary_identifier)
             self.drop_table(self.new_table_name)
             self.create_overlap_table()
             self.ensure_spatial_index(self.grid_table_name, "geometry")
             self.ensure_spatial_index(self.boundary_table_name, "geom")
-            self.insert_overlaps_optimised()
 
-            print(f"Overlap insertion complete: {boundary_identifier}\n")
+            n_partitions = self.boundary_partitions.get(boundary_identifier, 1)
+            gid_ranges = self.get_gid_partitions(n_partitions) if n_partitions > 1 else [None]
 
-            if process_no_overlaps:
-                print(f"### Processing regions with no overlaps: {boundary_identifier}")
-                self.process_no_overlap_regions()
-                print(f"### No overlap processing complete: {boundary_identifier}\n")
+            # An empty boundary table has no gid ranges: there is nothing to insert, so only its indexes are created
+            if not gid_ranges:
+                self.create_overlap_indexes()
+                print(f"No regions found, skipping overlap insertion: {boundary_identifier}\n")
+                continue
 
-        print("### Overlaps inserted for all boundaries.")
+            tasks += [(boundary_identifier, gid_range) for gid_range in gid_ranges]
+
+        remaining_partitions = {b: sum(1 for task in tasks if task[0] == b) for b in self.boundary_identifiers}
+        boundary_timings = {b: [] for b in self.boundary_identifiers}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running = {
+                executor.submit(
+                    process_partition_in_worker, self.conf, boundary_identifier, gid_range, False, self.raster_grid
+                ): (boundary_identifier, False)
+                for boundary_identifier, gid_range in tasks
+            }
+
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    boundary_identifier, is_no_overlap_task = running.pop(future)
+                    boundary_timings[boundary_identifier].append(future.result())
+
+                    if is_no_overlap_task:
+                        continue
+
+                    remaining_partitions[boundary_identifier] -= 1
+
+                    if remaining_partitions[boundary_identifier] == 0:
+                        # Indexes are built once all partitions are inserted, before processing no overlap regions
+                        self.set_boundary_table(boundary_identifier)
+                        self.create_overlap_indexes()
+
+                        print(f"Overlap insertion complete: {boundary_identifier}\n")
+
+                        if process_no_overlaps:
+                            future = executor.submit(
+                                process_partition_in_worker, self.conf, boundary_identifier, None, True
+                            )
+                            running[future] = (boundary_identifier, True)
+
+        boundary_times = {}
+
+        print("### Time taken per boundary:")
+        for boundary_identifier, timings in boundary_timings.items():
+            if not timings:
+                boundary_times[boundary_identifier] = 0.0
+                print(f"{boundary_identifier}: no regions")
+                continue
+
+            start_times, end_times = zip(*timings, strict=True)
+            boundary_times[boundary_identifier] = max(end_times) - min(start_times)
+            print(f"{boundary_identifier}: {boundary_times[boundary_identifier]:.2f} seconds")
+
+        print("\n### Overlaps inserted for all boundaries.")
         print("############################\n")
 
+        return boundary_times
+
     #########################################################################
     ### Plotting code
     #########################################################################
@@ -0,0 +1,142 @@
+import numpy as np
+import shapely
+from scipy.ndimage import binary_dilation
+
+
+def get_window(x_edges, y_edges, bounds):
+    """
+    Get the (inclusive) index ranges of the grid cells whose closed extent intersects the bounding box (minx, miny,
+    maxx, maxy). Cell (i, j) spans x_edges[j] to x_edges[j + 1] and y_edges[i] to y_edges[i + 1]. Returns None if the
+    bounding box is outside the grid.
+    """
+
+    minx, miny, maxx, maxy = bounds
+
+    j_min = max(np.searchsorted(x_edges, minx, side="left") - 1, 0)
+    j_max = min(np.searchsorted(x_edges, maxx, side="right") - 1, len(x_edges) - 2)
+    i_min = max(np.searchsorted(y_edges, miny, side="left") - 1, 0)
+    i_max = min(np.searchsorted(y_edges, maxy, side="right") - 1, len(y_edges) - 2)
+
+    if j_min > j_max or i_min > i_max:
+        return None
+
+    return i_min, i_max, j_min, j_max
+
+
+def get_edge_cells(geometry, x_edges, y_edges, window):
+    """
+    Find the cells in the window that the boundary of the geometry may pass through. The boundary is densified so that
+    its vertices are at most half a cell apart: any point on the boundary is then less than a cell away from a vertex,
+    so every cell the boundary touches is the cell of a vertex, or one of its neighbours.
+    """
+
+    i_min, i_max, j_min, j_max = window
+    edge = np.zeros((i_max - i_min + 1, j_max - j_min + 1), dtype=bool)
+
+    # Without a polygon boundary (i.e. a geometry collection) every cell is checked exactly
+    if geometry.geom_type not in ["Polygon", "MultiPolygon"]:
+        return ~edge
+
+    cell_size = min(x_edges[1] - x_edges[0], y_edges[1] - y_edges[0])
+    vertices = shapely.get_coordinates(shapely.segmentize(geometry.boundary, cell_size / 2))
+
+    i = np.searchsorted(y_edges, vertices[:, 1], side="right") - 1 - i_min
+    j = np.searchsorted(x_edges, vertices[:, 0], side="right") - 1 - j_min
+
+    # Vertices outside the window (i.e. on the far edge of the grid) are clipped onto it
+    edge[np.clip(i, 0, edge.shape[0] - 1), np.clip(j, 0, edge.shape[1] - 1)] = True
+
+    return binary_dilation(edge, structure=np.ones((3, 3), dtype=bool))
+
+
+def get_polygon_cells(geometry, x_edges, y_edges):
+    """
+    Rasterise a (multi)polygon onto the grid, returning the row and column indices of every cell it intersects (the
+    same cells as ST_Intersects against the cell polygons), and the fraction of each cell's area inside the polygon.
+    Cells away from the polygon boundary are either fully inside or fully outside it, so are classified by whether their
+    centre is inside the polygon. Only cells on the boundary are checked exactly, by intersecting the polygon with the
+    cell.
+    """
+
+    if x_edges[1] < x_edges[0] or y_edges[1] < y_edges[0]:
+        raise ValueError("Grid edges must be in ascending order.")
+
+    window = get_window(x_edges, y_edges, geometry.bounds)
+
+    if window is None:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    i_min, i_max, j_min, j_max = window
+    shapely.prepare(geometry)
+
+    edge = get_edge_cells(geometry, x_edges, y_edges, window)
+    overlaps = np.zeros_like(edge)
+    fractions = np.zeros(edge.shape, dtype=np.float32)
+
+    # Interior cells: check the cell centre
+    x_centres = (x_edges[j_min : j_max + 1] + x_edges[j_min + 1 : j_max + 2]) / 2
+    y_centres = (y_edges[i_min : i_max + 1] + y_edges[i_min + 1 : i_max + 2]) / 2
+
+    interior_i, interior_j = np.nonzero(~edge)
+    overlaps[interior_i, interior_j] = shapely.contains_xy(geometry, x_centres[interior_j], y_centres[interior_i])
+    fractions[overlaps] = 1
+
+    # Edge cells: exact intersection with the cell
+    edge_i, edge_j = np.nonzero(edge)
+    cells = shapely.box(
+        x_edges[edge_j + j_min],
+        y_edges[edge_i + i_min],
+        x_edges[edge_j + j_min + 1],
+        y_edges[edge_i + i_min + 1],
+    )
+    intersects = shapely.intersects(geometry, cells)
+    overlaps[edge_i, edge_j] = intersects
+
+    edge_i, edge_j, cells = edge_i[intersects], edge_j[intersects], cells[intersects]
+    fractions[edge_i, edge_j] = shapely.area(shapely.intersection(geometry, cells)) / shapely.area(cells)
+
+    i, j = np.nonzero(overlaps)
+
+    return i + i_min, j + j_min, fractions[i, j]
+
+
+def get_overlapping_cells(gids, geometries, x_edges, y_edges, mask):
+    """
+    Find the grid cells overlapping each region. Only cells in the grid table (i.e. non-zero in the aggregated,
+    labelled mask) are returned. Returns arrays of region gids, grid cell ids (i * nx + j, as in chess_scape_grid),
+    the fraction of each cell's area inside the region, and whether each cell is bias corrected (mask value of 1).
+    """
+
+    nx = mask.shape[1]
+
+    overlap_gids = []
+    overlap_grid_cell_ids = []
+    overlap_fractions = []
+
+    for gid, geometry in zip(gids, geometries, strict=True):
+        if geometry is None or geometry.is_empty:
+            continue
+
+        i, j, fractions = get_polygon_cells(geometry, x_edges, y_edges)
+
+        in_grid = mask[i, j] != 0
+        i, j = i[in_grid], j[in_grid]
+
+        overlap_gids.append(np.full(len(i), gid, dtype=np.int32))
+        overlap_grid_cell_ids.append((i * nx + j).astype(np.int32))
+        overlap_fractions.append(fractions[in_grid])
+
+    if not overlap_gids:
+        return (
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.float32),
+            np.empty(0, dtype=bool),
+        )
+
+    overlap_gids = np.concatenate(overlap_gids)
+    overlap_grid_cell_ids = np.concatenate(overlap_grid_cell_ids)
+    overlap_fractions = np.concatenate(overlap_fractions)
+    bias_corrected = mask.ravel()[overlap_grid_cell_ids] == 1
+
+    return overlap_gids, overlap_grid_cell_ids, overlap_fractions, bias_corrected
@@ -0,0 +1,103 @@
+import re
+
+import psycopg2
+
+# Suffix of the name a table is built under, before being swapped in to replace the live table
+SHADOW_SUFFIX = "__shadow"
+
+
+def get_shadow_table_name(table_name):
+    """
+    Get the name a table is built under before it is swapped in (see swap_tables).
+    """
+
+    return f"{table_name}{SHADOW_SUFFIX}"
+
+
+def get_indexes(cur, table_name):
+    """
+    Get the indexes of a table, as a dictionary of index name to (index definition, is primary key). Returns an empty
+    dictionary if the table does not exist.
+    """
+
+    select_indexes_query = """
+    SELECT i.relname, pg_get_indexdef(i.oid), x.indisprimary
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    WHERE x.indrelid = to_regclass(%s);
+    """
+
+    cur.execute(select_indexes_query, (f'"{table_name}"',))
+
+    return {index_name: (index_definition, is_primary) for index_name, index_definition, is_primary in cur.fetchall()}
+
+
+def copy_indexes(cur, table_name, shadow_table_name):
+    """
+    Create any indexes of the live table that are missing from the shadow table, such as indexes added to the live table
+    by a later stage of the build (i.e. the spatial index on the grid table, see OverlapCalculator). Only indexes named
+    after their table (i.e. <table_name>_<column>_idx) are copied, as are all indexes created in this module. Primary
+    keys are not copied, as they are created with the table.
+    """
+
+    shadow_indexes = get_indexes(cur, shadow_table_name)
+
+    for index_name, (index_definition, is_primary) in get_indexes(cur, table_name).items():
+        if is_primary or not index_name.startswith(table_name):
+            continue
+
+        shadow_index_name = shadow_table_name + index_name[len(table_name) :]
+
+        if shadow_index_name in shadow_indexes:
+            continue
+
+        # Point the definition (CREATE [UNIQUE] INDEX <name> ON [ONLY] <schema>.<table> ...) at the shadow table
+        match = re.match(r"^(CREATE (?:UNIQUE )?INDEX )\S+( ON (?:ONLY )?)\S+", index_definition)
+        shadow_index_definition = (
+            f'{match.group(1)}"{shadow_index_name}"{match.group(2)}"{shadow_table_name}"'
+            f"{index_definition[match.end() :]}"
+        )
+
+        cur.execute(shadow_index_definition)
+
+
+def swap_tables(conn, cur, table_names):
+    """
+    Replace live tables with the shadow tables built for them (see get_shadow_table_name), so that readers see either
+    the old or the new data, but never a missing or partially built table.
+
+    First, indexes of the live tables missing from the shadow tables are created, and the shadow tables are analyzed.
+    Then, in a single transaction, each live table is dropped, and its shadow table and shadow indexes are renamed to
+    the live names. Statistics belong to the table rather than its name, so queries are planned with them as soon as
+    the swap is committed. Readers only wait for the (brief) swap transaction.
+    """
+
+    try:
+        for table_name in table_names:
+            shadow_table_name = get_shadow_table_name(table_name)
+
+            copy_indexes(cur, table_name, shadow_table_name)
+            cur.execute(f'ANALYZE "{shadow_table_name}";')
+
+        conn.commit()
+
+        for table_name in table_names:
+            shadow_table_name = get_shadow_table_name(table_name)
+
+            cur.execute(f'DROP TABLE IF EXISTS "{table_name}";')
+            cur.execute(f'ALTER TABLE "{shadow_table_name}" RENAME TO "{table_name}";')
+
+            # Renaming the index of a primary key also renames the constraint
+            for index_name in get_indexes(cur, table_name):
+                if index_name.startswith(shadow_table_name):
+                    live_index_name = table_name + index_name[len(shadow_table_name) :]
+                    cur.execute(f'ALTER INDEX "{index_name}" RENAME TO "{live_index_name}";')
+
+        conn.commit()
+
+    except psycopg2.Error as e:
+        print(f"Error swapping in tables {table_names}: {e}")
+        conn.rollback()
+        raise
+
+    print(f"Swapped in tables: {', '.join(table_names)}")
@@ -29,6 +29,17 @@ var conString = "postgres://" + username + ":" + password + "@" + host + "/" + d
 let all_boundary_details = {};
 initialiseBoundaryDetails();
 
+// Precomputed simplification tiers (see data/src/boundary_simplifier.py), loaded once at startup. Maps each boundary
+// table to its tier tolerances in metres, largest first. Tables without tiers are simplified on each request
+let simplified_tiers = {};
+initialiseSimplifiedTiers();
+
+// CHESS-SCAPE tables stored in the array layout (see data/src/climate_layout.py), loaded at startup. Cell method
+// queries read these tables if present, otherwise the wide layout tables. Loading a layout drops the other layout's
+// tables, so these are fetched again if a cell method query finds its table missing
+let climate_array_tables = new Set();
+initialiseClimateArrayTables();
+
 /// GET BOUNDARY DATA FROM DB ///
 
 // Function to fetch boundary details from the PostgreSQL table and store in memory
@@ -71,6 +82,80 @@ async function initialiseBoundaryDetails() {
     }
 }
 
+// Function to fetch the simplified geometry tiers of each boundary table: columns geom_4326_<tolerance> of the
+// boundary_<identifier>_simplified tables
+async function fetchSimplifiedTiers() {
+    try {
+        const client = new Client(conString);
+        await client.connect();
+
+        const result = await client.query(`
+            SELECT table_name, column_name
+            FROM information_schema.columns
+            WHERE table_name LIKE 'boundary\\_%\\_simplified' AND column_name LIKE 'geom\\_4326\\_%'
+        `);
+        const tiers = {};
+
+        result.rows.forEach((row) => {
+            const tableName = row.table_name.replace(/_simplified$/, "");
+            const tolerance = parseInt(row.column_name.replace("geom_4326_", ""));
+
+            if (!isNaN(tolerance)) {
+                tiers[tableName] = [...(tiers[tableName] || []), tolerance];
+            }
+        });
+
+        Object.values(tiers).forEach((tolerances) => tolerances.sort((a, b) => b - a));
+
+        await client.end();
+        console.log("Simplified geometry tiers successfully fetched from the database.");
+        return tiers;
+    } catch (error) {
+        console.error("Error fetching simplified geometry tiers from the database:", error);
+        return {};
+    }
+}
+
+// Initialise simplified geometry tiers
+async function initialiseSimplifiedTiers() {
+    simplified_tiers = await fetchSimplifiedTiers();
+}
+
+// Get the largest precomputed tier tolerance no larger than the requested tolerance (so geometries are at least as
+// detailed as requested), or null if the table has no suitable tier
+function getSimplifiedTier(table, tolerance) {
+    const tolerances = simplified_tiers[table] || [];
+    const tier = tolerances.find((tierTolerance) => tierTolerance <= tolerance);
+
+    return tier === undefined ? null : tier;
+}
+
+// Function to fetch the names of the array layout CHESS-SCAPE tables: chess_scape_rcp<rcp>_<season>_arrays
+async function fetchClimateArrayTables() {
+    try {
+        const client = new Client(conString);
+        await client.connect();
+
+        const result = await client.query(`
+            SELECT table_name
+            FROM information_schema.tables
+            WHERE table_name LIKE 'chess\\_scape\\_rcp%\\_arrays'
+        `);
+
+        await client.end();
+        console.log("CHESS-SCAPE table layouts successfully fetched from the database.");
+        return new Set(result.rows.map((row) => row.table_name));
+    } catch (error) {
+        console.error("Error fetching CHESS-SCAPE table layouts from the database:", error);
+        return new Set();
+    }
+}
+
+// Initialise array layout CHESS-SCAPE tables
+async function initialiseClimateArrayTables() {
+    climate_array_tables = await fetchClimateArrayTables();
+}
+
 // For a given boundary dataset, get all region gids and names in geojson dataset
 router.get("/all_regions", async function (req, res) {
     try {
@@ -181,6 +266,30 @@ router.get("/region", async function (req, res) {
         // Placeholder for additional properties
         const props = "";
 
+        // Use precomputed simplified geometries if available, otherwise simplify on the fly
+        const tier = getSimplifiedTier(table, tolerance);
+
+        // Query: Build GeoJSON object for the given bounding box, from precomputed geometries (already in EPSG 4326)
+        const get_simplified_region_query = `
+            SELECT json_build_object(
+                'type', 'FeatureCollection',
+                'features', json_agg(
+                    json_build_object(
+                        'type', 'Feature',
+                        'properties', json_build_object(
+                            'gid', b.gid,
+                            'name', b.${boundaryDetails.name_col}
+                            ${props ? `, ${props}` : ""}
+                        ),
+                        'geometry', ST_AsGeoJSON(s.geom_4326_${tier})::json
+                    )
+                )
+            )
+            FROM ${table}_simplified s
+            JOIN ${table} b ON b.gid = s.gid
+            WHERE ST_Intersects(s.geom_4326_${tier}, ST_MakeEnvelope($1, $2, $3, $4, 4326));
+        `;
+
         // Query: Build GeoJSON object for the given bounding box
         const get_region_query = `
             SELECT json_build_object(
@@ -210,7 +319,10 @@ router.get("/region", async function (req, res) {
             );
         `;
 
-        const result = await client.query(get_region_query, [tolerance, left, bottom, right, top]);
+        const result =
+            tier === null
+                ? await client.query(get_region_query, [tolerance, left, bottom, right, top])
+                : await client.query(get_simplified_region_query, [left, bottom, right, top]);
 
         // Send the result as GeoJSON
         if (result.rows.length > 0) {
@@ -291,6 +403,48 @@ function buildAvgClimateCols() {
     return averageClimateColNames;
 }
 
+// CHESS-SCAPE helper function: generate area-weighted climate column SQL, weighting each cell by the fraction of
+// its area inside the selected regions (falling back to the plain mean if all cells only touch the regions). Weighted
+// sums are taken in double precision, as climate columns may be stored as REAL (summed in single precision)
+function buildWeightedAvgClimateCols() {
+    const weightedClimateColNames = [];
+    const variables = ["tas", "sfcWind", "pr", "rsds"];
+    const decades = ["1980", "1990", "2000", "2010", "2020", "2030", "2040", "2050", "2060", "2070"];
+
+    for (const variable of variables) {
+        for (const decade of decades) {
+            const col = `"${variable}_${decade}_mean"`;
+            weightedClimateColNames.push(
+                `COALESCE(SUM(o.weight * c.${col}::float8) / NULLIF(SUM(o.weight), 0), AVG(c.${col})) as ${col}`,
+            );
+        }
+    }
+
+    return weightedClimateColNames;
+}
+
+// CHESS-SCAPE helper function: generate area-weighted climate column SQL for the array layout. Each table row holds a
+// variable's [decade][statistic] array (statistics are min, mean and max), so each column aggregates an array
+// element over the rows of its variable
+function buildWeightedAvgClimateArrayCols() {
+    const weightedClimateColNames = [];
+    const variables = ["tas", "sfcWind", "pr", "rsds"];
+    const decades = ["1980", "1990", "2000", "2010", "2020", "2030", "2040", "2050", "2060", "2070"];
+
+    for (const variable of variables) {
+        decades.forEach((decade, i) => {
+            const element = `c.decade_stats[${i + 1}][2]`;
+            const filter = `FILTER (WHERE c.variable = '${variable}')`;
+            weightedClimateColNames.push(
+                `COALESCE(SUM(o.weight * ${element}::float8) ${filter} / NULLIF(SUM(o.weight) ${filter}, 0), ` +
+                    `AVG(${element}) ${filter}) as "${variable}_${decade}_mean"`,
+            );
+        });
+    }
+
+    return weightedClimateColNames;
+}
+
 // Build query string: cache method - uses cache tables in database (large regions)
 function buildCacheQuery(boundaryDetails, locations, rcp, season, averageColNames) {
     const cacheTable = `cache_${boundaryDetails.identifier}_to_${rcp}_${season}`;
@@ -303,27 +457,50 @@ function buildCacheQuery(boundaryDetails, locations, rcp, season, averageColName
         `;
 }
 
-// Build query string: cell method - performs calculations on the fly from CHESS-SCAPE tables
-function buildCellQuery(boundaryDetails, locations, rcp, season, averageColNames) {
+// Build query string: cell method - performs calculations on the fly from CHESS-SCAPE tables. Cells are weighted by
+// their overlap fraction, read from the covering index on the overlap table (regions don't overlap, so the fractions
+// of a cell shared by several selected regions are summed)
+function buildCellQuery(boundaryDetails, locations, rcp, season, weightedColNames) {
     const gridTable = `grid_overlaps_${boundaryDetails.identifier}`;
     const chessTable = `chess_scape_${rcp}_${season}`;
     const locationGids = locations.join(",");
 
+    // Array layout: only the rows of the returned variables are read
+    if (climate_array_tables.has(`${chessTable}_arrays`)) {
+        return buildCellArrayQuery(gridTable, `${chessTable}_arrays`, locationGids);
+    }
+
     const innerSelectCellsQuery = `
-        (SELECT DISTINCT grid_cell_id
-        FROM ${gridTable} 
-        WHERE gid IN (${locationGids}))
+        (SELECT grid_cell_id, SUM(overlap_fraction) AS weight
+        FROM ${gridTable}
+        WHERE gid IN (${locationGids})
+        GROUP BY grid_cell_id) o
         `;
 
     const selectClimateQuery = `
-        SELECT ${averageColNames.join(",")} 
-        FROM ${chessTable} 
-        WHERE grid_cell_id IN ${innerSelectCellsQuery};
+        SELECT ${weightedColNames.join(",")}
+        FROM ${innerSelectCellsQuery}
+        JOIN ${chessTable} c ON c.grid_cell_id = o.grid_cell_id;
         `;
 
     return selectClimateQuery;
 }
 
+// Build query string: cell method, for CHESS-SCAPE tables in the array layout
+function buildCellArrayQuery(gridTable, chessArrayTable, locationGids) {
+    const variables = ["tas", "sfcWind", "pr", "rsds"].map((variable) => `'${variable}'`);
+
+    return `
+        SELECT ${buildWeightedAvgClimateArrayCols().join(",")}
+        FROM
+        (SELECT grid_cell_id, SUM(overlap_fraction) AS weight
+        FROM ${gridTable}
+        WHERE gid IN (${locationGids})
+        GROUP BY grid_cell_id) o
+        JOIN ${chessArrayTable} c ON c.grid_cell_id = o.grid_cell_id AND c.variable IN (${variables.join(",")});
+        `;
+}
+
 // Check table name helper function: check front end table name is valid
 function is_valid_boundary(tableName) {
     return [
@@ -368,7 +545,7 @@ router.get("/chess_scape", async (req, res) => {
         // Build query based on variables and method
         let query;
         if (method === "cell") {
-            query = buildCellQuery(boundaryDetails, locations, rcp, season, averageClimateColNames);
+            query = buildCellQuery(boundaryDetails, locations, rcp, season, buildWeightedAvgClimateCols());
         } else {
             query = buildCacheQuery(boundaryDetails, locations, rcp, season, averageClimateColNames);
         }
@@ -377,10 +554,23 @@ router.get("/chess_scape", async (req, res) => {
         const client = new Client(conString);
         await client.connect();
 
-        const result = await client.query(query);
-        res.json(result.rows);
+        let result;
+        try {
+            result = await client.query(query);
+        } catch (err) {
+            // Undefined table: the climate table layout may have changed since it was fetched, so fetch it and retry
+            if (method !== "cell" || err.code !== "42P01") {
+                throw err;
+            }
 
-        await client.end();
+            await initialiseClimateArrayTables();
+            result = await client.query(
+                buildCellQuery(boundaryDetails, locations, rcp, season, buildWeightedAvgClimateCols()),
+            );
+        } finally {
+            await client.end();
+        }
+        res.json(result.rows);
     } catch (err) {
         console.error("Error while executing query:", err);
         res.status(500).send({ error: "An error occurred" });